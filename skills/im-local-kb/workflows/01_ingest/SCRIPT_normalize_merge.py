@@ -1,11 +1,32 @@
+import io
+import sys
+import json
+import struct
 import hashlib
+import bisect
+import cProfile
 import argparse
+from array import array
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from SCRIPT_util import *
-from typing import Callable, Any, List
+from typing import Callable, Any, Dict, Iterator, List, Optional, Sequence, Tuple
 
-def seq_match(list_s: List[Any], list_l: List[Any], item_getter: Callable[[Any], Any]) -> int:
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，退化为不加锁
+    fcntl = None
+
+# 本进程的阶段计时与计数（见 StageProfiler）：parse / digest / dump / load / hash / match / splice / collapse / write / index / archive
+PROFILER = StageProfiler()
+
+def _identity(x: Any) -> Any:
+    return x
+
+def seq_match(list_s: List[Any], list_l: List[Any], item_getter: Optional[Callable[[Any], Any]] = None) -> int:
     """
     在 list_l 中寻找 list_s 的连续匹配项，返回匹配的起始索引，如果没有找到返回 -1
+    item_getter 为 None 时直接比较元素本身（例如 HashedLines.digests 中的整数指纹）。
     虽然 KMP 更好，但我们先无视
     long_l = [
         {'id': 10, 'name': 'A'},
@@ -32,6 +53,8 @@ def seq_match(list_s: List[Any], list_l: List[Any], item_getter: Callable[[Any],
         return -1
 
     # 预先提取短列表的特征值，避免在双重循环中重复计算
+    if item_getter is None:
+        item_getter = _identity
     target_s = [item_getter(item) for item in list_s]
 
     for i in range(m - n + 1):
@@ -47,10 +70,11 @@ def seq_match(list_s: List[Any], list_l: List[Any], item_getter: Callable[[Any],
 
     return -1
 
-def seq_longest_common_prefix_length(list_s: List[Any], list_l: List[Any], item_getter: Callable[[Any], Any]) -> int:
+def seq_longest_common_prefix_length(list_s: List[Any], list_l: List[Any], item_getter: Optional[Callable[[Any], Any]] = None, start_l: int = 0) -> int:
     """
     寻找两个 list 的公共最长前缀长度，返回匹配的长度。
     如果没有，返回 0。
+    start_l: 从 list_l 的该下标开始比对，等价于传入 list_l[start_l:]，但不复制列表。
     例如：
     long_l = [
         {'id': 10, 'name': 'A'},
@@ -71,8 +95,10 @@ def seq_longest_common_prefix_length(list_s: List[Any], list_l: List[Any], item_
     print(seq_longest_prefix_match(short_l_3, long_l, getter))  # 输出: 0
     """
     i = 0
-    j = 0
+    j = start_l
     max_match_length = 0
+    if item_getter is None:
+        item_getter = _identity
 
     while i < len(list_s) and j < len(list_l):
         if item_getter(list_s[i]) == item_getter(list_l[j]):
@@ -84,14 +110,17 @@ def seq_longest_common_prefix_length(list_s: List[Any], list_l: List[Any], item_
 
     return max_match_length
 
-def seq_longest_common_suffix_length(list_s: List[Any], list_l: List[Any], item_getter: Callable[[Any], Any]) -> int:
+def seq_longest_common_suffix_length(list_s: List[Any], list_l: List[Any], item_getter: Optional[Callable[[Any], Any]] = None, end_l: Optional[int] = None) -> int:
     """
     寻找两个 list 的公共最长后缀长度，返回匹配的长度。
     如果没有，返回 0。
+    end_l: 只比对 list_l 中该下标之前的部分，等价于传入 list_l[:end_l]，但不复制列表。
     """
     i = len(list_s) - 1
-    j = len(list_l) - 1
+    j = slice(None, end_l).indices(len(list_l))[1] - 1
     max_match_length = 0
+    if item_getter is None:
+        item_getter = _identity
 
     while i >= 0 and j >= 0:
         if item_getter(list_s[i]) == item_getter(list_l[j]):
@@ -103,6 +132,51 @@ def seq_longest_common_suffix_length(list_s: List[Any], list_l: List[Any], item_
 
     return max_match_length
 
+class AnchorIndex:
+    """
+    目标文件 hash 行的锚点索引：hash -> 该 hash 在 hash 列表中第一次出现的位置。
+    find 的结果与 seq_match 完全相同（返回第一个完整匹配窗口的起始下标）：
+    先通过索引直接跳到窗口首个 hash 的第一个候选位置，候选窗口不匹配时再用 list.index 找下一个候选。
+    常见情况下耗时约为 O(窗口长度)，而不是 O(目标行数 × 窗口长度)。
+
+    >>> index = AnchorIndex(['a', 'b', 'c', 'b', 'c', 'd'])
+    >>> index.find(['b', 'c'])
+    1
+    >>> index.find(['b', 'c', 'd'])
+    3
+    >>> index.find(['c', 'x'])
+    -1
+    """
+
+    def __init__(self, keys: List[Any]):
+        self.keys = keys
+        # 倒序构建，保证同一个 hash 保留的是第一次出现的位置
+        self.first_position: Dict[Any, int] = dict(zip(reversed(keys), range(len(keys) - 1, -1, -1)))
+
+    def find(self, window: List[Any]) -> int:
+        """
+        在索引的 keys 中寻找 window 的连续匹配，返回第一个匹配的起始下标，没有找到返回 -1。
+        """
+        n = len(window)
+        m = len(self.keys)
+        if n == 0:
+            return 0
+        if n > m:
+            return -1
+
+        keys = self.keys
+        head = window[0]
+        i = self.first_position.get(head, -1)
+        while 0 <= i <= m - n:
+            if keys[i:i + n] == window:
+                return i
+            try:
+                i = keys.index(head, i + 1)
+            except ValueError:
+                break
+        return -1
+
+
 class MatchPoint:
     """
     描述单一匹配点的详细信息。
@@ -160,6 +234,12 @@ class MergeResult:
             "added_lines": 0,
             "status": "pending"
         }
+        # 性能计数
+        self.perf = {
+            "desc": "合并该块时的计数与耗时：hash 的行数、写入目标缓冲的字节数，以及 hash/match/splice 等阶段的耗时（毫秒）。",
+            "lines_hashed": 0,
+            "bytes_written": 0
+        }
 
     def to_dict(self):
         """
@@ -175,120 +255,477 @@ class MergeResult:
                 "end_anchor": vars(self.end_anchor)
             }),
             ("05_overlap_analysis", self.overlap_analysis),
-            ("06_action_taken", self.action_taken)
+            ("06_action_taken", self.action_taken),
+            ("07_perf", self.perf)
         ])
 
 
-def magic_merge(new_block: ChatBlock, target_filename: str) -> MergeResult:
+def hash_line(s: str) -> int:
+    """
+    内容指纹：对 extract_hashing_line 预处理后的内容计算 SHA-256，取前 8 字节作为 64 位整数。
     """
-    使用 new_block 和 target_filename 定位的目标文件进行合并，返回 MergeResult
+    return int.from_bytes(hashlib.sha256(s.encode('utf-8')).digest()[:8], 'little')
 
-    这个方法会
-    1. 处理 new_block 的每一行，留下 hash 部分和非 hash 部分(保留和 new_block 的映射关系)
-    2. 处理目标文件的每一行，留下 hash 部分和非 hash 部分(保留和目标文件原始行的映射关系)
-    3. 用 new_block 的前 N 行（仅 hash 行）去目标文件中匹配，找到最后一个完全匹配的行（match_start）
-    4. 用 new_block 的后 N 行（仅 hash 行）去目标文件中匹配，找到第一个完全匹配的行（match_end）
 
-    如果 match_start 和 match_end 都存在，且 match_start 行号 < match_end 行号，则认为 new_block 在目标文件中间找到匹配，可以进行拼接合并
+class HashedLines:
+    """
+    一组行的紧凑 hash 表示，只记录 hash 行（extract_hashing_line 不为 None 的行）：
+    - digests: array('Q')，每个 hash 行的 64 位内容指纹（见 hash_line）
+    - line_idx: array('I')，每个 hash 行在原始行列表中的行号（升序）
+    不保存内容副本，需要内容时通过原始行列表按行号取得。
+    相比每行一个 dict + 64 位十六进制字符串，内存占用小一个数量级，比较时也只比较整数。
+
+    >>> hashed = HashedLines.from_lines(["这是一条足够长的消息", "[图片]", "另一条足够长的消息"])
+    >>> list(hashed.line_idx)
+    [0, 2]
+    >>> len(hashed)
+    2
+    """
 
-        写出顺序：
-        1. 目标文件中 match_start 行（映射回原始行号）之前的内容
-        2. new_block 中 match_start 行（映射回原始行号）到 match_end 行（映射回原始行号）的内容
-        3. 目标文件中 match_end 行（映射回原始行号）之后的内容
+    __slots__ = ('digests', 'line_idx')
 
-    如果只有 match_start 存在，认为 new_block 的前半部分在目标文件中找到匹配，可以进行拼接合并
+    def __init__(self, digests: Optional[array] = None, line_idx: Optional[array] = None):
+        self.digests = digests if digests is not None else array('Q')
+        self.line_idx = line_idx if line_idx is not None else array('I')
 
-        写出顺序：
-        1. 目标文件中 match_start 行（映射回原始行号）之前的内容
-        2. new_block 中 match_start 行（映射回原始行号）到结尾的内容
+    @classmethod
+    def from_lines(cls, lines: List[str]) -> 'HashedLines':
+        """
+        处理每一行，留下 hash 部分（保留和原始行号的映射关系）。
+        """
+        hashed = cls()
+        digests_append = hashed.digests.append
+        line_idx_append = hashed.line_idx.append
+        extract = RegexPatterns.extract_hashing_line
+        with PROFILER.span("hash"):
+            for idx, line in enumerate(lines):
+                hashing = extract(line)
+                if hashing:
+                    digests_append(hash_line(hashing))
+                    line_idx_append(idx)
+        PROFILER.count("lines_hashed", len(lines))
+        return hashed
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+    def lines_between(self, line_from: int, line_to: int) -> 'HashedLines':
+        """
+        取出行号位于 [line_from, line_to) 的 hash 行，行号改为相对于 line_from。
+        """
+        lo = bisect.bisect_left(self.line_idx, line_from)
+        hi = bisect.bisect_left(self.line_idx, line_to)
+        return HashedLines(self.digests[lo:hi], array('I', (i - line_from for i in self.line_idx[lo:hi])))
 
-    如果只有 match_end 存在，认为 new_block 的后半部分在目标文件中找到匹配，可以进行拼接合并
+    def splice(self, line_from: int, line_to: int, replacement: 'HashedLines', replacement_line_count: int):
+        """
+        对应原始行列表中 lines[line_from:line_to] 被替换为 replacement_line_count 行（其 hash 行为 replacement，行号相对）：
+        之前的 hash 行不变，之后的 hash 行行号整体平移。
+        """
+        lo = bisect.bisect_left(self.line_idx, line_from)
+        hi = bisect.bisect_left(self.line_idx, line_to)
+        delta = replacement_line_count - (line_to - line_from)
+        self.digests[lo:hi] = replacement.digests
+        tail = array('I', (i + delta for i in self.line_idx[hi:])) if delta else self.line_idx[hi:]
+        self.line_idx[lo:] = array('I', (i + line_from for i in replacement.line_idx))
+        self.line_idx.extend(tail)
 
-        写出顺序：
-        1. 目标文件的 yaml header 部分（如果有的话）
-        1. new_block 中 从开始到 match_end 行（映射回原始行号）的内容
-        2. 目标文件中 match_end 行（映射回原始行号）之后的内容
 
-    如果都没找到，认为 new_block 没有在目标文件中找到匹配，直接按时间顺序插入到目标文件中合适的位置。
+class LineHashIndex:
+    """
+    整理后文件的行 hash 缓存，以 sidecar 文件（KnowledgeBasePaths.get_org_hash_index_path）的形式保存在文件旁边。
+    记录每行的起始字节偏移、hash 行的行号及其内容指纹（见 hash_line），并以文件大小、mtime 和内容摘要作为键：
+    文件没有变化时直接复用，不必对每一行重新执行 extract_hashing_line + SHA-256。
+
+    文件格式（小端）：
+    - header: magic(8s) version(u32) size(u64) mtime_ns(u64) content_digest(16s) line_count(u64) hashed_count(u64)
+    - line_offsets: (line_count + 1) × u64，每行的起始字节偏移，最后一项为文件大小
+    - hashed_line_idx: hashed_count × u32，hash 行的行号
+    - digests: hashed_count × u64，hash 行的内容指纹
+    """
 
-        构建一个 ChatOrgFile,
-        然后添加 new_block，
-        按照时间顺序排序，
-        写出覆盖目标文件即可。
+    MAGIC = b"IMKBHIDX"
+    VERSION = 2
+    _HEADER = struct.Struct("<8sIQQ16sQQ")
+    _NEWLINE = re.compile(rb"\r\n|\r|\n")  # 与文本模式读取（universal newlines）的断行规则一致
+
+    def __init__(self, size: int, mtime_ns: int, content_digest: bytes, line_offsets: array, hashed: HashedLines):
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.content_digest = content_digest
+        self.line_offsets = line_offsets
+        self.hashed = hashed
+
+    @staticmethod
+    def digest_content(data: bytes) -> bytes:
+        """
+        文件内容摘要，用于校验缓存是否仍然对应当前文件内容。
+        """
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    @classmethod
+    def build(cls, data: bytes, hashed: HashedLines, st: os.stat_result) -> 'LineHashIndex':
+        """
+        根据文件原始字节和已经计算好的 HashedLines 构建缓存。
+        """
+        line_offsets = array('Q', [0])
+        line_offsets.extend(m.end() for m in cls._NEWLINE.finditer(data))
+        if line_offsets[-1] != len(data):
+            line_offsets.append(len(data))
+        return cls(st.st_size, st.st_mtime_ns, cls.digest_content(data), line_offsets, hashed)
+
+    @classmethod
+    def read(cls, path: str) -> Optional['LineHashIndex']:
+        """
+        读取缓存文件。文件不存在、版本不符或内容损坏时返回 None。
+        """
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            magic, version, size, mtime_ns, content_digest, line_count, hashed_count = cls._HEADER.unpack_from(raw)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                return None
+            pos = cls._HEADER.size
+            line_offsets = cls._read_array('Q', raw, pos, line_count + 1)
+            pos += 8 * (line_count + 1)
+            hashed_line_idx = cls._read_array('I', raw, pos, hashed_count)
+            pos += 4 * hashed_count
+            digests = cls._read_array('Q', raw, pos, hashed_count)
+        except (OSError, struct.error, ValueError):
+            return None
+        return cls(size, mtime_ns, content_digest, line_offsets, HashedLines(digests, hashed_line_idx))
+
+    @staticmethod
+    def _read_array(typecode: str, raw: bytes, pos: int, count: int) -> array:
+        arr = array(typecode)
+        end = pos + arr.itemsize * count
+        if end > len(raw):
+            raise ValueError("hash index truncated")
+        arr.frombytes(raw[pos:end])
+        if sys.byteorder != 'little':
+            arr.byteswap()
+        return arr
+
+    def write(self, path: str):
+        """
+        写出缓存文件（先写临时文件再替换，避免留下写了一半的缓存）。
+        """
+        header = self._HEADER.pack(self.MAGIC, self.VERSION, self.size, self.mtime_ns, self.content_digest,
+                                   len(self.line_offsets) - 1, len(self.hashed))
+        arrays = [array('Q', self.line_offsets), array('I', self.hashed.line_idx), array('Q', self.hashed.digests)]
+        if sys.byteorder != 'little':
+            for arr in arrays:
+                arr.byteswap()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            for arr in arrays:
+                f.write(arr.tobytes())
+        os.replace(tmp_path, path)
+
+    def matches(self, data: bytes, st: os.stat_result) -> bool:
+        """
+        校验缓存是否对应当前文件：大小不同直接判定失效；否则以内容摘要为准（mtime 变化但内容未变时缓存仍然有效）。
+        """
+        if self.size != st.st_size or self.size != len(data):
+            return False
+        return self.content_digest == self.digest_content(data)
+
+    def hashed_for(self, lines: List[str]) -> Optional[HashedLines]:
+        """
+        返回缓存的 HashedLines。行数与缓存不一致时返回 None。
+        """
+        if len(self.line_offsets) - 1 != len(lines):
+            return None
+        return self.hashed
 
+
+_UNBUILT = object()
+
+
+class MergeTarget:
+    """
+    目标文件在内存中的行缓冲。
+    目标文件只在 load 时读取并 hash 一次，之后多个块依次合并到缓冲中，最后由 flush 一次性写回。
+    包含以下属性：
+    - file_path: 目标文件路径
+    - exists: 目标文件是否存在（或已经有内容等待写回）
+    - lines: 目标文件的当前行列表
+    - hashed: lines 的 hash 行（HashedLines）
+    - dirty: 缓冲是否有尚未写回的修改
     """
-    # 1. 初始化结果对象与参数
-    RESULT = MergeResult(target_filename, new_block.chat_name, new_block.time_tag)
-    opt_search_lines = 5  # 可配置：匹配时考虑的行数范围
 
-    # 2. 构建 hash function
-    def hash_line(s: str) -> str:
-        return hashlib.sha256(s.encode('utf-8')).hexdigest()
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.exists = False
+        self.lines: List[str] = []
+        self.hashed = HashedLines()
+        self.dirty = False
+        self._anchor_index: Optional[AnchorIndex] = None
+        # 时间标签索引：未构建时为 _UNBUILT，文件不规范时为 None
+        self._time_tag_index: Any = _UNBUILT
+
+    @property
+    def anchor_index(self) -> AnchorIndex:
+        """
+        hash 行的锚点索引，按需构建；缓冲被修改后失效，下次使用时重建。
+        """
+        if self._anchor_index is None:
+            self._anchor_index = AnchorIndex(self.hashed.digests)
+        return self._anchor_index
 
-    # 我们需要用一个数据结构表达 chat_block -> {hashable_line, hash, original_content_line_idx}[]
-    RESULT.block_stats["total_lines"] = len(new_block.content)
-    new_block_hash_list = []
-    for idx, line in enumerate(new_block.content):
-        hashing = RegexPatterns.extract_hashing_line(line)
-        if hashing:
-            new_block_hash_list.append({
-                "hash": hash_line(hashing),
-                "original_content_line_idx": idx,
-                "content": line
-            })
-    RESULT.block_stats["hashable_lines"] = len(new_block_hash_list)
-    RESULT.block_stats["ignored_lines"] = RESULT.block_stats["total_lines"] - RESULT.block_stats["hashable_lines"]
+    @property
+    def time_tag_index(self) -> Optional[TimeTagIndex]:
+        """
+        时间标签索引（见 TimeTagIndex），按需构建；文件不规范时为 None。
+        有序插入（insert_block_sorted）时增量更新，其他修改后失效。
+        """
+        if self._time_tag_index is _UNBUILT:
+            self._time_tag_index = TimeTagIndex.build(self.lines)
+        return self._time_tag_index
 
-    # 我们用另一个数据结构表达 target_file -> {hashable_line, hash, original_content_line_idx}[]
-    target_lines = []
-    target_file_hash_list = []
+    def insert_block_sorted(self, block: ChatBlock) -> bool:
+        """
+        no_match 的快速路径：把 block 渲染后的行直接插入到按时间排序的位置，只 hash 新插入的行。
+        结果与 解析整个文件 -> 追加 block -> 排序 -> 重新渲染 逐字节相同。
+        文件不规范、或 block 与文件不属于同一个 chat、时间标签不完整时返回 False，由调用方走完整路径。
+        """
+        index = self.time_tag_index
+        if index is None or block.chat_name != index.chat_name or not TimeTagIndex.is_canonical_tag(block.time_tag):
+            return False
+        new_lines = ChatOrgFile.block_to_md_lines(block)
+        pos, line_no = index.insert_position(block.time_tag, len(self.lines))
+        self.splice(line_no, line_no, new_lines, HashedLines.from_lines(new_lines))
+        # 插入的内容行中如果出现聊天名称/时间标签行，文件在下次解析时会被切分成不同的块，索引交给下次按需重建
+        classify = LineClassifier().classify
+        try:
+            plain = (classify(new_lines[0], None) == (LineClassifier.TIME, block.time_tag)
+                     and all(classify(line, block.time_tag)[0] == LineClassifier.CONTENT for line in new_lines[1:]))
+        except ValueError:
+            plain = False
+        if plain:
+            index.insert(pos, block.time_tag, line_no, len(new_lines))
+            self._time_tag_index = index
+        return True
+
+    @classmethod
+    def load(cls, file_path: str) -> 'MergeTarget':
+        """
+        读取目标文件并获取 hash 列表。文件不存在时返回空缓冲。
+        hash 列表优先从 sidecar 缓存（LineHashIndex）中恢复；缓存缺失或失效时重新计算并重建缓存。
+        """
+        target = cls(file_path)
+        if os.path.exists(file_path):
+            target.exists = True
+            with open(file_path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                data = f.read()
+            # 与 open(file_path, 'r', encoding='utf-8').readlines() 相同的解码与断行规则
+            target.lines = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8').readlines()
+
+            index_path = KnowledgeBasePaths.get_org_hash_index_path(file_path)
+            index = LineHashIndex.read(index_path)
+            hashed = index.hashed_for(target.lines) if index and index.matches(data, st) else None
+            if hashed is None:
+                hashed = HashedLines.from_lines(target.lines)
+                LineHashIndex.build(data, hashed, st).write(index_path)
+            target.hashed = hashed
+        return target
+
+    def splice(self, start: int, end: int, new_lines: List[str], new_hashed: HashedLines) -> int:
+        """
+        用 new_lines 替换 lines[start:end]，并增量更新 hash 行：
+        start 之前的 hash 行不变，end 之后的 hash 行整体平移，new_hashed 是 new_lines 的 hash 行（行号相对于 new_lines）。
+        返回替换后、合并未换行的行之前的行数（即直接写出时 writelines 的行数）。
+        """
+        self.hashed.splice(start, end, new_hashed, len(new_lines))
+        self.lines[start:end] = new_lines
+        PROFILER.count("bytes_written", sum(len(line.encode('utf-8')) for line in new_lines))
+        self._anchor_index = None
+        self._time_tag_index = _UNBUILT
+        written_line_count = len(self.lines)
+        self._join_unterminated_line(start + len(new_lines) - 1)
+        self._join_unterminated_line(start - 1)
+        self.exists = True
+        self.dirty = True
+        return written_line_count
+
+    def replace(self, new_lines: List[str]):
+        """
+        用 new_lines 整体替换缓冲，并重新计算 hash 列表。
+        """
+        self.lines = list(new_lines)
+        self.hashed = HashedLines.from_lines(self.lines)
+        PROFILER.count("bytes_written", sum(len(line.encode('utf-8')) for line in self.lines))
+        self._anchor_index = None
+        self._time_tag_index = _UNBUILT
+        self.exists = True
+        self.dirty = True
+
+    def _join_unterminated_line(self, idx: int):
+        """
+        如果 idx 行没有换行符且后面还有行，写出后两行会连成一行（例如原始文件末行没有换行）。
+        这里提前在缓冲中把它们合并，保证缓冲与写出再读回的文件内容逐行一致。
+        """
+        if idx < 0 or idx + 1 >= len(self.lines) or self.lines[idx].endswith("\n"):
+            return
+        joined = self.lines[idx] + self.lines[idx + 1]
+        self.hashed.splice(idx, idx + 2, HashedLines.from_lines([joined]), 1)
+        self.lines[idx:idx + 2] = [joined]
+        self._anchor_index = None
+        self._time_tag_index = _UNBUILT
+
+    def flush(self):
+        """
+        将缓冲写回目标文件（没有修改时不写），并更新 sidecar hash 缓存与群聊的时间线索引。
+        """
+        if not self.dirty:
+            return
+        with PROFILER.span("write", target=self.file_path):
+            data = "".join(self.lines).encode('utf-8')
+            st = atomic_write_bytes(self.file_path, data)
+            self.dirty = False
+            # 同步更新 sidecar 缓存，下次加载时无需重新 hash
+            LineHashIndex.build(data, self.hashed, st).write(KnowledgeBasePaths.get_org_hash_index_path(self.file_path))
+        PROFILER.count("bytes_flushed", len(data))
+        update_timeline_index(self.file_path, data, st.st_mtime_ns)
+
+
+@contextmanager
+def target_lock(target_filename: str):
+    """
+    对目标文件加排他的 advisory 锁（fcntl.flock，锁文件见 KnowledgeBasePaths.get_org_lock_path），
+    覆盖 读取 -> 合并 -> 写回 的全过程，防止两个并发的 ingest 进程同时改写同一个月度文件。
+    锁文件本身保留在目录中，不删除（删除会让等待中的进程锁住一个已经脱离目录的文件）。
+    """
+    if fcntl is None:
+        yield
+        return
+    lock_path = KnowledgeBasePaths.get_org_lock_path(target_filename)
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
 
-    if not new_block_hash_list:
-        print(f"[WARNING] No hashable lines found in block for {target_filename}. Skipping merge for this block.")
-        return RESULT
 
-    if os.path.exists(target_filename):
-        RESULT.target_stats["exists"] = True
-        with open(target_filename, 'r', encoding='utf-8') as f:
-            target_lines = f.readlines()
-        RESULT.target_stats["initial_total_lines"] = len(target_lines)
-        for idx, line in enumerate(target_lines):
-            hashing = RegexPatterns.extract_hashing_line(line)
-            if hashing:
-                target_file_hash_list.append({
-                    "hash": hash_line(hashing),
-                    "original_content_line_idx": idx,
-                    "content": line
-                })
+def update_timeline_index(target_filename: str, data: bytes, mtime_ns: int):
+    """
+    目标文件写回后，替换群聊时间线索引（TimelineIndex）中该文件的段。
+    索引的 读取 -> 修改 -> 写回 在索引的锁内完成，--jobs 并行写回同一群聊的不同文件时不会互相覆盖。
+    索引不存在或损坏时扫描群聊的全部文件重建。
+    """
+    chat_dir, file_name = os.path.split(target_filename)
+    index_path = KnowledgeBasePaths.get_org_timeline_index_path(chat_dir)
+    with PROFILER.span("index", target=target_filename), target_lock(index_path):
+        index = TimelineIndex.read(index_path)
+        if index is None:
+            index = TimelineIndex.load(chat_dir)
+        else:
+            index.update_file(file_name, data, mtime_ns)
+        index.write(index_path)
+
+
+def rebuild_timeline_index(chat_dir: str) -> TimelineIndex:
+    """
+    重新扫描群聊目录的全部文件，重建并写出时间线索引。
+    """
+    index_path = KnowledgeBasePaths.get_org_timeline_index_path(chat_dir)
+    with target_lock(index_path):
+        index = TimelineIndex()
+        index.sync(chat_dir)
+        index.write(index_path)
+    return index
+
+
+def rebuild_timeline_indexes(knowledge_base_dir: str) -> Tuple[int, int]:
+    """
+    为 01-chats-input-organized 下的每个群聊重新扫描全部文件、重建时间线索引（用于索引出现之前归档的数据）。
+    返回 (群聊数, 时间标签数)。
+    """
+    org_dir = os.path.join(knowledge_base_dir, "01-chats-input-organized")
+    chat_count, tag_count = 0, 0
+    if not os.path.isdir(org_dir):
+        return chat_count, tag_count
+    for name in sorted(os.listdir(org_dir)):
+        chat_dir = os.path.join(org_dir, name)
+        if not os.path.isdir(chat_dir):
+            continue
+        chat_count += 1
+        tag_count += len(rebuild_timeline_index(chat_dir).entries())
+    return chat_count, tag_count
+
+
+def magic_merge(new_block: ChatBlock, target_filename: str) -> MergeResult:
+    """
+    使用 new_block 和 target_filename 定位的目标文件进行合并，返回 MergeResult。
+    加锁后读取目标文件、合并（见 merge_into_target）、写回目标文件。
+    """
+    return merge_target_blocks(target_filename, [new_block])[0]
+
+
+def merge_target_blocks(target_filename: str, blocks: List[ChatBlock]) -> List[MergeResult]:
+    """
+    持有目标文件锁，依次把 blocks 合并到同一个目标文件的内存缓冲中，最后只写回一次。
+    返回与 blocks 一一对应的 MergeResult。作为进程池任务时，参数与返回值都可以直接序列化。
+    """
+    with target_lock(target_filename):
+        with PROFILER.span("load", target=target_filename):
+            target = MergeTarget.load(target_filename)
+        results = []
+        for block in blocks:
+            mark = PROFILER.mark()
+            result = merge_into_target(block, target)
+            result.perf.update(PROFILER.since(mark))
+            PROFILER.count("blocks_merged")
+            results.append(result)
+        target.flush()
+    return results
+
+
+def locate_splice(new_block_hashed: HashedLines, block_line_count: int, target: MergeTarget, RESULT: MergeResult,
+                  opt_search_lines: int = 5) -> Optional[Tuple[int, int, int, int]]:
+    """
+    用新块的 hash 行在 target 的缓冲中寻找起始/结束锚点，把锚点详情与合并策略记录到 RESULT，
+    返回拼接方案 (target_from, target_to, block_from, block_to)：用块的 [block_from:block_to) 行替换目标的 [target_from:target_to)。
+    块已全部存在时策略为 already_exists，没有找到锚点时策略不变；两种情况都返回 None。
+    只读取 target，不修改缓冲。
+    """
+    target_lines = target.lines
+    target_digests, target_line_idx = target.hashed.digests, target.hashed.line_idx
+    new_block_digests, new_block_line_idx = new_block_hashed.digests, new_block_hashed.line_idx
 
     # 3. 用 new_block 的前 N 行（仅 hash 行）去目标文件中匹配
-    begin_match = seq_match(new_block_hash_list[:opt_search_lines], target_file_hash_list, lambda x: x['hash'])
+    # 锚点查找使用目标的 AnchorIndex，结果与 seq_match 相同
+    begin_match = target.anchor_index.find(new_block_digests[:opt_search_lines])
     # 如果 begin_match != -1，说明找到了匹配的起点行，我们记录这个行号（在目标文件中的行号）和内容
     if begin_match != -1:
 
         RESULT.start_anchor.found = True
-        RESULT.start_anchor.match_index_in_new_block = new_block_hash_list[0]['original_content_line_idx']
-        RESULT.start_anchor.line_no_in_target = target_file_hash_list[begin_match]['original_content_line_idx']
-        RESULT.start_anchor.content_preview = target_file_hash_list[begin_match]['content'].strip()
+        RESULT.start_anchor.match_index_in_new_block = new_block_line_idx[0]
+        RESULT.start_anchor.line_no_in_target = target_line_idx[begin_match]
+        RESULT.start_anchor.content_preview = target_lines[target_line_idx[begin_match]].strip()
         
         # 我们用 prefix match 的方式分析，new_block 从 match_start 行开始，能匹配的最长 hash 连续行数
-        common_prefix_hashable_length = seq_longest_common_prefix_length(new_block_hash_list, target_file_hash_list[begin_match:], lambda x: x['hash'])
+        common_prefix_hashable_length = seq_longest_common_prefix_length(new_block_digests, target_digests, start_l=begin_match)
 
         # 如果 prefix 匹配长度等于 new_block 的 hashable 长度，说明该 block 已经全部存在
-        if common_prefix_hashable_length == len(new_block_hash_list):
+        if common_prefix_hashable_length == len(new_block_hashed):
             RESULT.action_taken["strategy"] = "already_exists"
-            return RESULT
+            return None
         
         # 转换回物理行数，记录在结果中
         if common_prefix_hashable_length > 0:
-            last_matching_idx_in_target = target_file_hash_list[begin_match + common_prefix_hashable_length - 1]['original_content_line_idx']  # 需要找到 target_file_hash_list 中第 common_prefix_hashable_length 个匹配行的原始行号
+            last_matching_idx_in_target = target_line_idx[begin_match + common_prefix_hashable_length - 1]  # 需要找到目标 hash 行中第 common_prefix_hashable_length 个匹配行的原始行号
             RESULT.start_anchor.matching_max_line_count_in_target = last_matching_idx_in_target - RESULT.start_anchor.line_no_in_target + 1
             
-            last_matching_idx_in_new_block = new_block_hash_list[0 + common_prefix_hashable_length - 1]['original_content_line_idx']  # 需要找到 new_block_hash_list 中第 common_prefix_hashable_length 个匹配行的原始行号
+            last_matching_idx_in_new_block = new_block_line_idx[0 + common_prefix_hashable_length - 1]  # 需要找到 new_block hash 行中第 common_prefix_hashable_length 个匹配行的原始行号
             RESULT.start_anchor.matching_max_line_count_in_new_block = last_matching_idx_in_new_block - RESULT.start_anchor.match_index_in_new_block + 1
             
     # 4. 用 new_block 的后 N 行（仅 hash 行）去目标文件中匹配
-    end_match = seq_match(new_block_hash_list[-opt_search_lines:], target_file_hash_list, lambda x: x['hash'])
+    end_match = target.anchor_index.find(new_block_digests[-opt_search_lines:])
 
     # 如果 end_match != -1，说明找到了匹配的结尾行，我们记录这个行号（在目标文件中的行号）和内容
     if end_match != -1:
@@ -298,84 +735,329 @@ def magic_merge(new_block: ChatBlock, target_filename: str) -> MergeResult:
         last_match_idx_in_target = end_match + last_match_idx_in_window
         
         # 我们用 suffix match 的方式分析，new_block 从 match_end 行开始往前，能匹配的最长 hash 连续行数
-        common_suffix_hashable_length = seq_longest_common_suffix_length(new_block_hash_list, target_file_hash_list[:end_match + opt_search_lines], lambda x: x['hash'])
+        common_suffix_hashable_length = seq_longest_common_suffix_length(new_block_digests, target_digests, end_l=end_match + opt_search_lines)
         
         # 转换回物理行数，记录在结果中
         if common_suffix_hashable_length > 0:
-            first_matching_idx_in_target = target_file_hash_list[end_match + last_match_idx_in_window - common_suffix_hashable_length + 1]['original_content_line_idx']  # 需要找到 target_file_hash_list 中第 common_suffix_hashable_length 个匹配行的原始行号
+            first_matching_idx_in_target = target_line_idx[end_match + last_match_idx_in_window - common_suffix_hashable_length + 1]  # 需要找到目标 hash 行中第 common_suffix_hashable_length 个匹配行的原始行号
             RESULT.end_anchor.matching_max_line_count_in_target = last_match_idx_in_target - first_matching_idx_in_target + 1
             
-            first_matching_idx_in_new_block = new_block_hash_list[-opt_search_lines + last_match_idx_in_window - common_suffix_hashable_length + 1]['original_content_line_idx']  # 需要找到 new_block_hash_list 中第 common_suffix_hashable_length 个匹配行的原始行号
-            RESULT.end_anchor.matching_max_line_count_in_new_block = new_block_hash_list[-1]['original_content_line_idx'] - first_matching_idx_in_new_block + 1
+            first_matching_idx_in_new_block = new_block_line_idx[-opt_search_lines + last_match_idx_in_window - common_suffix_hashable_length + 1]  # 需要找到 new_block hash 行中第 common_suffix_hashable_length 个匹配行的原始行号
+            RESULT.end_anchor.matching_max_line_count_in_new_block = new_block_line_idx[-1] - first_matching_idx_in_new_block + 1
 
-        RESULT.end_anchor.match_index_in_new_block = new_block_hash_list[-1]['original_content_line_idx']
-        RESULT.end_anchor.line_no_in_target = target_file_hash_list[last_match_idx_in_target]['original_content_line_idx']
-        RESULT.end_anchor.content_preview = target_file_hash_list[last_match_idx_in_target]['content'].strip()
+        RESULT.end_anchor.match_index_in_new_block = new_block_line_idx[-1]
+        RESULT.end_anchor.line_no_in_target = target_line_idx[last_match_idx_in_target]
+        RESULT.end_anchor.content_preview = target_lines[target_line_idx[last_match_idx_in_target]].strip()
 
-    # 5. 根据匹配结果进行合并
-    final_lines = []
+    # 5. 根据匹配结果进行合并：三种拼接策略都表达为 用 new_block.content[block_from:block_to] 替换目标的 [target_from:target_to)
+    splice = None  # (target_from, target_to, block_from, block_to)
 
     if RESULT.start_anchor.found and RESULT.end_anchor.found and RESULT.start_anchor.line_no_in_target <= RESULT.end_anchor.line_no_in_target:
         # 如果两边都存在匹配，且 match_start 行号 < match_end 行号，则认为 new_block 在目标文件中间找到匹配，可以进行拼接合并
         RESULT.action_taken["strategy"] = "both_match"
-        
+
         # 写出顺序：
         # 1. 目标文件中 match_start 行（映射回原始行号）之前的内容
-        final_lines.extend(target_lines[:RESULT.start_anchor.line_no_in_target])
         # 2. new_block 中 match_start 行（映射回原始行号）到 match_end 行（映射回原始行号）的内容
-        final_lines.extend(new_block.content[RESULT.start_anchor.match_index_in_new_block:RESULT.end_anchor.match_index_in_new_block + 1])
         # 3. 目标文件中 match_end 行（映射回原始行号）之后的内容
-        final_lines.extend(target_lines[RESULT.end_anchor.line_no_in_target + 1:])
-        
+        splice = (RESULT.start_anchor.line_no_in_target, RESULT.end_anchor.line_no_in_target + 1,
+                  RESULT.start_anchor.match_index_in_new_block, RESULT.end_anchor.match_index_in_new_block + 1)
+
     elif RESULT.start_anchor.found:
         # 如果只有 match_start 存在，认为 new_block 的前半部分在目标文件中找到匹配，可以进行拼接合并
-
         RESULT.action_taken["strategy"] = "begin_match"
-  
+
         # 写出顺序：
         # 1. 目标文件中直到最末匹配行的内容（以保留目标文件中匹配部分的后续内容，避免丢失） -- line_no_in_target 和 matching_max_line_count_in_target
-        final_lines.extend(target_lines[:RESULT.start_anchor.line_no_in_target + RESULT.start_anchor.matching_max_line_count_in_target])
         # 2. new_block 中最末匹配行（映射回原始行号）到结尾的内容
-        final_lines.extend(new_block.content[RESULT.start_anchor.match_index_in_new_block + RESULT.start_anchor.matching_max_line_count_in_new_block:])
         # 3. 目标文件中最末匹配行之后的内容
-        final_lines.extend(target_lines[RESULT.start_anchor.line_no_in_target + RESULT.start_anchor.matching_max_line_count_in_target:])
-        
+        insert_at = RESULT.start_anchor.line_no_in_target + RESULT.start_anchor.matching_max_line_count_in_target
+        splice = (insert_at, insert_at,
+                  RESULT.start_anchor.match_index_in_new_block + RESULT.start_anchor.matching_max_line_count_in_new_block, block_line_count)
+
     elif RESULT.end_anchor.found:
         # 如果只有 match_end 存在，认为 new_block 的后半部分在目标文件中找到匹配，可以进行拼接合并
         RESULT.action_taken["strategy"] = "end_match"
-        
+
         # 写出顺序：
         # 1. 目标文件直到最早匹配行的内容（以保留目标文件中匹配部分的前续内容，避免丢失） -- line_no_in_target 和 matching_max_line_count_in_target
-        final_lines.extend(target_lines[:RESULT.end_anchor.line_no_in_target - RESULT.end_anchor.matching_max_line_count_in_target + 1])
         # 2. new_block 中 从开始到最早匹配行（映射回原始行号）的内容
-        final_lines.extend(new_block.content[:RESULT.end_anchor.match_index_in_new_block - RESULT.end_anchor.matching_max_line_count_in_new_block + 1])
         # 3. 目标文件中最早匹配行之后的内容
-        final_lines.extend(target_lines[RESULT.end_anchor.line_no_in_target - RESULT.end_anchor.matching_max_line_count_in_target + 1:])
-        
-    else:
-        # 如果都没找到，认为 new_block 没有在目标文件中找到匹配，直接按时间顺序插入到目标文件中合适的位置。
+        insert_at = RESULT.end_anchor.line_no_in_target - RESULT.end_anchor.matching_max_line_count_in_target + 1
+        splice = (insert_at, insert_at,
+                  0, RESULT.end_anchor.match_index_in_new_block - RESULT.end_anchor.matching_max_line_count_in_new_block + 1)
 
-        RESULT.action_taken["strategy"] = "no_match"
-        if RESULT.target_stats["exists"]:
-            # 注意：此处 target_org 解析通常不需要 fallback_year，因为整理后的文件应该已有年份
-            target_org = FileParser.parse_org_file(target_filename)
-        else:
-            target_org = ChatOrgFile(target_filename)
-        target_org.chat_blocks.append(new_block)
-        final_lines = target_org.convert_to_md_lines()
+    return splice
+
+
+def apply_splice(target: MergeTarget, splice: Tuple[int, int, int, int], content: Sequence[str], hashed: HashedLines) -> int:
+    """
+    执行 locate_splice 给出的拼接方案：用 content[block_from:block_to] 替换 target 的 [target_from:target_to)。
+    返回 MergeTarget.splice 的结果（直接写出时的行数）。
+    """
+    target_from, target_to, block_from, block_to = splice
+    # 与列表切片语义保持一致（负数或越界的下标按切片规则归一化）
+    target_from, target_to, _ = slice(target_from, target_to).indices(len(target.lines))
+    target_to = max(target_from, target_to)
+    block_from, block_to, _ = slice(block_from, block_to).indices(len(content))
+    block_to = max(block_from, block_to)
+    return target.splice(target_from, target_to, content[block_from:block_to], hashed.lines_between(block_from, block_to))
+
+
+def merge_into_target(new_block: ChatBlock, target: MergeTarget) -> MergeResult:
+    """
+    将 new_block 合并到目标文件的内存缓冲 target 中，返回 MergeResult。缓冲由调用方负责 flush。
+
+    这个方法会
+    1. 处理 new_block 的每一行，留下 hash 部分和非 hash 部分(保留和 new_block 的映射关系)
+    2. 处理目标文件的每一行，留下 hash 部分和非 hash 部分(保留和目标文件原始行的映射关系)
+    3. 用 new_block 的前 N 行（仅 hash 行）去目标文件中匹配，找到最后一个完全匹配的行（match_start）
+    4. 用 new_block 的后 N 行（仅 hash 行）去目标文件中匹配，找到第一个完全匹配的行（match_end）
+
+    如果 match_start 和 match_end 都存在，且 match_start 行号 < match_end 行号，则认为 new_block 在目标文件中间找到匹配，可以进行拼接合并
+
+        写出顺序：
+        1. 目标文件中 match_start 行（映射回原始行号）之前的内容
+        2. new_block 中 match_start 行（映射回原始行号）到 match_end 行（映射回原始行号）的内容
+        3. 目标文件中 match_end 行（映射回原始行号）之后的内容
+
+    如果只有 match_start 存在，认为 new_block 的前半部分在目标文件中找到匹配，可以进行拼接合并
+
+        写出顺序：
+        1. 目标文件中 match_start 行（映射回原始行号）之前的内容
+        2. new_block 中 match_start 行（映射回原始行号）到结尾的内容
 
-    # 6. 持久化写入并记录最终状态
-    os.makedirs(os.path.dirname(target_filename), exist_ok=True)
-    with open(target_filename, 'w', encoding='utf-8') as f:
-        f.writelines(final_lines)
+    如果只有 match_end 存在，认为 new_block 的后半部分在目标文件中找到匹配，可以进行拼接合并
 
-    RESULT.action_taken["final_total_lines"] = len(final_lines)
+        写出顺序：
+        1. 目标文件的 yaml header 部分（如果有的话）
+        1. new_block 中 从开始到 match_end 行（映射回原始行号）的内容
+        2. 目标文件中 match_end 行（映射回原始行号）之后的内容
+
+    如果都没找到，认为 new_block 没有在目标文件中找到匹配，直接按时间顺序插入到目标文件中合适的位置。
+
+        构建一个 ChatOrgFile,
+        然后添加 new_block，
+        按照时间顺序排序，
+        写出覆盖目标文件即可。
+
+    """
+    # 1. 初始化结果对象与参数
+    target_filename = target.file_path
+    RESULT = MergeResult(target_filename, new_block.chat_name, new_block.time_tag)
+    opt_search_lines = 5  # 可配置：匹配时考虑的行数范围
+
+    # 2. 我们需要用一个数据结构表达 chat_block -> hash 行（HashedLines：指纹 + 原始行号）
+    RESULT.block_stats["total_lines"] = len(new_block.content)
+    new_block_hashed = HashedLines.from_lines(new_block.content)
+    RESULT.block_stats["hashable_lines"] = len(new_block_hashed)
+    RESULT.block_stats["ignored_lines"] = RESULT.block_stats["total_lines"] - RESULT.block_stats["hashable_lines"]
+
+    if not new_block_hashed:
+        print(f"[WARNING] No hashable lines found in block for {target_filename}. Skipping merge for this block.")
+        return RESULT
+
+    # 目标文件 -> hash 行，已在缓冲中准备好
+    target_lines = target.lines
+    if target.exists:
+        RESULT.target_stats["exists"] = True
+        RESULT.target_stats["initial_total_lines"] = len(target_lines)
+
+    with PROFILER.span("match"):
+        splice = locate_splice(new_block_hashed, len(new_block.content), target, RESULT, opt_search_lines)
+    if RESULT.action_taken["strategy"] == "already_exists":
+        return RESULT
+
+    with PROFILER.span("splice"):
+        if splice is not None:
+            final_total_lines = apply_splice(target, splice, new_block.content, new_block_hashed)
+        else:
+            # 如果都没找到，认为 new_block 没有在目标文件中找到匹配，直接按时间顺序插入到目标文件中合适的位置。
+            RESULT.action_taken["strategy"] = "no_match"
+            # 快速路径：规范的目标文件通过时间标签索引直接定位插入点（见 MergeTarget.insert_block_sorted）
+            if not (RESULT.target_stats["exists"] and target.insert_block_sorted(new_block)):
+                if RESULT.target_stats["exists"]:
+                    # 注意：此处 target_org 解析通常不需要 fallback_year，因为整理后的文件应该已有年份
+                    target_org = FileParser.parse_org_lines(target_lines, target_filename)
+                else:
+                    target_org = ChatOrgFile(target_filename)
+                target_org.chat_blocks.append(new_block)
+                target.replace(target_org.convert_to_md_lines())
+            final_total_lines = len(target.lines)
+
+    # 6. 记录最终状态（由调用方负责写回）
+    RESULT.action_taken["final_total_lines"] = final_total_lines
     RESULT.action_taken["added_lines"] = RESULT.action_taken["final_total_lines"] - RESULT.target_stats["initial_total_lines"]
     RESULT.action_taken["status"] = "success"
 
     return RESULT
 
 
+def collapse_overlapping_blocks(target_filename: str, blocks: List[ChatBlock]) -> Tuple[List[ChatBlock], List[int], List[Optional[MergeResult]]]:
+    """
+    批内重叠折叠：同一批次中，同一群聊同一天的块（例如不同设备、不同日期导出的重叠片段）先在内存中互相合并，
+    每个重叠区域只留下一个合并后的块，再与磁盘上的目标文件合并。减少磁盘合并次数，也避免同一区域被反复拼接。
+
+    blocks 为同一目标文件的块（已按时间排序）。依次处理每个块：
+    用与磁盘合并相同的锚点逻辑（locate_splice）在同一天已有的区域缓冲中寻找重叠，
+    找到重叠（或已全部存在）时在缓冲中拼接，否则以该块开启一个新的区域。
+    时间标签不完整、或没有 hash 行的块不参与折叠。
+
+    返回 (merge_blocks, owners, collapse_results)：
+    - merge_blocks: 折叠后需要合并到目标文件的块，顺序与各区域第一个块的顺序一致
+    - owners: owners[i] 为 blocks[i] 所在区域在 merge_blocks 中的下标
+    - collapse_results: blocks[i] 被折叠进前面的块时为其 MergeResult（strategy 为 collapsed，锚点相对于区域缓冲），否则为 None
+    """
+    regions: List[Tuple[ChatBlock, Optional[MergeTarget]]] = []
+    day_regions: Dict[Tuple[str, str], List[int]] = {}
+    owners: List[int] = []
+    collapse_results: List[Optional[MergeResult]] = []
+
+    for block in blocks:
+        mark = PROFILER.mark()
+        # 区域缓冲中每行都以换行结尾：来源文件末行没有换行时，避免与后拼接进来的行连成一行（渲染到目标文件时同样会补上换行）
+        content = [line if line.endswith("\n") else line + "\n" for line in block.content]
+        hashed = HashedLines.from_lines(content) if TimeTagIndex.is_canonical_tag(block.time_tag) else None
+        if not hashed:
+            owners.append(len(regions))
+            collapse_results.append(None)
+            regions.append((block, None))
+            continue
+
+        day_key = (block.chat_name, block.time_tag[:10])
+        for region_no in day_regions.get(day_key, []):
+            buffer = regions[region_no][1]
+            RESULT = MergeResult(target_filename, block.chat_name, block.time_tag)
+            RESULT.block_stats["total_lines"] = len(content)
+            RESULT.block_stats["hashable_lines"] = len(hashed)
+            RESULT.block_stats["ignored_lines"] = len(content) - len(hashed)
+            RESULT.target_stats["exists"] = True
+            RESULT.target_stats["initial_total_lines"] = len(buffer.lines)
+            splice = locate_splice(hashed, len(content), buffer, RESULT)
+            if splice is None and RESULT.action_taken["strategy"] != "already_exists":
+                continue
+            # 记录区域缓冲中的合并方式，策略统一记为 collapsed
+            RESULT.action_taken["collapse_strategy"] = RESULT.action_taken["strategy"]
+            RESULT.action_taken["strategy"] = "collapsed"
+            RESULT.action_taken["final_total_lines"] = apply_splice(buffer, splice, content, hashed) if splice else len(buffer.lines)
+            RESULT.action_taken["added_lines"] = RESULT.action_taken["final_total_lines"] - RESULT.target_stats["initial_total_lines"]
+            RESULT.action_taken["status"] = "success"
+            RESULT.perf.update(PROFILER.since(mark))
+            owners.append(region_no)
+            collapse_results.append(RESULT)
+            break
+        else:
+            buffer = MergeTarget(target_filename)
+            buffer.lines = content
+            buffer.hashed = hashed
+            buffer.exists = True
+            day_regions.setdefault(day_key, []).append(len(regions))
+            owners.append(len(regions))
+            collapse_results.append(None)
+            regions.append((block, buffer))
+
+    merge_blocks = []
+    for block, buffer in regions:
+        if buffer is not None and buffer.dirty:
+            # 区域吸收过其他块：以第一个块的群聊、时间标签生成合并后的块
+            block = ChatBlock(block.chat_name, block.time_tag, buffer.lines, block.associated_file_path, block.sort_key)
+        merge_blocks.append(block)
+    return merge_blocks, owners, collapse_results
+
+
+def merge_target_partition(target_filename: str, blocks: List[ChatBlock], collapse: bool = True) -> List[MergeResult]:
+    """
+    合并同一目标文件的一组块，返回与 blocks 一一对应的 MergeResult。
+    collapse 为 True 时先做批内重叠折叠（见 collapse_overlapping_blocks），只把折叠后的块合并到目标文件：
+    每个区域第一个块的 MergeResult 为区域整体的合并结果（action_taken 中 collapsed_blocks 为折叠进来的块数），
+    被折叠的块的 MergeResult 为其在区域缓冲中的合并记录。作为进程池任务时，参数与返回值都可以直接序列化。
+    """
+    if not collapse:
+        return merge_target_blocks(target_filename, blocks)
+    with PROFILER.span("collapse", target=target_filename):
+        merge_blocks, owners, collapse_results = collapse_overlapping_blocks(target_filename, blocks)
+    merge_results = merge_target_blocks(target_filename, merge_blocks)
+    for owner, collapse_result in zip(owners, collapse_results):
+        if collapse_result is not None:
+            merge_results[owner].action_taken["collapsed_blocks"] = merge_results[owner].action_taken.get("collapsed_blocks", 0) + 1
+    return [collapse_result or merge_results[owner] for owner, collapse_result in zip(owners, collapse_results)]
+
+
+def merge_target_partition_task(target_filename: str, blocks: List[ChatBlock], collapse: bool, trace: bool) -> Tuple[List[MergeResult], dict]:
+    """
+    进程池任务：在子进程中执行 merge_target_partition，同时带回子进程的阶段统计（StageProfiler.snapshot）。
+    """
+    PROFILER.reset(trace)
+    results = merge_target_partition(target_filename, blocks, collapse)
+    return results, PROFILER.snapshot()
+
+
+class MergeScheduler:
+    """
+    按目标文件（KnowledgeBasePaths.get_org_file_path）对待合并的块分组，
+    每个目标文件只加载、hash 一次，按时间顺序把该目标的所有块合并到内存缓冲后，只写回一次。
+    每个块仍然产出一条独立的 MergeResult 审计记录。
+    不同目标文件之间互不依赖，jobs > 1 时按目标文件分区，交给进程池并行合并。
+    collapse 为 True 时，同一目标内重叠的块先在内存中折叠（见 collapse_overlapping_blocks）。
+    """
+
+    def __init__(self, knowledge_base_dir: str, collapse: bool = True):
+        self.knowledge_base_dir = knowledge_base_dir
+        self.collapse = collapse
+        self.groups: Dict[str, List[Tuple[Any, ChatBlock]]] = {}
+
+    def add(self, key: Any, block: ChatBlock):
+        """
+        登记一个待合并的块。key 由调用方定义（例如 (rel_path, idx)），随结果原样返回。
+        """
+        target_filename = KnowledgeBasePaths.get_org_file_path(self.knowledge_base_dir, chat_name=block.chat_name, dt=block.time_tag)
+        self.groups.setdefault(target_filename, []).append((key, block))
+
+    def run(self, jobs: int = 1, checkpoint: Optional['IngestCheckpoint'] = None) -> Iterator[Tuple[Any, ChatBlock, MergeResult]]:
+        """
+        逐个目标文件执行合并，产出 (key, block, MergeResult)。
+        同一目标内按 time_tag 稳定排序，时间相同的块保持登记顺序。
+        无论是否并行，产出顺序都与登记目标文件的顺序一致。
+        给出 checkpoint 时，每个目标文件合并前写入 begin 记录，写回完成后写入 commit 记录（均由当前进程写入）。
+        """
+        partitions = []
+        for target_filename, entries in self.groups.items():
+            order_key = ChatBlock.order_key(block for _, block in entries)
+            partitions.append((target_filename, sorted(entries, key=lambda e: order_key(e[1]))))
+        target_filenames = [target_filename for target_filename, _ in partitions]
+        block_lists = [[block for _, block in entries] for _, entries in partitions]
+
+        def partition_results(results_iter):
+            for (target_filename, entries), results in zip(partitions, results_iter):
+                if checkpoint:
+                    checkpoint.commit(target_filename, [key for key, _ in entries])
+                for (key, block), result in zip(entries, results):
+                    yield key, block, result
+
+        def begin(target_filename: str, entries: List[Tuple[Any, ChatBlock]]) -> str:
+            if checkpoint:
+                checkpoint.begin(target_filename, [key for key, _ in entries])
+            return target_filename
+
+        if jobs <= 1 or len(partitions) <= 1:
+            # 串行：逐个目标 begin -> 合并 -> commit
+            yield from partition_results(merge_target_partition(begin(target_filename, entries), blocks, self.collapse)
+                                         for (target_filename, entries), blocks in zip(partitions, block_lists))
+            return
+
+        for target_filename, entries in partitions:
+            begin(target_filename, entries)
+        def absorbed(task_results):
+            # 汇总子进程的阶段统计，只把 MergeResult 交给后续处理
+            for results, snapshot in task_results:
+                PROFILER.absorb(snapshot)
+                yield results
+
+        with ProcessPoolExecutor(max_workers=min(jobs, len(partitions))) as executor:
+            yield from partition_results(absorbed(executor.map(merge_target_partition_task, target_filenames, block_lists,
+                                                               [self.collapse] * len(partitions), [PROFILER.trace] * len(partitions))))
+
+
 # ==========================================
 # 主流程 (Main Controller)
 # ==========================================
@@ -387,34 +1069,54 @@ def parse_args():
     --output_dir: 归档输出目录
     --tasks_dir: 任务状态目录
     --fallback_year: 缺少年份时的兜底年份
+    --streaming: 逐文件流式处理（解析一块、合并一块，文件处理完立即归档），内存占用以单个块为上限
+    --jobs: 批量模式下并行解析原始文件、并行合并不同目标文件的进程数，0 表示使用全部 CPU 核心
+    --debug-dumps: 调试输出方式，off 不输出；journal 写入单个 journal.jsonl（默认）；yaml 每个块写出独立的 YAML 文件
+    --journal-zstd: journal 使用 zstd 压缩（journal.jsonl.zst，需要 zstandard 包）
+    --force: 忽略 ingest 清单，已经消费过的文件和块也重新解析、合并
+    --resume: 从上次中断的运行继续，跳过检查点日志中已提交的块
+    --no-collapse: 批量模式下不做批内重叠折叠，每个块分别与目标文件合并
+    --profile: 额外在运行目录写出 cProfile 统计 (profile.pstats) 与 Chrome trace (trace.json)
+    --rebuild-index: 重新扫描全部群聊、重建时间线索引后退出（不需要 --input_dir / --output_dir）
     """
     parser = argparse.ArgumentParser(description="高可靠性聊天记录归档脚本")
-    parser.add_argument("--input_dir", required=True, type=str, help="原始文件目录")
-    parser.add_argument("--output_dir", required=True, type=str, help="归档输出目录")
+    parser.add_argument("--input_dir", type=str, help="原始文件目录")
+    parser.add_argument("--output_dir", type=str, help="归档输出目录")
     parser.add_argument("--knowledge_base_dir", required=True, type=str, help="知识库目录")
     parser.add_argument("--fallback_year", type=int, help="缺少年份时的兜底年份 (例如 2026)")
-    return parser.parse_args()
-
-
-def main():
-
-    # 1. 初始化
-    args = parse_args()
-
-    # 2. 任务信息目录准备
-    norm_task_run_dir = KnowledgeBasePaths.get_task_run_dir('normalize', args.knowledge_base_dir)
-    os.makedirs(norm_task_run_dir,  exist_ok=True)
-
-    # 3. 校验并获取相对路径
+    parser.add_argument("--streaming", action="store_true", help="逐文件流式解析、合并并归档，适合一次导入大量数据")
+    parser.add_argument("--jobs", type=int, default=1, help="并行解析/合并的进程数 (默认 1，0 表示全部 CPU 核心)")
+    parser.add_argument("--debug-dumps", choices=["off", "journal", "yaml"], default="journal", help="调试输出方式 (默认 journal)")
+    parser.add_argument("--journal-zstd", action="store_true", help="journal 使用 zstd 压缩")
+    parser.add_argument("--force", action="store_true", help="忽略 ingest 清单，重新处理已经消费过的文件和块")
+    parser.add_argument("--resume", action="store_true", help="从上次中断的运行继续，跳过已提交的块")
+    parser.add_argument("--no-collapse", action="store_true", help="不做批内重叠折叠，每个块分别与目标文件合并")
+    parser.add_argument("--profile", action="store_true", help="在运行目录写出 profile.pstats 与 trace.json")
+    parser.add_argument("--rebuild-index", action="store_true", help="重建全部群聊的时间线索引后退出")
+    args = parser.parse_args()
+    if not args.rebuild_index and not (args.input_dir and args.output_dir):
+        parser.error("--input_dir 与 --output_dir 为必填参数")
+    if args.jobs < 0:
+        parser.error("--jobs 不能为负数")
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+    return args
+
+
+def collect_file_tasks(input_dir: str, knowledge_base_dir: str) -> List[Tuple[str, str]]:
+    """
+    校验输入目录并收集待处理的原始文件，返回 [(full_path, rel_path), ...]。
+    rel_path 是相对于 00-chats-input-raw 根目录的路径，以保留归档时的子目录结构。
+    """
     # 确保输入目录在 00-chats-input-raw 目录下，以保留归档时的子目录结构
-    raw_input_root = os.path.abspath(os.path.join(args.knowledge_base_dir, "00-chats-input-raw"))
-    abs_input_dir = os.path.abspath(args.input_dir)
+    raw_input_root = os.path.abspath(os.path.join(knowledge_base_dir, "00-chats-input-raw"))
+    abs_input_dir = os.path.abspath(input_dir)
 
     if os.path.commonpath([abs_input_dir, raw_input_root]) != raw_input_root:
-        raise ValueError(f"输入目录 {args.input_dir} (解析为 {abs_input_dir}) 必须位于知识库的 00 根目录 {raw_input_root} 之下")
+        raise ValueError(f"输入目录 {input_dir} (解析为 {abs_input_dir}) 必须位于知识库的 00 根目录 {raw_input_root} 之下")
 
     file_tasks = []  # (full_path, rel_path)
-    for root, dirs, files in os.walk(args.input_dir):
+    for root, dirs, files in os.walk(input_dir):
         # 排除 10-chats-input-raw-used, processed 目录 (防御性)
         dirs[:] = [d for d in dirs if d not in ['processed', '10-chats-input-raw-used']]
         for file in files:
@@ -423,54 +1125,403 @@ def main():
                 # 计算相对于 00 根目录的路径，以确保归档到 10 时复刻完整的目录结构
                 rel_path = os.path.relpath(os.path.abspath(full_path), raw_input_root)
                 file_tasks.append((full_path, rel_path))
+    return file_tasks
 
-    if not file_tasks:
-        print(f"No .md files found in {args.input_dir}")
-        return
 
-    # 4. 解析原始文件，获取所有 (ChatRawFile, rel_path)
-    raw_files_with_rel: List[Tuple[ChatRawFile, str]] = []
+def safe_rel_name(rel_path: str) -> str:
+    """
+    使用相对路径生成 dump 文件名前缀，避免重名冲突。
+    """
+    return rel_path.replace(os.sep, '_').replace('.', '_')
+
+
+def merge_audit_dict(block: ChatBlock, merge_result: MergeResult) -> dict:
+    """
+    合并审计记录的内容：块的元信息（不含完整 content）+ MergeResult。
+    """
+    return {
+        "block_info": block.to_dict(with_content=False),
+        "merge_result": merge_result.to_dict()
+    }
+
+
+def dump_raw_block(task_run_dir: str, rel_path: str, idx: int, block: ChatBlock):
+    """
+    debug: 将原始块写出到 {safe_rel_name}_{idx}_raw_chunk.yaml
+    """
+    dump_filename = f"{safe_rel_name(rel_path)}_{idx}_raw_chunk"
+    dump_path = KnowledgeBasePaths.get_task_orig_chunk_path(task_run_dir, dump_filename)
+    with open(dump_path, 'w', encoding='utf-8') as f:
+        f.write(block.dump_yaml())
+
+
+def dump_merge_result(task_run_dir: str, rel_path: str, idx: int, block: ChatBlock, merge_result: MergeResult):
+    """
+    写出合并日志 {safe_rel_name}_{idx}_merge_chunk.yaml
+    """
+    dump_filename = f"{safe_rel_name(rel_path)}_{idx}_merge_chunk"
+    dump_path = KnowledgeBasePaths.get_task_merged_chunk_path(task_run_dir, dump_filename)
+    with open(dump_path, 'w', encoding='utf-8') as f:
+        # 合并 merge_result 和 block 的信息，生成 dump 内容
+        yaml.dump(merge_audit_dict(block, merge_result), f, allow_unicode=True)
+
+
+class DebugDumper:
+    """
+    按 --debug-dumps 选择调试输出方式：
+    - off: 不输出
+    - journal: 原始块和合并结果各一条记录，追加到运行目录下的单个 journal 文件（见 RunJournal），
+      需要时用 SCRIPT_view_journal.py 渲染为 YAML
+    - yaml: 每个块写出 chunks/*_raw_chunk.yaml 与 chunks_merged/*_merge_chunk.yaml（旧行为）
+    """
+
+    def __init__(self, mode: str, task_run_dir: str, compressed: bool = False):
+        self.mode = mode
+        self.task_run_dir = task_run_dir
+        self.journal = RunJournal(KnowledgeBasePaths.get_task_journal_path(task_run_dir, compressed)) if mode == "journal" else None
+
+    def raw_block(self, rel_path: str, idx: int, block: ChatBlock):
+        with PROFILER.span("dump"):
+            if self.mode == "yaml":
+                dump_raw_block(self.task_run_dir, rel_path, idx, block)
+            elif self.journal:
+                self.journal.append({"type": "raw_block", "rel_path": rel_path, "idx": idx, "block": block.to_dict()})
+
+    def merge_result(self, rel_path: str, idx: int, block: ChatBlock, merge_result: MergeResult):
+        with PROFILER.span("dump"):
+            if self.mode == "yaml":
+                dump_merge_result(self.task_run_dir, rel_path, idx, block, merge_result)
+            elif self.journal:
+                self.journal.append(dict({"type": "merge_result", "rel_path": rel_path, "idx": idx}, **merge_audit_dict(block, merge_result)))
+
+    def close(self):
+        if self.journal:
+            self.journal.close()
+
+
+def parse_raw_file_compact(full_path: str, fallback_year: Optional[int]) -> List[Tuple[str, str, Sequence[str], Optional[int]]]:
+    """
+    子进程任务：解析单个原始文件，返回 [(chat_name, time_tag, content, sort_key), ...]。
+    associated_file_path 对同一文件的所有块都相同，不随结果回传，以减少进程间序列化的数据量；
+    content 为 LineBuffer 时按 bytes + 行偏移序列化，sort_key 随结果回传，父进程无需再次解析时间标签。
+    """
+    return [(block.chat_name, block.time_tag, block.content, block.sort_key)
+            for block in FileParser.iter_raw_blocks(full_path, fallback_year=fallback_year)]
+
+
+def parse_raw_files(file_tasks: List[Tuple[str, str]], fallback_year: Optional[int], jobs: int) -> List[ChatRawFile]:
+    """
+    解析全部原始文件，结果顺序与 file_tasks 一致。
+    jobs > 1 时使用进程池并行解析（解析是纯 CPU 的正则与日期处理），由父进程按原顺序还原 ChatRawFile。
+    """
+    if jobs <= 1 or len(file_tasks) <= 1:
+        return [FileParser.parse_raw_file(full_path, fallback_year=fallback_year) for full_path, _ in file_tasks]
+
+    full_paths = [full_path for full_path, _ in file_tasks]
+    raw_files = []
+    with ProcessPoolExecutor(max_workers=min(jobs, len(file_tasks))) as executor:
+        # executor.map 按提交顺序返回结果，保证后续合并顺序与串行解析一致
+        for full_path, compact_blocks in zip(full_paths, executor.map(parse_raw_file_compact, full_paths, [fallback_year] * len(full_paths))):
+            raw_file = ChatRawFile(full_path)
+            raw_file.chat_blocks = [ChatBlock(chat_name, time_tag, content, full_path, sort_key)
+                                    for chat_name, time_tag, content, sort_key in compact_blocks]
+            raw_files.append(raw_file)
+    return raw_files
+
+
+class IngestManifest:
+    """
+    知识库级的 ingest 清单（见 KnowledgeBasePaths.get_ingest_manifest_path），只追加写入的 JSONL：
+    - {"kind": "file", "digest": 原始文件字节的 SHA-256, "rel_path": ..., "archived_path": ...}
+    - {"kind": "block", "digest": 块内容摘要 (见 block_digest), "rel_path": ..., "idx": ..., "archived_path": ...}
+    archived_path 为相对于知识库根目录的归档位置（10-chats-input-raw-used/...）。
+
+    用户经常重复导出有重叠的时间段，同样的文件、同样的块会再次进入 00 目录。
+    已消费过的文件在解析前跳过（仍然归档），已消费过的块在合并前跳过，本次运行内重复出现的也一样。
+    清单只在原始文件归档之后写入：中途失败时，未归档文件的块不会被误判为已消费。
+    """
+
+    def __init__(self, path: str, enabled: bool = True):
+        self.path = path
+        self.enabled = enabled
+        self.files: Dict[str, str] = {}
+        self.blocks: Dict[str, str] = {}
+        self.skipped_files = 0
+        self.skipped_blocks = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    (self.files if record["kind"] == "file" else self.blocks).setdefault(record["digest"], record["archived_path"])
+
+    @staticmethod
+    def file_digest(file_path: str) -> str:
+        """
+        原始文件字节内容的 SHA-256。
+        """
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    block_digest = staticmethod(block_digest)  # 定义在 SCRIPT_util，generate / reshard 按相同的摘要识别块
+
+    def claim_file(self, digest: str) -> bool:
+        """
+        文件是否需要处理：已消费过（或本次运行已登记）时返回 False 并计入跳过数，否则登记并返回 True。
+        """
+        if self.enabled and digest in self.files:
+            self.skipped_files += 1
+            return False
+        self.files.setdefault(digest, "")
+        return True
+
+    def claim_block(self, digest: str) -> bool:
+        """
+        块是否需要合并：已消费过（或本次运行已登记）时返回 False 并计入跳过数，否则登记并返回 True。
+        """
+        if self.enabled and digest in self.blocks:
+            self.skipped_blocks += 1
+            return False
+        self.blocks.setdefault(digest, "")
+        return True
+
+    def record(self, knowledge_base_dir: str, rel_path: str, file_digest: str, block_digests: List[Tuple[int, str]]):
+        """
+        原始文件归档后调用：写入文件记录及其本次实际合并的块记录 [(idx, digest), ...]。
+        """
+        archived_path = os.path.relpath(KnowledgeBasePaths.get_used_raw_file_path(knowledge_base_dir, rel_path), knowledge_base_dir)
+        records = [{"kind": "file", "digest": file_digest, "rel_path": rel_path, "archived_path": archived_path}]
+        records += [{"kind": "block", "digest": digest, "rel_path": rel_path, "idx": idx, "archived_path": archived_path}
+                    for idx, digest in block_digests]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.files[file_digest] = self.files.get(file_digest) or archived_path
+        for _, digest in block_digests:
+            self.blocks[digest] = self.blocks.get(digest) or archived_path
+
+    def report(self):
+        print(f"Skipped {self.skipped_files} already ingested file(s), {self.skipped_blocks} already ingested block(s)")
+
+
+class IngestCheckpoint:
+    """
+    ingest 检查点日志（见 KnowledgeBasePaths.get_ingest_checkpoint_path），预写式、只追加的 JSONL：
+    - {"event": "begin", "target": 目标文件, "keys": [[rel_path, idx, block_digest], ...]}：开始合并这些块
+    - {"event": "commit", "target": 目标文件, "keys": [...]}：这些块已合并并原子写回目标文件（写入后 fsync）
+    目标文件通过 atomic_write_bytes 写回，中断时只会是旧内容或完整的新内容。
+    --resume 时跳过已 commit 的块；只有 begin 没有 commit 的块会重新合并（若目标文件其实已经写回，重新合并的结果为 already_exists）。
+    运行正常结束后删除检查点日志；不带 --resume 启动时，遗留的检查点日志会被提示并清空。
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.committed = set()
+        self.resumed_blocks = 0
+        if os.path.exists(path):
+            if resume:
+                with open(path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            break  # 中断时写了一半的最后一行
+                        if record["event"] == "commit":
+                            self.committed.update(tuple(key) for key in record["keys"])
+                print(f"Resuming: {len(self.committed)} block(s) already committed")
+            else:
+                print(f"Note: found checkpoint of an interrupted run ({path}), starting over; use --resume to continue it")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, 'a' if resume else 'w', encoding='utf-8')
+
+    def is_committed(self, key: Tuple[str, int, str]) -> bool:
+        """
+        块是否已在之前的（中断的）运行中提交，已提交时计入续跑跳过数。
+        """
+        if key in self.committed:
+            self.resumed_blocks += 1
+            return True
+        return False
+
+    def begin(self, target_filename: str, keys: List[Tuple[str, int, str]]):
+        self._append({"event": "begin", "target": target_filename, "keys": keys}, sync=False)
+
+    def commit(self, target_filename: str, keys: List[Tuple[str, int, str]]):
+        self._append({"event": "commit", "target": target_filename, "keys": keys}, sync=True)
+
+    def _append(self, record: dict, sync: bool):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def finish(self):
+        """
+        运行正常结束：所有文件已归档、清单已写入，检查点日志不再需要。
+        """
+        self.close()
+        os.remove(self.path)
+
+
+def archive_raw_file(knowledge_base_dir: str, full_path: str, rel_path: str):
+    """
+    归档原始文件到 10-chats-input-raw-used 目录
+    """
+    dst_path = KnowledgeBasePaths.get_used_raw_file_path(knowledge_base_dir, rel_path)
+    with PROFILER.span("archive"):
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        os.rename(full_path, dst_path)
+    print(f"Archived: {rel_path} -> 10-chats-input-raw-used/")
+
+
+def run_streaming(args, file_tasks: List[Tuple[str, str]], dumper: DebugDumper, manifest: IngestManifest, checkpoint: IngestCheckpoint):
+    """
+    流式模式：逐个文件处理。
+    生成器每产出一个块就立即 dump、合并，然后丢弃；一个文件的所有块处理完毕后立即归档该文件。
+    峰值内存由最大的单个块（以及它的目标月份文件）决定，而不是整批数据。
+    """
     for full_path, rel_path in file_tasks:
-        chat_raw_file = FileParser.parse_raw_file(full_path, fallback_year=args.fallback_year)
-        raw_files_with_rel.append((chat_raw_file, rel_path))
+        with PROFILER.span("digest"):
+            file_digest = IngestManifest.file_digest(full_path)
+        if not manifest.claim_file(file_digest):
+            print(f"Skipped (already ingested): {rel_path}")
+            archive_raw_file(args.knowledge_base_dir, full_path, rel_path)
+            continue
+        block_digests = []
+        for idx, block in enumerate(PROFILER.iter_span("parse", FileParser.iter_raw_blocks(full_path, fallback_year=args.fallback_year))):
+            with PROFILER.span("digest"):
+                block_digest = IngestManifest.block_digest(block)
+            if not manifest.claim_block(block_digest):
+                continue
+            block_digests.append((idx, block_digest))
+            key = (rel_path, idx, block_digest)
+            if checkpoint.is_committed(key):
+                continue
+            dumper.raw_block(rel_path, idx, block)
+            target_filename = KnowledgeBasePaths.get_org_file_path(args.knowledge_base_dir, chat_name=block.chat_name, dt=block.time_tag)
+            checkpoint.begin(target_filename, [key])
+            merge_result = magic_merge(block, target_filename)
+            checkpoint.commit(target_filename, [key])
+            dumper.merge_result(rel_path, idx, block, merge_result)
+        archive_raw_file(args.knowledge_base_dir, full_path, rel_path)
+        manifest.record(args.knowledge_base_dir, rel_path, file_digest, block_digests)
 
-    # --- debug: dump raw blocks to filename-idx_chunk.yaml ---
-    for raw_file, rel_path in raw_files_with_rel:
-        # 使用相对路径生成 dump 文件名，避免重名冲突
-        safe_rel_name = rel_path.replace(os.sep, '_').replace('.', '_')
-        for idx, block in enumerate(raw_file.chat_blocks):
-            dump_filename = f"{safe_rel_name}_{idx}_raw_chunk"
-            dump_path = KnowledgeBasePaths.get_task_orig_chunk_path(norm_task_run_dir, dump_filename)
-            with open(dump_path, 'w', encoding='utf-8') as f:
-                f.write(block.dump_yaml())
 
-    # 5. for each file 的 each block, 合并到已有的目标文件中
+def run_batch(args, file_tasks: List[Tuple[str, str]], dumper: DebugDumper, manifest: IngestManifest, checkpoint: IngestCheckpoint):
+    """
+    批量模式：先解析全部文件，再按目标文件分组合并（见 MergeScheduler），最后统一归档。
+    """
+    # 4. 按 ingest 清单过滤已消费过的文件，再解析剩余的原始文件（--jobs > 1 时并行），获取所有 (ChatRawFile, rel_path)
+    with PROFILER.span("digest"):
+        file_digests = {rel_path: IngestManifest.file_digest(full_path) for full_path, rel_path in file_tasks}
+    parse_tasks = []
+    for full_path, rel_path in file_tasks:
+        if manifest.claim_file(file_digests[rel_path]):
+            parse_tasks.append((full_path, rel_path))
+        else:
+            print(f"Skipped (already ingested): {rel_path}")
+    with PROFILER.span("parse"):
+        raw_files = parse_raw_files(parse_tasks, args.fallback_year, args.jobs)
+    raw_files_with_rel: List[Tuple[ChatRawFile, str]] = [(raw_file, rel_path) for raw_file, (_, rel_path) in zip(raw_files, parse_tasks)]
+
+    # 按 ingest 清单过滤已消费过的块，记录每个文件本次实际合并的块
+    block_digests: Dict[str, List[Tuple[int, str]]] = {rel_path: [] for _, rel_path in parse_tasks}
+    new_blocks: List[Tuple[str, int, ChatBlock, str]] = []
     for raw_file, rel_path in raw_files_with_rel:
-        safe_rel_name = rel_path.replace(os.sep, '_').replace('.', '_')
         for idx, block in enumerate(raw_file.chat_blocks):
+            with PROFILER.span("digest"):
+                block_digest = IngestManifest.block_digest(block)
+            if manifest.claim_block(block_digest):
+                block_digests[rel_path].append((idx, block_digest))
+                # --resume: 上次中断前已经提交的块不再合并
+                if not checkpoint.is_committed((rel_path, idx, block_digest)):
+                    new_blocks.append((rel_path, idx, block, block_digest))
+
+    # --- debug: dump raw blocks (journal / filename-idx_chunk.yaml) ---
+    for rel_path, idx, block, _ in new_blocks:
+        dumper.raw_block(rel_path, idx, block)
+
+    # 5. 按目标文件分组合并：每个目标文件只读取、hash、写回一次，合并前后写入检查点
+    # 同一群聊同一天互相重叠的块先在内存中折叠，只把折叠后的块合并到目标文件
+    scheduler = MergeScheduler(args.knowledge_base_dir, collapse=not args.no_collapse)
+    for rel_path, idx, block, block_digest in new_blocks:
+        scheduler.add((rel_path, idx, block_digest), block)
+    collapsed_blocks = 0
+    for (rel_path, idx, _), block, merge_result in scheduler.run(jobs=args.jobs, checkpoint=checkpoint):
+        dumper.merge_result(rel_path, idx, block, merge_result)
+        collapsed_blocks += merge_result.action_taken["strategy"] == "collapsed"
+    if collapsed_blocks:
+        print(f"Collapsed {collapsed_blocks} overlapping block(s) in memory before merging")
+
+    # 6. 归档原始文件到 10-chats-input-raw-used 目录，并写入 ingest 清单
+    for full_path, rel_path in file_tasks:
+        archive_raw_file(args.knowledge_base_dir, full_path, rel_path)
+        if rel_path in block_digests:
+            manifest.record(args.knowledge_base_dir, rel_path, file_digests[rel_path], block_digests[rel_path])
 
-            # 先在 args.output_dir 中定位目标群的目标月份文件（不检查，仅定位）
-            # 目标文件命名规范: {group_id}_{YYYYMM}.md
-            target_filename = KnowledgeBasePaths.get_org_file_path(args.knowledge_base_dir, chat_name=block.chat_name, dt=block.time_tag)
 
-            # 合并
-            merge_result = magic_merge(block, target_filename);
-            # 写出合并日志 dump_{orig_filename}_{block_idx}_merge_chunk.yaml
-            dump_filename = f"{safe_rel_name}_{idx}_merge_chunk"
-            dump_path = KnowledgeBasePaths.get_task_merged_chunk_path(norm_task_run_dir, dump_filename)
-            with open(dump_path, 'w', encoding='utf-8') as f:
-                # 合并 merge_result 和 block 的信息，生成 dump 内容
-                yaml.dump({
-                    "block_info": yaml.safe_load(block.dump_yaml_without_content()),
-                    "merge_result": merge_result.to_dict()
-                }, f, allow_unicode=True)
-
-    # 6. 归档原始文件到 10-chats-input-raw-used 目录
-    for full_path, rel_path in file_tasks:
-        dst_path = KnowledgeBasePaths.get_used_raw_file_path(args.knowledge_base_dir, rel_path)
-        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
-        os.rename(full_path, dst_path)
-        print(f"Archived: {rel_path} -> 10-chats-input-raw-used/")
+def main():
+
+    # 1. 初始化
+    args = parse_args()
+    if args.rebuild_index:
+        chat_count, tag_count = rebuild_timeline_indexes(args.knowledge_base_dir)
+        print(f"Rebuilt timeline index for {chat_count} chat(s), {tag_count} time tag(s)")
+        return
+
+    # 2. 任务信息目录准备
+    norm_task_run_dir = KnowledgeBasePaths.get_task_run_dir('normalize', args.knowledge_base_dir)
+    os.makedirs(norm_task_run_dir,  exist_ok=True)
+
+    # 3. 校验并获取相对路径
+    file_tasks = collect_file_tasks(args.input_dir, args.knowledge_base_dir)
+    if not file_tasks:
+        print(f"No .md files found in {args.input_dir}")
+        return
+
+    manifest = IngestManifest(KnowledgeBasePaths.get_ingest_manifest_path(args.knowledge_base_dir), enabled=not args.force)
+    checkpoint = IngestCheckpoint(KnowledgeBasePaths.get_ingest_checkpoint_path(args.knowledge_base_dir), resume=args.resume)
+    dumper = DebugDumper(args.debug_dumps, norm_task_run_dir, compressed=args.journal_zstd)
+    # 阶段计时始终开启；--profile 时额外记录 trace 事件，并对本进程做 cProfile（进程池子进程不在 pstats 中，但其阶段耗时会汇总进 trace）
+    PROFILER.reset(trace=args.profile)
+    profile = cProfile.Profile() if args.profile else None
+    if profile:
+        profile.enable()
+    try:
+        if args.streaming:
+            if args.jobs > 1:
+                print("Note: --jobs is ignored in --streaming mode")
+            run_streaming(args, file_tasks, dumper, manifest, checkpoint)
+        else:
+            run_batch(args, file_tasks, dumper, manifest, checkpoint)
+    except BaseException:
+        # 保留检查点日志，供 --resume 使用
+        checkpoint.close()
+        raise
+    finally:
+        dumper.close()
+        if profile:
+            profile.disable()
+            profile.dump_stats(KnowledgeBasePaths.get_task_profile_path(norm_task_run_dir))
+            PROFILER.write_chrome_trace(KnowledgeBasePaths.get_task_trace_path(norm_task_run_dir))
+        # 运行摘要：各阶段耗时与计数
+        with open(KnowledgeBasePaths.get_task_summary_path(norm_task_run_dir), 'w', encoding='utf-8') as f:
+            json.dump(PROFILER.summary(), f, ensure_ascii=False, indent=2)
+    checkpoint.finish()
+    manifest.report()
+    if checkpoint.resumed_blocks:
+        print(f"Resumed: skipped {checkpoint.resumed_blocks} block(s) committed by the interrupted run")
+    print(PROFILER.format_summary())
+    if profile:
+        print(f"Profile: {KnowledgeBasePaths.get_task_profile_path(norm_task_run_dir)}, trace: {KnowledgeBasePaths.get_task_trace_path(norm_task_run_dir)}")
 
 
 if __name__ == "__main__":
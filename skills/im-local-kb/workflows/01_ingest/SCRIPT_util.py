@@ -1,8 +1,21 @@
 import re
 import os
+import io
+import sys
+import codecs
+import hashlib
+import json
+import time
+import struct
+import mmap
+import bisect
+import itertools
 import yaml
-from datetime import datetime
-from typing import List, Optional, Tuple
+from array import array
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
 
 """
 SCRIPT_util.py
@@ -65,11 +78,7 @@ class RegexPatterns:
 
         # 将 ref_date 解析成 datetime 对象，方便后续补全
         # ref_date 可以是 None，也可以是 "YYYY-MM-DD" 或 "YYYY-MM-DD HH:mm" 格式
-        ref_dt = None
-        if ref_date:
-            ref_dt = time_parse(ref_date, "%Y-%m-%d %H:%M") or time_parse(ref_date, "%Y-%m-%d")
-            if not ref_dt:
-                raise ValueError(f"提供的参考日期 '{ref_date}' 格式不正确，应该是 'YYYY-MM-DD' 或 'YYYY-MM-DD HH:mm'")
+        ref_dt = RegexPatterns.parse_ref_date(ref_date) if ref_date else None
 
         # 然后我们就能用 if ... elif ... 来判断不同的时间格式，并尝试解析
         if time_parse(orig_time_str, "%Y-%m-%d %H:%M"):
@@ -95,6 +104,26 @@ class RegexPatterns:
         else:
             raise ValueError(f"无法解析时间标签 '{orig_time_str}'，请提供更完整的日期时间信息")
 
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def parse_ref_date(ref_date: str) -> datetime:
+        """
+        将参考日期 ref_date 解析为 datetime 对象，结果按字符串缓存。
+        解析一个文件时 ref_date 就是上一个时间标签，绝大多数行会重复使用同一个值，缓存可以避免反复 strptime。
+        ref_date 应该是 "YYYY-MM-DD" 或 "YYYY-MM-DD HH:mm" 格式，否则抛异常。
+
+        >>> RegexPatterns.parse_ref_date("2024-06-01 14:30")
+        datetime.datetime(2024, 6, 1, 14, 30)
+        >>> RegexPatterns.parse_ref_date("2024-06-01")
+        datetime.datetime(2024, 6, 1, 0, 0)
+        """
+        for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d"):
+            try:
+                return datetime.strptime(ref_date, fmt)
+            except ValueError:
+                pass
+        raise ValueError(f"提供的参考日期 '{ref_date}' 格式不正确，应该是 'YYYY-MM-DD' 或 'YYYY-MM-DD HH:mm'")
+
     @staticmethod
     def extract_chat_name(line: str) -> Tuple[bool, Optional[str]]:
         """
@@ -188,45 +217,328 @@ class RegexPatterns:
         return sanitized.strip('_')
 
 
+class LineClassifier:
+    """
+    单趟行分类器：用一个预编译的正则把每一行归入 聊天名称行 / 时间标签行 / 普通内容行 三类之一。
+    结果与依次调用 RegexPatterns.extract_chat_name 和 RegexPatterns.extract_time_tag 完全一致，但
+    - 普通内容行只会经过一次 C 层的正则匹配（绝大多数行在第一个字符就失败），
+    - 常见的 ASCII 时间标签直接由捕获组拼出结果，用 datetime 构造函数校验，不再逐个格式尝试 strptime，
+    - 参考日期的解析通过 RegexPatterns.parse_ref_date 缓存。
+    遇到不常见的写法（全角数字、多个空格分隔、越界日期等），回退到 RegexPatterns 的原始实现，保证行为（包括异常）不变。
+
+    >>> c = LineClassifier(fallback_year=2024)
+    >>> c.classify("## -- [项目讨论群]", None)
+    (1, '项目讨论群')
+    >>> c.classify("-- 07-02 14:30", None)
+    (2, '2024-07-02 14:30')
+    >>> c.classify("-- 15:00", "2024-07-02 14:30")
+    (2, '2024-07-02 15:00')
+    >>> c.classify("张三: 你好", "2024-07-02 14:30")
+    (0, None)
+    """
+
+    CONTENT = 0
+    CHAT = 1
+    TIME = 2
+
+    # 三个分支：聊天名称行；常见写法的时间标签行；以及需要回退到原始实现判断的候选行（以 # 或 -- 开头）。
+    # 首尾的 \s* 与 \s*\Z 等价于原始实现中的 line.strip()。
+    _LINE_PATTERN = re.compile(
+        r"\s*(?:"
+        r"#+\s+--\s+(?P<chat>\S.*?)\s*\Z"
+        r"|--\s*(?:(?:(?P<year>[0-9]{4})-)?(?P<month>[0-9]{1,2})-(?P<day>[0-9]{1,2}))?"
+        r"(?:(?(month) )(?P<hour>[0-9]{1,2}):(?P<minute>[0-9]{1,2}))?\s*\Z"
+        r"|(?P<other>#|--)"
+        r")"
+    )
+
+    def __init__(self, fallback_year: Optional[int] = None):
+        self.fallback_year = fallback_year
+        self._match = self._LINE_PATTERN.match
+
+    def classify(self, line: str, ref_date: Optional[str]) -> Tuple[int, Optional[str]]:
+        """
+        返回 (kind, value)：
+        - (CHAT, 已转义的聊天名称)
+        - (TIME, 补全后的时间标签)
+        - (CONTENT, None)
+        """
+        m = self._match(line)
+        if m is None:
+            return self.CONTENT, None
+
+        chat = m.group('chat')
+        if chat is not None:
+            return self.CHAT, RegexPatterns.chat_name_sanitize(chat.strip().strip("[]"))
+
+        if m.group('other') is not None:
+            return self._classify_slow(line, ref_date)
+
+        month = m.group('month')
+        hour = m.group('hour')
+        if month is None and hour is None:
+            # 只有 "--"，不是时间标签
+            return self.CONTENT, None
+
+        # 与原始实现一致：先解析参考日期（格式错误时同样抛异常）
+        ref_dt = RegexPatterns.parse_ref_date(ref_date) if ref_date else None
+        year = m.group('year')
+        try:
+            datetime(int(year) if year else 1900,
+                     int(month) if month else 1, int(m.group('day')) if month else 1,
+                     int(hour) if hour else 0, int(m.group('minute')) if hour else 0)
+        except ValueError:
+            # 越界的日期时间交给原始实现处理（会抛出同样的异常）
+            return self._classify_slow(line, ref_date)
+
+        orig_time_str = line[m.start('year' if year else ('month' if month else 'hour')):m.end('minute' if hour else 'day')]
+        if year:
+            return self.TIME, orig_time_str if hour else orig_time_str + " 00:00"
+        if month:
+            fill_year = ref_dt.year if ref_dt else self.fallback_year
+            if not fill_year:
+                return self._classify_slow(line, ref_date)
+            return self.TIME, f"{fill_year}-{orig_time_str}" if hour else f"{fill_year}-{orig_time_str} 00:00"
+        if ref_dt is None:
+            return self._classify_slow(line, ref_date)
+        return self.TIME, f"{ref_dt.year}-{ref_dt.month:02d}-{ref_dt.day:02d} {orig_time_str}"
+
+    def _classify_slow(self, line: str, ref_date: Optional[str]) -> Tuple[int, Optional[str]]:
+        """
+        回退路径：按原始顺序调用 RegexPatterns 的实现。
+        """
+        is_chat, chat_name = RegexPatterns.extract_chat_name(line)
+        if is_chat:
+            return self.CHAT, RegexPatterns.chat_name_sanitize(chat_name)
+        is_time, time_tag = RegexPatterns.extract_time_tag(line, ref_date, fallback_year=self.fallback_year)
+        if is_time:
+            return self.TIME, time_tag
+        return self.CONTENT, None
+
+
+class LineBuffer(Sequence[str]):
+    r"""
+    一段 UTF-8 字节缓冲（bytes / memoryview，例如 mmap 的切片）的只读行视图，行为与 readlines() 得到的 List[str] 相同：
+    按 \n 断行并保留换行符，最后一行可以没有换行符。
+    行边界在第一次使用时计算（只记录偏移，不产生字符串），每次取行时才解码，不缓存解码结果。
+    序列化（pickle）时只保存一份 bytes 和行偏移数组。
+
+    >>> lines = LineBuffer("甲\n乙\n丙".encode('utf-8'))
+    >>> len(lines), lines[1], lines[-1], lines[0:2]
+    (3, '乙\n', '丙', ['甲\n', '乙\n'])
+    >>> lines == ['甲\n', '乙\n', '丙']
+    True
+    """
+
+    __slots__ = ('_buf', '_offsets')
+
+    def __init__(self, buf: Union[bytes, memoryview]):
+        self._buf = buf
+        self._offsets: Optional[array] = None
+
+    @property
+    def offsets(self) -> array:
+        """
+        每一行的起始字节偏移，末尾附加缓冲长度，共 len(self) + 1 项。
+        """
+        if self._offsets is None:
+            # 按 \n 切开后累加每段长度（含换行符），逐段的工作都在 C 层完成
+            parts = bytes(self._buf).split(b"\n")
+            last = parts.pop()
+            lengths = [len(part) + 1 for part in parts]
+            if last:
+                lengths.append(len(last))
+            offsets = array('Q', [0])
+            offsets.extend(itertools.accumulate(lengths))
+            self._offsets = offsets
+        return self._offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        offsets = self.offsets
+        if isinstance(index, slice):
+            return [str(self._buf[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(*index.indices(len(offsets) - 1))]
+        if index < 0:
+            index += len(offsets) - 1
+        if not 0 <= index < len(offsets) - 1:
+            raise IndexError("LineBuffer index out of range")
+        return str(self._buf[offsets[index]:offsets[index + 1]], 'utf-8')
+
+    def __iter__(self) -> Iterator[str]:
+        buf, offsets = self._buf, self.offsets
+        for i in range(len(offsets) - 1):
+            yield str(buf[offsets[i]:offsets[i + 1]], 'utf-8')
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (LineBuffer, list)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"LineBuffer({list(self)!r})"
+
+    def __reduce__(self):
+        return LineBuffer._restore, (bytes(self._buf), self._offsets)
+
+    @staticmethod
+    def _restore(buf: bytes, offsets: Optional[array]) -> 'LineBuffer':
+        lines = LineBuffer(buf)
+        lines._offsets = offsets
+        return lines
+
+    @staticmethod
+    def from_lines(lines: Sequence[str]) -> Optional['LineBuffer']:
+        """
+        把 readlines() 风格的行列表压缩为一个 LineBuffer：除最后一行外每行恰好以一个 \\n 结尾，且行内没有其他 \\n。
+        不满足时（无法从拼接后的缓冲还原出同样的行）返回 None。
+        """
+        if not lines:
+            return None
+        text = ''.join(lines)
+        if text.count("\n") != len(lines) - (0 if lines[-1].endswith("\n") else 1):
+            return None
+        if any(not line.endswith("\n") for line in itertools.islice(lines, 0, len(lines) - 1)):
+            return None
+        buffer = LineBuffer(text.encode('utf-8'))
+        offsets = array('Q', [0])
+        offsets.extend(itertools.accumulate(len(line.encode('utf-8')) for line in lines))
+        buffer._offsets = offsets
+        return buffer
+
+    def text(self) -> str:
+        """
+        整段解码，等价于 ''.join(self)。
+        """
+        return str(self._buf, 'utf-8')
+
+
 class ChatBlock:
     """
     代表一个以日期标注的聊天记录块，包含以下属性：
     - chat_name: 聊天名称字符串，如 "项目讨论群", "张三"
     - time_tag: 日期时间字符串，如 "2024-06-01", "07-02", "14:30", "2024-06-01 14:30", "07-02 14:30"
-    - content: 聊天记录内容字符串（多行）
+    - content: 聊天记录内容（按行的只读序列，与 List[str] 用法相同）
     - associated_file_path: 该块关联的来源或目标文件路径字符串
+    - sort_key: time_tag 为规范的 "YYYY-MM-DD HH:MM" 时，为自 1970-01-01 00:00 起的分钟数，否则为 None
+
+    为了降低大批量块的内存、排序与进程间传递（pickle）的开销：
+    - 使用 __slots__，不为每个块创建 __dict__；
+    - sort_key 在构造（解析）时计算一次，排序直接比较整数（见 ChatBlock.order_key）；
+    - content 保存为一份 UTF-8 缓冲 + 行偏移数组（LineBuffer），而不是每行一个 str 对象。
+      传入的行列表无法无损压缩时（例如行内含有换行符）保持原样。
+
+    >>> block = ChatBlock("群", "2024-01-02 03:04", ["甲", "乙"], "x.md")
+    >>> block.sort_key, len(block.content), block.content[0]
+    (28402744, 2, '甲')
+    >>> ChatBlock("群", "2024-1-2 03:04", [], "x.md").sort_key is None
+    True
     """
 
-    def __init__(self, chat_name: str, time_tag: str, content: List[str], associated_file_path: str):
+    __slots__ = ('chat_name', 'time_tag', 'associated_file_path', 'sort_key', '_content')
+
+    _CANONICAL_TAG = re.compile(r"([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):([0-9]{2})\Z")
+    _EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+    def __init__(self, chat_name: str, time_tag: str, content: Sequence[str], associated_file_path: str, sort_key: Optional[int] = None):
         self.chat_name = chat_name
         self.time_tag = time_tag
         self.associated_file_path = associated_file_path
         self.content = content
+        self.sort_key = sort_key if sort_key is not None else ChatBlock.epoch_minutes(time_tag)
 
-    def dump_yaml(self) -> str:
+    @property
+    def content(self) -> Sequence[str]:
+        return self._content
+
+    @content.setter
+    def content(self, content: Sequence[str]):
+        if not isinstance(content, LineBuffer):
+            content = LineBuffer.from_lines(content) or list(content)
+        self._content = content
+
+    @staticmethod
+    def epoch_minutes(time_tag: str) -> Optional[int]:
         """
-        将该聊天记录块以 YAML 格式写入目标文件路径，调试用。
+        规范时间标签 "YYYY-MM-DD HH:MM" 对应的分钟数（自 1970-01-01 00:00 起），其他写法或无效日期返回 None。
+        对规范时间标签，分钟数的大小顺序与字符串的字典序完全一致。
+        """
+        m = ChatBlock._CANONICAL_TAG.match(time_tag)
+        if m is None:
+            return None
+        year, month, day, hour, minute = map(int, m.groups())
+        if hour > 23 or minute > 59:
+            return None
+        try:
+            ordinal = datetime(year, month, day).toordinal()
+        except ValueError:
+            return None
+        return (ordinal - ChatBlock._EPOCH_ORDINAL) * 1440 + hour * 60 + minute
+
+    @staticmethod
+    def order_key(blocks: Iterable['ChatBlock']):
+        """
+        按时间排序 blocks 时使用的 key：全部块都有 sort_key 时比较整数，否则退回按 time_tag 字符串排序（与原有行为一致）。
+        """
+        if all(block.sort_key is not None for block in blocks):
+            return ChatBlock._get_sort_key
+        return ChatBlock._get_time_tag
+
+    @staticmethod
+    def _get_sort_key(block: 'ChatBlock') -> int:
+        return block.sort_key
+
+    @staticmethod
+    def _get_time_tag(block: 'ChatBlock') -> str:
+        return block.time_tag
+
+    def __reduce__(self):
+        return ChatBlock, (self.chat_name, self.time_tag, self._content, self.associated_file_path, self.sort_key)
+
+    def to_dict(self, with_content: bool = True) -> dict:
+        """
+        转换为可序列化的字典（YAML / JSON 通用）。
+        with_content=False 时 content 只展示前 80 个字符（content_ellipsed），方便快速查看块的信息而不暴露全部内容。
         """
         data = {
             'chat_name': self.chat_name,
             'time_tag': self.time_tag,
             'associated_file_path': self.associated_file_path,
-            'content': ''.join(self.content)
         }
-        return yaml.dump(data, allow_unicode=True)
+        if with_content:
+            data['content'] = ''.join(self.content)
+        else:
+            data['content_ellipsed'] = (''.join(self.content)[:80] + '...') if self.content else ''
+        return data
+
+    def dump_yaml(self) -> str:
+        """
+        将该聊天记录块以 YAML 格式写入目标文件路径，调试用。
+        """
+        return yaml.dump(self.to_dict(), allow_unicode=True)
 
     def dump_yaml_without_content(self) -> str:
         """
         将该聊天记录块的元信息（不包含 content）以 YAML 格式写入目标文件路径，调试用。
         content 展示前 80 个字符，方便快速查看块的信息而不暴露全部内容。
         """
-        data = {
-            'chat_name': self.chat_name,
-            'time_tag': self.time_tag,
-            'associated_file_path': self.associated_file_path,
-            'content_ellipsed': (''.join(self.content)[:80] + '...') if self.content else ''
-        }
-        return yaml.dump(data, allow_unicode=True)
+        return yaml.dump(self.to_dict(with_content=False), allow_unicode=True)
+
+
+def block_digest(block: ChatBlock) -> str:
+    """
+    块的内容摘要：chat_name、time_tag 与全部内容行共同决定，与来源文件无关。
+    ingest 清单、03_generate 的增量上下文与 reshard 的校验都按它识别块。
+    """
+    digest = hashlib.sha256()
+    digest.update(block.chat_name.encode('utf-8'))
+    digest.update(b"\0")
+    digest.update(block.time_tag.encode('utf-8'))
+    digest.update(b"\0")
+    for line in block.content:
+        digest.update(line.encode('utf-8'))
+    return digest.hexdigest()
 
 
 class ChatRawFile:
@@ -276,14 +588,17 @@ class ChatOrgFile:
 
         # 检查所有块都有有效的时间标签
         # YYYY-MM-DD HH:mm 格式中，一定要包含 年-月-日；但允许缺失时间部分
+        # 有 sort_key 的块在解析时已经确认是完整的规范格式，无需再次校验
         for block in self.chat_blocks:
+            if block.sort_key is not None:
+                continue
             if not block.time_tag:
                 raise ValueError(f"聊天记录块缺少时间标签")
             if not re.match(r"^\d{4}-\d{2}-\d{2}", block.time_tag):
                 raise ValueError(f"时间标签 '{block.time_tag}' 不包含年-月-日信息")
 
-        # 按时间顺序排序（如果时间标签格式正确，直接按字符串排序即可）
-        self.chat_blocks.sort(key=lambda b: b.time_tag)
+        # 按时间顺序排序（如果时间标签格式正确，直接按字符串排序即可；全部为规范格式时比较整数 sort_key，顺序相同）
+        self.chat_blocks.sort(key=ChatBlock.order_key(self.chat_blocks))
 
     def convert_to_md_lines(self) -> List[str]:
         """
@@ -295,12 +610,341 @@ class ChatOrgFile:
             chat_name = self.chat_blocks[0].chat_name
             md_lines.append(f"## -- {chat_name}\n")
             for block in self.chat_blocks:
-                md_lines.append(f"-- {block.time_tag}\n")
-                for line in block.content:
-                    md_lines.append(line.rstrip("\r\n") + "\n")
+                md_lines.extend(ChatOrgFile.block_to_md_lines(block))
 
         return md_lines
 
+    @staticmethod
+    def block_to_md_lines(block: ChatBlock) -> List[str]:
+        """
+        单个块在整理后文件中的行：时间标签行 + 内容行（统一为 \\n 换行）。
+        """
+        md_lines = [f"-- {block.time_tag}\n"]
+        for line in block.content:
+            md_lines.append(line.rstrip("\r\n") + "\n")
+        return md_lines
+
+class TimeTagIndex:
+    r"""
+    整理后文件的时间标签索引：按出现顺序记录每个时间标签行的 (time_tag, 行号)。
+    只为"规范"的文件建立索引，即文件内容与 FileParser.parse_org_lines + ChatOrgFile.convert_to_md_lines 的结果逐行相同：
+    - 第一行是 "## -- {chat_name}"，其后不再出现聊天名称行，第二行是时间标签行；
+    - 时间标签行都是 "-- YYYY-MM-DD ..." 的完整写法，且按时间非递减排列；
+    - 每一行都以 \n 结尾（没有 \r）。
+    对规范文件，追加一个块后重新解析、排序、渲染的结果，等价于在 bisect_right 的位置插入该块渲染后的行。
+
+    >>> index = TimeTagIndex.build(["## -- 群\n", "-- 2024-01-01 10:00\n", "a\n", "-- 2024-01-03 09:00\n", "b\n"])
+    >>> index.chat_name, index.tags, index.line_nos
+    ('群', ['2024-01-01 10:00', '2024-01-03 09:00'], [1, 3])
+    >>> index.insert_position("2024-01-02 08:00", 5)
+    (1, 3)
+    >>> TimeTagIndex.build(["## -- 群\n", "-- 2024-01-03 09:00\n", "-- 2024-01-01 10:00\n"]) is None
+    True
+    """
+
+    __slots__ = ('chat_name', 'tags', 'line_nos')
+
+    _FULL_DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}")
+
+    def __init__(self, chat_name: str, tags: List[str], line_nos: List[int]):
+        self.chat_name = chat_name
+        self.tags = tags
+        self.line_nos = line_nos
+
+    @staticmethod
+    def is_canonical_tag(time_tag: str) -> bool:
+        """
+        时间标签是否满足 ChatOrgFile.validate_and_sort_blocks 的要求（以 YYYY-MM-DD 开头）。
+        """
+        return bool(TimeTagIndex._FULL_DATE_PATTERN.match(time_tag))
+
+    @classmethod
+    def build(cls, lines: List[str]) -> Optional['TimeTagIndex']:
+        """
+        扫描整理后文件的行，文件规范时返回索引，否则返回 None（调用方应回退到完整的解析-排序-渲染）。
+        分类规则与 FileParser.iter_blocks 相同（LineClassifier），但不构建块、不复制内容。
+        """
+        if len(lines) < 2:
+            return None
+        classify = LineClassifier().classify
+        try:
+            kind, chat_name = classify(lines[0], None)
+            if kind != LineClassifier.CHAT or lines[0] != f"## -- {chat_name}\n":
+                return None
+            tags: List[str] = []
+            line_nos: List[int] = []
+            last_tag = None
+            for line_no in range(1, len(lines)):
+                line = lines[line_no]
+                if not line.endswith("\n") or line.endswith("\r\n"):
+                    return None
+                kind, value = classify(line, last_tag)
+                if kind == LineClassifier.CONTENT:
+                    if last_tag is None:
+                        return None
+                    continue
+                if kind == LineClassifier.CHAT or line != f"-- {value}\n" or not cls.is_canonical_tag(value):
+                    return None
+                if last_tag is not None and value < last_tag:
+                    return None
+                tags.append(value)
+                line_nos.append(line_no)
+                last_tag = value
+        except ValueError:
+            # 解析本身会失败的文件交给完整路径处理（抛出同样的异常）
+            return None
+        return cls(chat_name, tags, line_nos)
+
+    def insert_position(self, time_tag: str, total_lines: int) -> Tuple[int, int]:
+        """
+        时间标签为 time_tag 的新块在排序后的位置：返回 (在索引中的下标, 插入的行号)。
+        时间相同的块排在已有块之后，与稳定排序后追加的结果一致。
+        """
+        pos = bisect.bisect_right(self.tags, time_tag)
+        return pos, (self.line_nos[pos] if pos < len(self.line_nos) else total_lines)
+
+    def insert(self, pos: int, time_tag: str, line_no: int, line_count: int):
+        """
+        在 pos 处登记一个新插入的块（共 line_count 行，时间标签行位于 line_no），之后的块行号整体平移。
+        """
+        self.line_nos[pos:] = [n + line_count for n in self.line_nos[pos:]]
+        self.tags.insert(pos, time_tag)
+        self.line_nos.insert(pos, line_no)
+
+
+class MarkerLineScanner:
+    r"""
+    基于 mmap 的字节级扫描器，结果与 FileParser.iter_blocks 逐行解析完全相同。
+    只有"行首（允许前导空白）是 # 或 --"的行才可能是聊天名称行、时间标签行或 frontmatter 标记，
+    扫描器直接在 mmap 的字节上用正则定位这些候选行，只解码候选行交给 LineClassifier 判断；
+    其余的消息内容不解码，每个块的 content 是 mmap 上的 LineBuffer 视图，用到时才按行解码。
+    解析大文件时不需要把整个文件变成 Python 字符串，耗时主要在 I/O。
+
+    前导空白与 str.strip / 正则 \s 的定义一致（包括 U+3000 等 Unicode 空白的 UTF-8 编码）。
+    文件中有 \r 时（\r\n 或旧式 Mac 换行），文本模式会做换行转换，这种文件不使用扫描器（见 can_scan）。
+    mmap 在所有块都被释放后随垃圾回收关闭。
+    """
+
+    # 除换行符以外的所有空白字符（与 str 正则的 \s 一致）的 UTF-8 编码
+    _SPACE = b"(?:" + b"|".join(re.escape(chr(c).encode('utf-8')) for c in range(0x3001)
+                                 if re.match(r"\s", chr(c)) and chr(c) not in "\r\n") + b")"
+    # 行首候选：第一行单独用 _FIRST_MARKER 判断，其余行通过前面的 \n 定位（字面量前缀可以快速搜索）
+    _FIRST_MARKER = re.compile(_SPACE + b"*(?:#|--)")
+    _MARKER = re.compile(b"\n" + _SPACE + b"*(?:#|--)")
+
+    def __init__(self, file_path: str, fallback_year: Optional[int] = None):
+        self.file_path = file_path
+        self.fallback_year = fallback_year
+
+    @staticmethod
+    def can_scan(file_path: str) -> bool:
+        r"""
+        文件非空且不含 \r 时可以使用扫描器。
+        Windows 上被 mmap 的文件不能重命名（归档），因此不使用扫描器。
+        """
+        if os.name == 'nt':
+            return False
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return mm.find(b"\r") == -1
+
+    def iter_marker_lines(self, mm: mmap.mmap, pos: int) -> Iterator[Tuple[int, int]]:
+        """
+        产出 pos 之后所有候选行的 (行起始偏移, 行结束偏移)，行结束偏移包含换行符。
+        """
+        size = len(mm)
+        if pos == 0 and self._FIRST_MARKER.match(mm, 0):
+            end = mm.find(b"\n", 0)
+            yield 0, size if end == -1 else end + 1
+        for m in self._MARKER.finditer(mm, max(pos - 1, 0)):
+            start = m.start() + 1
+            if start < pos:
+                continue
+            end = mm.find(b"\n", start)
+            yield start, size if end == -1 else end + 1
+
+    def iter_blocks(self) -> Iterator[ChatBlock]:
+        """
+        与 FileParser.iter_blocks 的流程相同：跳过 frontmatter，然后在 聊天名称行 / 时间标签行 处切分块。
+        块的内容是两个标记行之间的全部字节。
+        """
+        with open(self.file_path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mm)
+        size = len(mm)
+
+        def decode_line(start: int, end: int) -> str:
+            return str(mm[start:end], 'utf-8')
+
+        # 跳过 frontmatter：第一行是 "---" 时，跳到下一个 "---" 行之后（没有结束标记时整个文件都是 frontmatter）
+        pos = 0
+        first_end = mm.find(b"\n")
+        first_end = size if first_end == -1 else first_end + 1
+        if RegexPatterns.is_frontmatter(decode_line(0, first_end)):
+            pos = size
+            for start, end in self.iter_marker_lines(mm, first_end):
+                if RegexPatterns.is_frontmatter(decode_line(start, end)):
+                    pos = end
+                    break
+
+        last_chat_name = None
+        last_time_tag = None
+        content_start = pos
+
+        classify = LineClassifier(fallback_year=self.fallback_year).classify
+        for start, end in self.iter_marker_lines(mm, pos):
+            kind, value = classify(decode_line(start, end), last_time_tag)
+            if kind == LineClassifier.CONTENT:
+                continue
+            # 产出之前的块
+            if last_chat_name is not None and last_time_tag is not None:
+                yield ChatBlock(last_chat_name, last_time_tag, LineBuffer(view[content_start:start]), self.file_path)
+            if kind == LineClassifier.CHAT:
+                last_chat_name = value
+                last_time_tag = None
+            else:
+                last_time_tag = value
+            content_start = end
+
+        # 产出最后一个块
+        if last_chat_name is not None and last_time_tag is not None:
+            yield ChatBlock(last_chat_name, last_time_tag, LineBuffer(view[content_start:size]), self.file_path)
+
+
+class BlockDigestScanner:
+    r"""
+    流式计算整理后文件中每个块的内容摘要（block_digest），不保留块的内容，也不需要再次读取文件。
+    输入是按文本模式统一换行后的文件字节（只有 \n 换行，例如 ContextWriter 复制时写出的内容），分多次 feed，最后调用 finish。
+    与 MarkerLineScanner 一样只解码行首为 # 或 -- 的候选行交给 LineClassifier，其余内容直接按字节送入当前块的摘要。
+    结果与 FileParser.parse_org_file 之后逐块计算 block_digest 相同，包括块的顺序与 validate_and_sort_blocks 的校验。
+    偏移以 base 为起点（feed 的第一个字节的偏移），例如文件内容在输出文件中的位置。
+
+    >>> scanner = BlockDigestScanner("2024-01.md", base=100)
+    >>> for piece in ["## -- 群\n-- 2024-01-02 03:04\n甲\n-- 2024-01", "-01 09:00\n乙"]:
+    ...     scanner.feed(piece.encode('utf-8'))
+    >>> [(block.time_tag, digest == block_digest(ChatBlock("群", block.time_tag, [text], "")), start, end)
+    ...  for (block, digest, start, end), text in zip(scanner.finish(), ["乙", "甲\n"])]
+    [('2024-01-01 09:00', True, 154, 157), ('2024-01-02 03:04', True, 130, 134)]
+    >>> scanner = BlockDigestScanner("2024-01.md")
+    >>> scanner.feed("## -- 群\n-- 2024-01-02 03:04\n## -- 另一个群\n-- 2024-01-03 03:04\n".encode('utf-8'))
+    >>> scanner.finish()
+    Traceback (most recent call last):
+    ...
+    ValueError: 整理后的文件应该只包含一个 chat，但找到多个不同的 chat
+    """
+
+    def __init__(self, file_path: str, base: int = 0, fallback_year: Optional[int] = None):
+        self.file_path = file_path
+        self.start = base
+        self.pos = base  # 下一个尚未处理的字节（carry 的起点）的偏移
+        self._classify = LineClassifier(fallback_year=fallback_year).classify
+        self._carry = b""  # 还没有遇到换行符的最后一行
+        self._frontmatter: Optional[bool] = None  # None: 还没有处理第一行；True: 处于 frontmatter 中
+        self._chat_name: Optional[str] = None
+        self._time_tag: Optional[str] = None
+        self._digest = None  # 当前块（有聊天名称与时间标签时）的摘要
+        self._content_start = 0
+        self._blocks: List[Tuple[ChatBlock, str, int, int]] = []
+        self._file_digest = hashlib.sha256()
+        self._error: Optional[ValueError] = None
+
+    def feed(self, data: bytes):
+        self._file_digest.update(data)
+        if self._error is not None:
+            return
+        data = self._carry + data if self._carry else data
+        cut = data.rfind(b"\n") + 1
+        self._carry = data[cut:]
+        if cut:
+            self._scan(data[:cut])
+
+    def finish(self) -> List[Tuple[ChatBlock, str, int, int]]:
+        """
+        处理最后一行，返回按时间排序的 [(ChatBlock（不含内容）, 摘要, 内容起点, 内容终点), ...]。
+        文件不是有效的整理后文件时（parse_org_file 会报错的情况）抛出 ValueError。
+        """
+        if self._carry and self._error is None:
+            self._scan(self._carry)
+            self._carry = b""
+        if self._error is not None:
+            raise self._error
+        self._close_block(self.pos)
+        org_file = ChatOrgFile(self.file_path)
+        org_file.chat_blocks = [block for block, _, _, _ in self._blocks]
+        org_file.validate_and_sort_blocks()
+        position = {id(block): i for i, block in enumerate(org_file.chat_blocks)}
+        return sorted(self._blocks, key=lambda record: position[id(record[0])])
+
+    def file_digest(self) -> str:
+        """
+        已 feed 的全部字节的 SHA-256。
+        """
+        return self._file_digest.hexdigest()
+
+    def _close_block(self, end: int):
+        if self._digest is not None:
+            block = ChatBlock(self._chat_name, self._time_tag, [], self.file_path)
+            self._blocks.append((block, self._digest.hexdigest(), self._content_start, end))
+            self._digest = None
+
+    def _scan(self, region: bytes):
+        # region 由完整的行组成（只有文件的最后一行可以没有换行符）
+        base = self.pos
+        self.pos += len(region)
+        pos = 0
+        if self._frontmatter is None:
+            first_end = region.find(b"\n") + 1 or len(region)
+            self._frontmatter = RegexPatterns.is_frontmatter(str(region[:first_end], 'utf-8'))
+            if self._frontmatter:
+                pos = first_end
+        content_from = pos
+        try:
+            for start, end in self._marker_lines(region, pos):
+                line = str(region[start:end], 'utf-8')
+                if self._frontmatter:
+                    if RegexPatterns.is_frontmatter(line):
+                        self._frontmatter = False
+                        content_from = end
+                    continue
+                kind, value = self._classify(line, self._time_tag)
+                if kind == LineClassifier.CONTENT:
+                    continue
+                if self._digest is not None:
+                    self._digest.update(region[content_from:start])
+                self._close_block(base + start)
+                if kind == LineClassifier.CHAT:
+                    self._chat_name, self._time_tag = value, None
+                else:
+                    self._time_tag = value
+                if self._chat_name is not None and self._time_tag is not None:
+                    self._digest = hashlib.sha256()
+                    self._digest.update(self._chat_name.encode('utf-8') + b"\0" + self._time_tag.encode('utf-8') + b"\0")
+                    self._content_start = base + end
+                content_from = end
+        except ValueError as e:
+            # 与 parse_org_file 相同，无法解析的时间标签使整个文件无效
+            self._error = e
+            return
+        if not self._frontmatter and self._digest is not None:
+            self._digest.update(region[content_from:])
+
+    @staticmethod
+    def _marker_lines(region: bytes, pos: int) -> Iterator[Tuple[int, int]]:
+        # 与 MarkerLineScanner.iter_marker_lines 相同；region 从行首开始
+        size = len(region)
+        if pos == 0 and MarkerLineScanner._FIRST_MARKER.match(region, 0):
+            end = region.find(b"\n", 0)
+            yield 0, size if end == -1 else end + 1
+        for m in MarkerLineScanner._MARKER.finditer(region, max(pos - 1, 0)):
+            start = m.start() + 1
+            if start < pos:
+                continue
+            end = region.find(b"\n", start)
+            yield start, size if end == -1 else end + 1
+
+
 class FileParser:
     """
     解析器类，提供静态方法解析原始和整理后的聊天记录文件。
@@ -310,63 +954,81 @@ class FileParser:
     def parse_raw_file(file_path: str, fallback_year: Optional[int] = None) -> ChatRawFile:
         """
         解析原始聊天记录文件，提取其中的 ChatBlock 列表。
+        逐块解析逻辑见 FileParser.iter_blocks，这里只是把所有块收集起来。
+        """
+        raw_file = ChatRawFile(file_path)
+        raw_file.chat_blocks = list(FileParser.iter_raw_blocks(file_path, fallback_year=fallback_year))
+        return raw_file
+
+    @staticmethod
+    def iter_raw_blocks(file_path: str, fallback_year: Optional[int] = None) -> Iterator[ChatBlock]:
+        """
+        parse_raw_file 的生成器版本：逐行读取文件，每解析完一个 ChatBlock 就 yield 出去。
+        内存占用只和当前块的大小有关，和文件大小无关。
+        """
+        if MarkerLineScanner.can_scan(file_path):
+            yield from MarkerLineScanner(file_path, fallback_year=fallback_year).iter_blocks()
+            return
+        with open(file_path, 'r', encoding='utf-8') as f:
+            yield from FileParser.iter_blocks(f, file_path, fallback_year=fallback_year)
+
+    @staticmethod
+    def iter_blocks(lines: Iterable[str], file_path: str, fallback_year: Optional[int] = None) -> Iterator[ChatBlock]:
+        """
+        从行序列（文件对象、行列表均可）中逐个解析出 ChatBlock。
 
         1. 如果内容第一行是 frontmatter, 跳过前后 frontmatter 部分
         2. 设置 last_chat_name 是 None，last_time_tag 是 None, current_content 是 []
-        3. 遍历每一行，使用 RegexPatterns.extract_chat_name 判断是否为 chat_name 行。
-            - 如果是，说明这是一个新的 chat 块的开始。将之前的块（如果存在）保存到 chat_blocks 中，然后重置 last_time_tag=None, current_content=[]；更新 last_chat_name。
-            - 否则，使用 RegexPatterns.extract_time_tag 判断是否为 time_tag 行（传递当前的 last_time_tag 作为 ref_time）。
-                - 如果是，说明这是一个新的时间块的开始。将之前的块（如果存在）保存到 chat_blocks 中，然后重置 current_content；更新 last_time_tag。
+        3. 遍历每一行，使用 LineClassifier 单趟判断（等价于先 RegexPatterns.extract_chat_name 再 RegexPatterns.extract_time_tag）是否为 chat_name 行。
+            - 如果是，说明这是一个新的 chat 块的开始。将之前的块（如果存在）yield 出去，然后重置 last_time_tag=None, current_content=[]；更新 last_chat_name。
+            - 否则，判断是否为 time_tag 行（传递当前的 last_time_tag 作为 ref_time）。
+                - 如果是，说明这是一个新的时间块的开始。将之前的块（如果存在）yield 出去，然后重置 current_content；更新 last_time_tag。
                 - 否则，将该行添加到 current_content 中。
-        4. 最后将最后一个块（如果存在）保存到 chat_blocks 中。
+        4. 最后将最后一个块（如果存在）yield 出去。
         """
-        raw_file = ChatRawFile(file_path)
-
-        with open(file_path, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        line_iter = iter(lines)
 
         # 跳过 frontmatter
-        start_idx = 0
-        if lines and RegexPatterns.is_frontmatter(lines[0]):
-            start_idx = 1
-            while start_idx < len(lines) and not RegexPatterns.is_frontmatter(lines[start_idx]):
-                start_idx += 1
-            start_idx += 1  # 跳过结束的 frontmatter 标记
+        first_line = next(line_iter, None)
+        if first_line is None:
+            return
+        if RegexPatterns.is_frontmatter(first_line):
+            for line in line_iter:
+                if RegexPatterns.is_frontmatter(line):
+                    break
+        else:
+            line_iter = itertools.chain((first_line,), line_iter)
 
         last_chat_name = None
         last_time_tag = None
         current_content = []
 
-        for line in lines[start_idx:]:
-            is_chat, chat_name = RegexPatterns.extract_chat_name(line)
-            if is_chat:
-                # 立即进行转义处理
-                chat_name = RegexPatterns.chat_name_sanitize(chat_name)
-                # 保存之前的块
+        classifier = LineClassifier(fallback_year=fallback_year)
+        classify = classifier.classify
+        for line in line_iter:
+            kind, value = classify(line, last_time_tag)
+            if kind == LineClassifier.CONTENT:
+                # 普通内容行
+                current_content.append(line)
+            elif kind == LineClassifier.CHAT:
+                # 产出之前的块（聊天名称已由分类器转义）
                 if last_chat_name is not None and last_time_tag is not None:
-                    raw_file.chat_blocks.append(ChatBlock(last_chat_name, last_time_tag, current_content, file_path))
+                    yield ChatBlock(last_chat_name, last_time_tag, current_content, file_path)
                 # 重置状态
-                last_chat_name = chat_name
+                last_chat_name = value
                 last_time_tag = None
                 current_content = []
             else:
-                is_time, time_tag = RegexPatterns.extract_time_tag(line, last_time_tag, fallback_year=fallback_year)
-                if is_time:
-                    # 保存之前的块
-                    if last_chat_name is not None and last_time_tag is not None:
-                        raw_file.chat_blocks.append(ChatBlock(last_chat_name, last_time_tag, current_content, file_path))
-                    # 更新时间标签并重置内容
-                    last_time_tag = time_tag
-                    current_content = []
-                else:
-                    # 普通内容行
-                    current_content.append(line)
+                # 产出之前的块
+                if last_chat_name is not None and last_time_tag is not None:
+                    yield ChatBlock(last_chat_name, last_time_tag, current_content, file_path)
+                # 更新时间标签并重置内容
+                last_time_tag = value
+                current_content = []
 
-        # 保存最后一个块
+        # 产出最后一个块
         if last_chat_name is not None and last_time_tag is not None:
-            raw_file.chat_blocks.append(ChatBlock(last_chat_name, last_time_tag, current_content, file_path))
-
-        return raw_file
+            yield ChatBlock(last_chat_name, last_time_tag, current_content, file_path)
 
     @staticmethod
     def parse_org_file(file_path: str, fallback_year: Optional[int] = None) -> ChatOrgFile:
@@ -380,6 +1042,438 @@ class FileParser:
         org_file.validate_and_sort_blocks()
         return org_file
 
+    @staticmethod
+    def parse_org_chat(chat_dir: str, start_dt: Optional[datetime] = None, end_dt: Optional[datetime] = None,
+                       fallback_year: Optional[int] = None) -> ChatOrgFile:
+        """
+        按群聊目录的分片清单（ShardLayout）解析整个群聊（或与 start_dt / end_dt 相交的分片），合并为一个按时间排序的 ChatOrgFile。
+        """
+        org_file = ChatOrgFile(chat_dir)
+        for file_path in ShardLayout.load(chat_dir).shard_files(chat_dir, start_dt, end_dt):
+            org_file.chat_blocks.extend(FileParser.parse_org_file(file_path, fallback_year=fallback_year).chat_blocks)
+        org_file.validate_and_sort_blocks()
+        return org_file
+
+    @staticmethod
+    def parse_org_lines(lines: Iterable[str], file_path: str, fallback_year: Optional[int] = None) -> ChatOrgFile:
+        """
+        与 parse_org_file 相同，但解析的是已经在内存中的行（例如合并过程中尚未写回的目标文件缓冲）。
+        """
+        org_file = ChatOrgFile(file_path)
+        org_file.chat_blocks = list(FileParser.iter_blocks(lines, file_path, fallback_year=fallback_year))
+        org_file.validate_and_sort_blocks()
+        return org_file
+
+
+class ShardLayout:
+    """
+    整理后聊天记录的分片粒度。每个群聊目录下可以有一个 _shard.yaml 清单声明粒度，没有清单时为 month：
+    - month: {YYYY-MM}.md
+    - week:  {YYYY}-W{WW}.md（ISO 周，周一开始；跨年的周归属 ISO 年）
+    - day:   {YYYY-MM-DD}.md
+    群聊目录中只有与清单粒度一致的分片文件有效；文件名不是分片名称的 .md 文件照旧读取。
+    重新分片见 workflows/util_reshard/SCRIPT_reshard.py。
+
+    >>> ShardLayout("week").shard_name(datetime(2024, 12, 30, 9, 0))
+    '2025-W01'
+    >>> ShardLayout.parse_shard_name("2025-W01")
+    ('week', datetime.datetime(2024, 12, 30, 0, 0), datetime.datetime(2025, 1, 6, 0, 0))
+    >>> ShardLayout.parse_shard_name("2024-12")
+    ('month', datetime.datetime(2024, 12, 1, 0, 0), datetime.datetime(2025, 1, 1, 0, 0))
+    >>> ShardLayout.parse_shard_name("2024-02-30") is None
+    True
+    """
+
+    GRANULARITIES = ("month", "week", "day")
+    DEFAULT_GRANULARITY = "month"
+
+    _SHARD_NAME_PATTERN = re.compile(r"^(\d{4})-(?:(\d{2})|W(\d{2})|(\d{2})-(\d{2}))$")
+    # 群聊目录 -> (清单 mtime_ns, ShardLayout)，清单变化时重新读取
+    _cache: Dict[str, Tuple[Optional[int], 'ShardLayout']] = {}
+
+    def __init__(self, granularity: str = DEFAULT_GRANULARITY):
+        if granularity not in ShardLayout.GRANULARITIES:
+            raise ValueError(f"未知的分片粒度 '{granularity}'，可选: {', '.join(ShardLayout.GRANULARITIES)}")
+        self.granularity = granularity
+
+    @classmethod
+    def load(cls, chat_dir: str) -> 'ShardLayout':
+        """
+        读取群聊目录的分片清单（不存在时为默认的 month 粒度）。结果按清单的 mtime 缓存，ingest 按块解析路径时不会反复读取。
+        """
+        manifest_path = KnowledgeBasePaths.get_org_shard_manifest_path(chat_dir)
+        try:
+            mtime_ns = os.stat(manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            mtime_ns = None
+        cached = cls._cache.get(chat_dir)
+        if cached and cached[0] == mtime_ns:
+            return cached[1]
+        layout = cls()
+        if mtime_ns is not None:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = yaml.safe_load(f) or {}
+            layout = cls(manifest.get("granularity", cls.DEFAULT_GRANULARITY))
+        cls._cache[chat_dir] = (mtime_ns, layout)
+        return layout
+
+    def save(self, chat_dir: str):
+        """
+        写出群聊目录的分片清单（先写临时文件再替换）。
+        """
+        manifest_path = KnowledgeBasePaths.get_org_shard_manifest_path(chat_dir)
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            yaml.safe_dump({"granularity": self.granularity}, f, allow_unicode=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, manifest_path)
+        ShardLayout._cache.pop(chat_dir, None)
+
+    def shard_name(self, dt: datetime) -> str:
+        """
+        dt 所在分片的名称（不含 .md 后缀）。
+        """
+        if self.granularity == "day":
+            return dt.strftime("%Y-%m-%d")
+        if self.granularity == "week":
+            iso_year, iso_week, _ = dt.isocalendar()
+            return f"{iso_year:04d}-W{iso_week:02d}"
+        return dt.strftime("%Y-%m")
+
+    def shard_file_path(self, chat_dir: str, time_tag: str) -> str:
+        """
+        时间标签为 time_tag（"YYYY-MM-DD HH:MM" 或 "YYYY-MM-DD"）的块所在分片文件的路径。
+        """
+        try:
+            dt = datetime.strptime(time_tag, "%Y-%m-%d %H:%M")
+        except ValueError:
+            dt = datetime.strptime(time_tag, "%Y-%m-%d")
+        return os.path.join(chat_dir, f"{self.shard_name(dt)}.md")
+
+    @staticmethod
+    def parse_shard_name(name: str) -> Optional[Tuple[str, datetime, datetime]]:
+        """
+        解析分片名称（不含 .md 后缀），返回 (粒度, 起始时间, 结束时间)，时间范围左闭右开；不是分片名称时返回 None。
+        """
+        m = ShardLayout._SHARD_NAME_PATTERN.match(name)
+        if not m:
+            return None
+        year, month, week, day_month, day = m.groups()
+        try:
+            if month:
+                start = datetime(int(year), int(month), 1)
+                end = datetime(int(year) + (start.month == 12), start.month % 12 + 1, 1)
+                return "month", start, end
+            if week:
+                start = datetime.fromisocalendar(int(year), int(week), 1)
+                return "week", start, start + timedelta(days=7)
+            start = datetime(int(year), int(day_month), int(day))
+            return "day", start, start + timedelta(days=1)
+        except ValueError:
+            return None
+
+    def shard_files(self, chat_dir: str, start_dt: Optional[datetime] = None, end_dt: Optional[datetime] = None) -> List[str]:
+        """
+        群聊目录中有效的 .md 文件路径，分片按时间顺序排列，其他 .md 文件排在最后（按名称）。
+        给出 start_dt / end_dt（闭区间）时跳过时间范围不相交的分片。
+        其他粒度的分片（例如重新分片中断后残留的旧文件）不会返回。
+        """
+        if not os.path.isdir(chat_dir):
+            return []
+        entries = []
+        for file_name in os.listdir(chat_dir):
+            stem, ext = os.path.splitext(file_name)
+            if ext != ".md" or file_name.startswith("."):
+                continue
+            shard = ShardLayout.parse_shard_name(stem)
+            if shard is None:
+                entries.append((datetime.max, file_name))
+                continue
+            granularity, shard_start, shard_end = shard
+            if granularity != self.granularity:
+                continue
+            if (start_dt and shard_end <= start_dt) or (end_dt and shard_start > end_dt):
+                continue
+            entries.append((shard_start, file_name))
+        return [os.path.join(chat_dir, file_name) for _, file_name in sorted(entries)]
+
+
+class TimelineIndex:
+    r"""
+    群聊的时间线索引（见 KnowledgeBasePaths.get_org_timeline_index_path）：群聊各文件中每个时间标签行的
+    (分钟数, 行号, 字节偏移)，分钟数见 ChatBlock.epoch_minutes。
+    ingest 写回分片时同步更新；缺口检查、按时间范围筛选直接读取索引，不必重新读取全部文件。
+    每个文件一段，段内按 (分钟数, 行号) 排序，并记录文件大小与 mtime：写回一个分片只替换对应的段；
+    load 时只重新扫描缺失或发生变化的文件（索引不存在或损坏时扫描全部文件）。
+    时间标签行的判定与 02_gap_check 相同：去掉首尾空白后以 "--" 开头，紧跟有效的 "YYYY-MM-DD HH:MM"（之后允许有其他内容）。
+
+    文件格式（小端）：
+    - header: magic(8s) version(u32) file_count(u32)
+    - files: file_count × [name_len(u16) name(utf-8) size(u64) mtime_ns(u64) entry_count(u64)]
+    - 每个文件依次为 minutes: entry_count × i64，line_nos: entry_count × u32，offsets: entry_count × u64
+
+    >>> index = TimelineIndex()
+    >>> data = "## -- 群\n-- 2024-01-02 03:04\n甲\n  -- 2024-01-01 09:00 补充\n-- 2024-02-30 10:00\n".encode('utf-8')
+    >>> index.update_file("2024-01.md", data, 0)
+    >>> [(TimelineIndex.to_datetime(m).strftime("%d %H:%M"), name, line, offset) for m, name, line, offset in index.entries()]
+    [('01 09:00', '2024-01.md', 3, 34), ('02 03:04', '2024-01.md', 1, 10)]
+    """
+
+    MAGIC = b"IMKBTLIX"
+    VERSION = 1
+    _HEADER = struct.Struct("<8sII")
+    _FILE_ENTRY = struct.Struct("<QQQ")
+    # 候选行：开头的空白（与 str.strip 相同的 Unicode 空白，换行符除外）之后是 "--"；候选行再解码按 _TAG_TEXT 判定
+    _TAG_CANDIDATE = re.compile(
+        rb"^(?:[\t\x0b\x0c\x1c-\x1f ]|\xc2[\x85\xa0]|\xe1\x9a\x80|\xe2\x80[\x80-\x8a\xa8\xa9\xaf]|\xe2\x81\x9f|\xe3\x80\x80)*--",
+        re.M)
+    _TAG_TEXT = re.compile(r"^--\s*(\d{4}-\d{2}-\d{2})\s+(\d{2}:\d{2})")
+    _NEWLINE = re.compile(rb"\r\n|\r|\n")  # 与文本模式读取（universal newlines）的断行规则一致
+    _VALIDATE_CHUNK = 1 << 20
+
+    def __init__(self):
+        # 文件名 -> (size, mtime_ns, minutes, line_nos, offsets)
+        self.segments: Dict[str, Tuple[int, int, array, array, array]] = {}
+
+    @staticmethod
+    def to_datetime(minutes: int) -> datetime:
+        return datetime(1970, 1, 1) + timedelta(minutes=minutes)
+
+    @staticmethod
+    def to_minutes(dt: datetime) -> int:
+        return (dt - datetime(1970, 1, 1)) // timedelta(minutes=1)
+
+    @classmethod
+    def tag_minutes(cls, line: str) -> Optional[int]:
+        r"""
+        时间标签行的分钟数，不是时间标签行时返回 None。判定与 02_gap_check 相同：
+        line.strip() 匹配 _TAG_TEXT（\s、\d 为 Unicode 语义），且 "YYYY-MM-DD HH:MM" 能被 strptime 解析。
+
+        >>> TimelineIndex.tag_minutes("\u3000-- 2024-01-01 00:01 补充") == TimelineIndex.to_minutes(datetime(2024, 1, 1, 0, 1))
+        True
+        >>> TimelineIndex.tag_minutes("--2024-13-01 00:01") is None
+        True
+        """
+        m = cls._TAG_TEXT.match(line.strip())
+        if m is None:
+            return None
+        tag = f"{m.group(1)} {m.group(2)}"
+        if tag.isascii():
+            return ChatBlock.epoch_minutes(tag)
+        try:
+            return cls.to_minutes(datetime.strptime(tag, "%Y-%m-%d %H:%M"))
+        except ValueError:
+            return None
+
+    @classmethod
+    def scan(cls, data: bytes) -> List[Tuple[int, int, int]]:
+        r"""
+        扫描文件字节，返回全部有效时间标签行的 (分钟数, 行号, 字节偏移)，按行号排列。
+        只有 \n 换行的文件先在字节上找候选行（_TAG_CANDIDATE）；含 \r 的文件按 universal newlines 断行后逐行判定。
+        两种情况都由 tag_minutes 判定，结果与换行方式无关。
+        data 不是有效的 UTF-8 时抛出 UnicodeDecodeError（与按文本读取整个文件时一样）。
+
+        >>> lf = "-- 2024-01-01 10:00\n\u3000-- 2024-01-02 10:00\n\u3000甲\n".encode('utf-8')
+        >>> [(m, line) for m, line, _ in TimelineIndex.scan(lf)] == [(m, line) for m, line, _ in TimelineIndex.scan(lf.replace(b"\n", b"\r\n"))]
+        True
+        >>> [line for _, line, _ in TimelineIndex.scan(lf)]
+        [0, 1]
+        >>> TimelineIndex.scan(lf + b"\xff")
+        Traceback (most recent call last):
+        ...
+        UnicodeDecodeError: 'utf-8' codec can't decode byte 0xff in position 50: invalid start byte
+        """
+        # 分块校验，不把整个文件解码成 str
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        view = memoryview(data)
+        for pos in range(0, len(data), cls._VALIDATE_CHUNK):
+            decoder.decode(view[pos:pos + cls._VALIDATE_CHUNK])
+        decoder.decode(b"", final=True)
+        tags = []
+        if b"\r" not in data:
+            line_no, pos = 0, 0
+            for m in cls._TAG_CANDIDATE.finditer(data):
+                start = m.start()
+                line_no += data.count(b"\n", pos, start)
+                pos = start
+                end = data.find(b"\n", start)
+                line = data[start:end if end >= 0 else len(data)].decode('utf-8')
+                minutes = cls.tag_minutes(line)
+                if minutes is not None:
+                    tags.append((minutes, line_no, start))
+            return tags
+        starts = [0] + [m.end() for m in cls._NEWLINE.finditer(data)]
+        for line_no, (start, end) in enumerate(zip(starts, starts[1:] + [len(data)])):
+            if start == end:
+                continue
+            minutes = cls.tag_minutes(data[start:end].decode('utf-8'))
+            if minutes is not None:
+                tags.append((minutes, line_no, start))
+        return tags
+
+    def update_file(self, name: str, data: bytes, mtime_ns: int):
+        """
+        用文件的最新内容 data（mtime_ns 为写入后的 mtime）替换该文件的段。
+        data 不是有效的 UTF-8 时抛出 UnicodeDecodeError，原有的段不变。
+        """
+        tags = sorted(self.scan(data))
+        self.segments[name] = (len(data), mtime_ns, array('q', [t[0] for t in tags]),
+                               array('I', [t[1] for t in tags]), array('Q', [t[2] for t in tags]))
+
+    def entries(self, start_dt: Optional[datetime] = None, end_dt: Optional[datetime] = None) -> List[Tuple[int, str, int, int]]:
+        """
+        时间在 [start_dt, end_dt]（闭区间，缺省为不限）内的 (分钟数, 文件名, 行号, 字节偏移)，按 (分钟数, 文件名, 行号) 排序。
+        """
+        lo_minutes = self.to_minutes(start_dt) if start_dt else None
+        hi_minutes = self.to_minutes(end_dt) if end_dt else None
+        rows = []
+        for name, (_, _, minutes, line_nos, offsets) in self.segments.items():
+            lo = bisect.bisect_left(minutes, lo_minutes) if lo_minutes is not None else 0
+            hi = bisect.bisect_right(minutes, hi_minutes) if hi_minutes is not None else len(minutes)
+            rows.extend((minutes[i], name, line_nos[i], offsets[i]) for i in range(lo, hi))
+        # 段内有序、分片之间按时间有序，timsort 对这样的输入接近线性
+        rows.sort()
+        return rows
+
+    def columns(self, start_dt: Optional[datetime] = None, end_dt: Optional[datetime] = None) -> Tuple[List[str], array, array, array, array]:
+        r"""
+        与 entries 相同的标签、相同的顺序，按列返回，不为每个标签创建元组：
+        (文件名列表, 文件序号 'I'（文件名列表的下标）, 分钟数 'q', 行号 'I', 字节偏移 'Q')。
+        分钟数列可以零拷贝地转换为 int64 的 numpy 数组。
+
+        >>> index = TimelineIndex()
+        >>> index.update_file("2024-02.md", b"-- 2024-02-01 10:00\n-- 2024-02-03 10:00\n", 0)
+        >>> index.update_file("2024-01.md", b"-- 2024-02-02 10:00\n", 0)
+        >>> names, file_ids, minutes, line_nos, offsets = index.columns()
+        >>> [(minutes[i], names[file_ids[i]], line_nos[i], offsets[i]) for i in range(len(minutes))] == index.entries()
+        True
+        """
+        lo_minutes = self.to_minutes(start_dt) if start_dt else None
+        hi_minutes = self.to_minutes(end_dt) if end_dt else None
+        names = sorted(self.segments)
+        file_ids, minutes, line_nos, offsets = array('I'), array('q'), array('I'), array('Q')
+        ordered = True
+        for file_id, name in enumerate(names):
+            _, _, seg_minutes, seg_line_nos, seg_offsets = self.segments[name]
+            lo = bisect.bisect_left(seg_minutes, lo_minutes) if lo_minutes is not None else 0
+            hi = bisect.bisect_right(seg_minutes, hi_minutes) if hi_minutes is not None else len(seg_minutes)
+            if lo == hi:
+                continue
+            # 段内按 (分钟数, 行号) 有序；各段按文件名拼接后，只要相邻段在时间上不重叠，整体就已经按 (分钟数, 文件名, 行号) 有序
+            if minutes and seg_minutes[lo] < minutes[-1]:
+                ordered = False
+            file_ids.extend(array('I', [file_id]) * (hi - lo))
+            minutes.extend(seg_minutes[lo:hi])
+            line_nos.extend(seg_line_nos[lo:hi])
+            offsets.extend(seg_offsets[lo:hi])
+        if not ordered:
+            order = sorted(range(len(minutes)), key=lambda i: (minutes[i], file_ids[i], line_nos[i]))
+            file_ids, minutes, line_nos, offsets = (array(column.typecode, (column[i] for i in order))
+                                                    for column in (file_ids, minutes, line_nos, offsets))
+        return names, file_ids, minutes, line_nos, offsets
+
+    def sync(self, chat_dir: str, start_dt: Optional[datetime] = None, end_dt: Optional[datetime] = None,
+             fallback: Optional['TimelineIndex'] = None) -> int:
+        """
+        使索引与群聊目录中的有效文件（ShardLayout.shard_files）一致：重新扫描新增或大小/mtime 变化的文件，删除已不存在的文件。
+        给出 start_dt / end_dt 时按分片文件名剪枝，只检查与范围相交的文件，其余文件的段直接丢弃
+        （剪枝后的索引只用于读取，不要写回）。fallback 中大小与 mtime 相符的段直接复用，不重新扫描。
+        不是有效 UTF-8 的文件报告到 stderr 后跳过（不进入索引，下次同步时重新检查）。
+        返回重新扫描的文件数。
+        """
+        current = {os.path.basename(path): path for path in ShardLayout.load(chat_dir).shard_files(chat_dir, start_dt, end_dt)}
+        for name in [name for name in self.segments if name not in current]:
+            del self.segments[name]
+        scanned = 0
+        for name, path in current.items():
+            st = os.stat(path)
+            if self.segments.get(name, (None, None))[:2] == (st.st_size, st.st_mtime_ns):
+                continue
+            if fallback and fallback.segments.get(name, (None, None))[:2] == (st.st_size, st.st_mtime_ns):
+                self.segments[name] = fallback.segments[name]
+                continue
+            with open(path, 'rb') as f:
+                st = os.fstat(f.fileno())
+                data = f.read()
+            try:
+                self.update_file(name, data, st.st_mtime_ns)
+            except UnicodeDecodeError as e:
+                print(f"Error reading {path}: {e}", file=sys.stderr)
+                self.segments.pop(name, None)
+                continue
+            scanned += 1
+        return scanned
+
+    @classmethod
+    def load(cls, chat_dir: str, start_dt: Optional[datetime] = None, end_dt: Optional[datetime] = None) -> 'TimelineIndex':
+        """
+        读取群聊的时间线索引并与目录同步（见 sync，给出时间范围时只保留与范围相交的分片），不写回。
+        索引不存在或损坏时相当于扫描全部（相交的）文件。
+        """
+        index = cls.read(KnowledgeBasePaths.get_org_timeline_index_path(chat_dir)) or cls()
+        if os.path.isdir(chat_dir):
+            index.sync(chat_dir, start_dt, end_dt)
+        return index
+
+    @classmethod
+    def read(cls, path: str) -> Optional['TimelineIndex']:
+        """
+        读取索引文件。文件不存在、版本不符或内容损坏时返回 None。
+        """
+        try:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            magic, version, file_count = cls._HEADER.unpack_from(raw)
+            if magic != cls.MAGIC or version != cls.VERSION:
+                return None
+            pos = cls._HEADER.size
+            files = []
+            for _ in range(file_count):
+                (name_len,) = struct.unpack_from("<H", raw, pos)
+                name = raw[pos + 2:pos + 2 + name_len].decode('utf-8')
+                pos += 2 + name_len
+                files.append((name,) + cls._FILE_ENTRY.unpack_from(raw, pos))
+                pos += cls._FILE_ENTRY.size
+            index = cls()
+            for name, size, mtime_ns, count in files:
+                arrays = []
+                for typecode in ('q', 'I', 'Q'):
+                    arr = array(typecode)
+                    end = pos + arr.itemsize * count
+                    if end > len(raw):
+                        return None
+                    arr.frombytes(raw[pos:end])
+                    if sys.byteorder != 'little':
+                        arr.byteswap()
+                    arrays.append(arr)
+                    pos = end
+                index.segments[name] = (size, mtime_ns, *arrays)
+        except (OSError, struct.error, ValueError):
+            return None
+        return index
+
+    def write(self, path: str):
+        """
+        写出索引文件（先写临时文件再替换，避免留下写了一半的索引）。
+        """
+        names = sorted(self.segments)
+        parts = [self._HEADER.pack(self.MAGIC, self.VERSION, len(names))]
+        for name in names:
+            size, mtime_ns, minutes = self.segments[name][:3]
+            encoded = name.encode('utf-8')
+            parts.append(struct.pack("<H", len(encoded)) + encoded + self._FILE_ENTRY.pack(size, mtime_ns, len(minutes)))
+        for name in names:
+            for arr in self.segments[name][2:]:
+                if sys.byteorder != 'little':
+                    arr = array(arr.typecode, arr)
+                    arr.byteswap()
+                parts.append(arr.tobytes())
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(b"".join(parts))
+        os.replace(tmp_path, path)
+
 
 class KnowledgeBasePaths:
     """
@@ -406,6 +1500,38 @@ class KnowledgeBasePaths:
         os.makedirs(os.path.dirname(path), exist_ok=True)
         return path
 
+    @staticmethod
+    def get_task_journal_path(task_run_dir: str, compressed: bool = False) -> str:
+        """
+        根据任务运行目录生成运行日志（journal）路径，压缩时附加 .zst 后缀。
+        例如： {task_run_dir}/journal.jsonl
+        """
+        return os.path.join(task_run_dir, "journal.jsonl.zst" if compressed else "journal.jsonl")
+
+    @staticmethod
+    def get_task_summary_path(task_run_dir: str) -> str:
+        """
+        根据任务运行目录生成运行摘要（各阶段耗时与计数）路径。
+        例如： {task_run_dir}/summary.json
+        """
+        return os.path.join(task_run_dir, "summary.json")
+
+    @staticmethod
+    def get_task_profile_path(task_run_dir: str) -> str:
+        """
+        根据任务运行目录生成 cProfile 统计文件路径（可用 python -m pstats 查看）。
+        例如： {task_run_dir}/profile.pstats
+        """
+        return os.path.join(task_run_dir, "profile.pstats")
+
+    @staticmethod
+    def get_task_trace_path(task_run_dir: str) -> str:
+        """
+        根据任务运行目录生成 Chrome trace 文件路径（可在 chrome://tracing 或 Perfetto 中打开）。
+        例如： {task_run_dir}/trace.json
+        """
+        return os.path.join(task_run_dir, "trace.json")
+
     @staticmethod
     def get_task_merged_chunk_path(task_run_dir: str, chunk_name: str) -> str:
         """
@@ -417,19 +1543,55 @@ class KnowledgeBasePaths:
         return path
 
     @staticmethod
-    def get_org_file_path(knowledge_base_dir: str, chat_name: str, dt: str) -> str:
+    def get_org_chat_dir(knowledge_base_dir: str, chat_name: str) -> str:
         """
-        根据聊天名称和日期时间生成整理后文件路径。
+        根据聊天名称生成整理后的群聊目录路径。
+        例如： kb/01-chats-input-organized/{chat_name}
+        """
+        return os.path.join(knowledge_base_dir, "01-chats-input-organized", RegexPatterns.chat_name_sanitize(chat_name))
+
+    @staticmethod
+    def get_org_shard_manifest_path(chat_dir: str) -> str:
+        """
+        群聊目录的分片清单路径（见 ShardLayout）。
+        例如： kb/01-chats-input-organized/{chat_name}/_shard.yaml
+        """
+        return os.path.join(chat_dir, "_shard.yaml")
+
+    @staticmethod
+    def get_org_timeline_index_path(chat_dir: str) -> str:
+        """
+        群聊目录的时间线索引路径（见 TimelineIndex）。
+        例如： kb/01-chats-input-organized/{chat_name}/_timeline.idx
+        """
+        return os.path.join(chat_dir, "_timeline.idx")
+
+    @staticmethod
+    def get_org_file_path(knowledge_base_dir: str, chat_name: str, dt: str, layout: Optional[ShardLayout] = None) -> str:
+        """
+        根据聊天名称和日期时间生成整理后文件路径，分片粒度由群聊目录的分片清单决定（或由 layout 指定）。
         例如： kb/01-chats-input-organized/{chat_name}/{YYYY-MM}.md
         """
-        sanitized_chat_name = RegexPatterns.chat_name_sanitize(chat_name)
-        try:
-            dt_obj = datetime.strptime(dt, "%Y-%m-%d %H:%M")
-        except ValueError:
-            dt_obj = datetime.strptime(dt, "%Y-%m-%d")
+        chat_dir = KnowledgeBasePaths.get_org_chat_dir(knowledge_base_dir, chat_name)
+        return (layout or ShardLayout.load(chat_dir)).shard_file_path(chat_dir, dt)
+
+    @staticmethod
+    def get_org_hash_index_path(org_file_path: str) -> str:
+        """
+        整理后文件的行 hash 索引（sidecar）路径，与文件放在同一目录下的隐藏文件。
+        例如： kb/01-chats-input-organized/{chat_name}/.{YYYY-MM}.md.hashidx
+        """
+        dir_name, base_name = os.path.split(org_file_path)
+        return os.path.join(dir_name, f".{base_name}.hashidx")
 
-        date_str = dt_obj.strftime("%Y-%m")
-        return os.path.join(knowledge_base_dir, "01-chats-input-organized", sanitized_chat_name, f"{date_str}.md")
+    @staticmethod
+    def get_org_lock_path(org_file_path: str) -> str:
+        """
+        整理后文件的合并锁文件路径，与文件放在同一目录下的隐藏文件。
+        例如： kb/01-chats-input-organized/{chat_name}/.{YYYY-MM}.md.lock
+        """
+        dir_name, base_name = os.path.split(org_file_path)
+        return os.path.join(dir_name, f".{base_name}.lock")
 
     @staticmethod
     def get_used_raw_file_path(knowledge_base_dir: str, rel_path: str) -> str:
@@ -439,6 +1601,22 @@ class KnowledgeBasePaths:
         """
         return os.path.join(knowledge_base_dir, "10-chats-input-raw-used", rel_path)
 
+    @staticmethod
+    def get_ingest_manifest_path(knowledge_base_dir: str) -> str:
+        """
+        ingest 清单路径：记录已消费的原始文件、块的内容摘要及其归档位置，跨运行共享。
+        例如： kb/tasks/normalize/ingest_manifest.jsonl
+        """
+        return os.path.join(knowledge_base_dir, "tasks", "normalize", "ingest_manifest.jsonl")
+
+    @staticmethod
+    def get_ingest_checkpoint_path(knowledge_base_dir: str) -> str:
+        """
+        ingest 检查点日志路径：记录每个目标文件合并的开始/提交，用于中断后 --resume。运行成功结束后删除。
+        例如： kb/tasks/normalize/checkpoint.jsonl
+        """
+        return os.path.join(knowledge_base_dir, "tasks", "normalize", "checkpoint.jsonl")
+
     @staticmethod
     def get_task_prompt_path(task_run_dir: str, task_idx: int) -> str:
         """
@@ -455,6 +1633,209 @@ class KnowledgeBasePaths:
         """
         return f"{task_run_dir}/outputs_{task_idx}_chunk_{chunk_idx}.md"
 
+def atomic_write_bytes(path: str, data: bytes) -> os.stat_result:
+    """
+    原子写入：先写同目录下的隐藏临时文件并 fsync，再 os.replace 覆盖目标文件。
+    进程在任何时刻中断，目标文件要么是旧内容，要么是完整的新内容，不会留下写了一半的文件。
+    返回写入后文件的 stat。
+    """
+    dir_name, base_name = os.path.split(path)
+    os.makedirs(dir_name, exist_ok=True)
+    tmp_path = os.path.join(dir_name, f".{base_name}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        st = os.fstat(f.fileno())
+    os.replace(tmp_path, path)
+    return st
+
+
+class RunJournal:
+    """
+    任务运行日志：一个只追加写入的 JSONL 文件，每行一条记录（dict）。
+    用于代替每个块一个 YAML 的调试输出，整个运行只产生一个文件，需要时再用 SCRIPT_view_journal.py 渲染为 YAML。
+    路径以 .zst 结尾时使用 zstd 流式压缩（需要安装 zstandard 包）。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        compressor = RunJournal._zstandard().ZstdCompressor() if path.endswith('.zst') else None
+        raw = open(path, 'wb')
+        stream = compressor.stream_writer(raw) if compressor else raw
+        self._file = io.TextIOWrapper(stream, encoding='utf-8', newline='\n')
+
+    @staticmethod
+    def _zstandard():
+        """
+        按需导入 zstandard，未安装时给出明确的错误信息。
+        """
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("读写 .zst 压缩的运行日志需要 zstandard 包，请执行 pip install zstandard，或改用未压缩的 journal.jsonl")
+        return zstandard
+
+    def append(self, record: dict):
+        """
+        追加一条记录。
+        """
+        self._file.write(json.dumps(record, ensure_ascii=False))
+        self._file.write("\n")
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self) -> 'RunJournal':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @staticmethod
+    def iter_records(path: str) -> Iterator[dict]:
+        """
+        按顺序读取运行日志中的所有记录。
+        """
+        with open(path, 'rb') as raw:
+            stream = RunJournal._zstandard().ZstdDecompressor().stream_reader(raw) if path.endswith('.zst') else raw
+            for line in io.TextIOWrapper(stream, encoding='utf-8'):
+                if line.strip():
+                    yield json.loads(line)
+
+
+class StageProfiler:
+    """
+    运行阶段的计时与计数：
+    - span(stage): 上下文管理器，累计该阶段的耗时与次数
+    - count(name, n): 累加计数器，例如 lines_hashed、bytes_written
+    - trace 为 True 时，每个 span 同时记录一条 Chrome trace 的 "X" 事件（trace_events）
+    各阶段均为包含时间：嵌套的阶段（例如 load 中的 hash）同时计入内外两个阶段。
+    进程池子进程中的统计通过 snapshot() 带回，由父进程 absorb() 汇总。
+
+    >>> profiler = StageProfiler()
+    >>> with profiler.span("parse"):
+    ...     profiler.count("lines_hashed", 3)
+    >>> mark = profiler.mark()
+    >>> profiler.count("lines_hashed", 2)
+    >>> profiler.stages["parse"][1], profiler.counters["lines_hashed"], profiler.since(mark)["lines_hashed"]
+    (1, 5, 2)
+    """
+
+    __slots__ = ('trace', 'stages', 'counters', 'trace_events')
+
+    def __init__(self, trace: bool = False):
+        self.reset(trace)
+
+    def reset(self, trace: bool = False):
+        """
+        清空全部统计。
+        """
+        self.trace = trace
+        self.stages: Dict[str, List[float]] = {}  # stage -> [累计秒数, 次数]
+        self.counters: Dict[str, int] = {}
+        self.trace_events: List[dict] = []
+
+    @contextmanager
+    def span(self, stage: str, **trace_args):
+        """
+        统计 with 块的耗时，计入 stage。trace_args 只写入 trace 事件（例如目标文件名）。
+        """
+        wall = time.time()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._add(stage, time.perf_counter() - start, wall, trace_args)
+
+    def iter_span(self, stage: str, iterable: Iterable[Any]) -> Iterator[Any]:
+        """
+        包装一个迭代器：每次取下一个元素的耗时计入 stage（例如流式解析的生成器）。
+        """
+        iterator = iter(iterable)
+        while True:
+            wall = time.time()
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._add(stage, time.perf_counter() - start, wall, {})
+                return
+            self._add(stage, time.perf_counter() - start, wall, {})
+            yield item
+
+    def _add(self, stage: str, elapsed: float, wall: float, trace_args: dict):
+        totals = self.stages.get(stage)
+        if totals is None:
+            self.stages[stage] = [elapsed, 1]
+        else:
+            totals[0] += elapsed
+            totals[1] += 1
+        if self.trace:
+            self.trace_events.append({"name": stage, "ph": "X", "ts": int(wall * 1e6), "dur": int(elapsed * 1e6),
+                                      "pid": os.getpid(), "tid": 0, "args": trace_args})
+
+    def count(self, name: str, n: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def mark(self) -> Tuple[Dict[str, float], Dict[str, int]]:
+        """
+        记录当前的累计值，配合 since 计算一段处理（例如单个块）的增量。
+        """
+        return {stage: totals[0] for stage, totals in self.stages.items()}, dict(self.counters)
+
+    def since(self, mark: Tuple[Dict[str, float], Dict[str, int]]) -> Dict[str, Union[int, float]]:
+        """
+        自 mark 以来的增量：各计数器的增量，以及各阶段的耗时增量（毫秒，键为 {stage}_ms）。
+        """
+        seconds, counters = mark
+        delta: Dict[str, Union[int, float]] = {name: value - counters.get(name, 0) for name, value in self.counters.items()}
+        for stage, totals in self.stages.items():
+            elapsed = totals[0] - seconds.get(stage, 0.0)
+            if elapsed:
+                delta[f"{stage}_ms"] = round(elapsed * 1000, 3)
+        return delta
+
+    def snapshot(self) -> dict:
+        return {"stages": self.stages, "counters": self.counters, "trace_events": self.trace_events}
+
+    def absorb(self, snapshot: dict):
+        """
+        汇总另一个 StageProfiler（通常来自子进程）的 snapshot。
+        """
+        for stage, (elapsed, calls) in snapshot["stages"].items():
+            totals = self.stages.setdefault(stage, [0.0, 0])
+            totals[0] += elapsed
+            totals[1] += calls
+        for name, value in snapshot["counters"].items():
+            self.count(name, value)
+        self.trace_events.extend(snapshot["trace_events"])
+
+    def summary(self) -> dict:
+        """
+        运行摘要：各阶段的累计秒数与次数、各计数器的总数。
+        """
+        return {
+            "stages": {stage: {"seconds": round(elapsed, 6), "calls": calls} for stage, (elapsed, calls) in self.stages.items()},
+            "counters": dict(self.counters)
+        }
+
+    def format_summary(self) -> str:
+        lines = ["Stage timings (inclusive):"]
+        for stage, (elapsed, calls) in self.stages.items():
+            lines.append(f"  {stage:<10} {elapsed:>10.3f}s  {calls:>8} call(s)")
+        if self.counters:
+            lines.append("Counters: " + ", ".join(f"{name}={value}" for name, value in self.counters.items()))
+        return "\n".join(lines)
+
+    def write_chrome_trace(self, path: str):
+        """
+        写出 Chrome trace（JSON Object Format），可在 chrome://tracing 或 Perfetto 中打开。
+        """
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"traceEvents": self.trace_events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
@@ -0,0 +1,96 @@
+import os
+import sys
+import argparse
+import yaml
+from SCRIPT_util import KnowledgeBasePaths, RunJournal
+from typing import Iterator, Optional, Tuple
+
+"""
+SCRIPT_view_journal.py
+描述: 查看 SCRIPT_normalize_merge.py 写出的运行日志（journal.jsonl / journal.jsonl.zst）。
+默认列出全部记录的摘要；指定记录序号或 (rel_path, idx) 时，把记录渲染为与旧版调试 YAML 相同结构的 YAML。
+"""
+
+
+def resolve_journal_path(path: str) -> str:
+    """
+    path 可以是 journal 文件本身，也可以是任务运行目录 (tasks/normalize/run_*)。
+    """
+    if os.path.isdir(path):
+        for compressed in (False, True):
+            journal_path = KnowledgeBasePaths.get_task_journal_path(path, compressed)
+            if os.path.exists(journal_path):
+                return journal_path
+        raise FileNotFoundError(f"目录 {path} 下没有找到 journal.jsonl 或 journal.jsonl.zst")
+    return path
+
+
+def record_to_yaml(record: dict) -> str:
+    """
+    将一条记录渲染为 YAML：
+    - raw_block: 与 chunks/*_raw_chunk.yaml 相同
+    - merge_result: 与 chunks_merged/*_merge_chunk.yaml 相同
+    """
+    if record["type"] == "raw_block":
+        return yaml.dump(record["block"], allow_unicode=True)
+    return yaml.dump({"block_info": record["block_info"], "merge_result": record["merge_result"]}, allow_unicode=True)
+
+
+def record_summary(no: int, record: dict) -> str:
+    """
+    单行摘要：序号、类型、来源文件与块序号、群聊、时间，合并记录附带合并策略。
+    """
+    block = record["block"] if record["type"] == "raw_block" else record["block_info"]
+    summary = f"{no:>6}  {record['type']:<12} {record['rel_path']}#{record['idx']}  {block['chat_name']}  {block['time_tag']}"
+    if record["type"] == "merge_result":
+        summary += f"  {record['merge_result']['06_action_taken']['strategy']}"
+    return summary
+
+
+def select_records(journal_path: str, record_no: Optional[int], rel_path: Optional[str], idx: Optional[int],
+                   record_type: Optional[str]) -> Iterator[Tuple[int, dict]]:
+    """
+    按条件筛选记录，产出 (记录序号, 记录)。记录序号从 0 开始，即 journal 中的行序。
+    """
+    for no, record in enumerate(RunJournal.iter_records(journal_path)):
+        if record_no is not None and no != record_no:
+            continue
+        if rel_path is not None and record["rel_path"] != rel_path:
+            continue
+        if idx is not None and record["idx"] != idx:
+            continue
+        if record_type is not None and record["type"] != record_type:
+            continue
+        yield no, record
+
+
+def main():
+    parser = argparse.ArgumentParser(description="查看 ingest 运行日志 (journal)")
+    parser.add_argument("journal", type=str, help="journal 文件或任务运行目录 (tasks/normalize/run_*)")
+    parser.add_argument("--record", type=int, help="按记录序号查看 (见列表第一列)")
+    parser.add_argument("--rel_path", type=str, help="按原始文件相对路径筛选")
+    parser.add_argument("--idx", type=int, help="按块序号筛选")
+    parser.add_argument("--type", choices=["raw_block", "merge_result"], help="按记录类型筛选")
+    parser.add_argument("--list", action="store_true", help="只列出摘要，不渲染 YAML")
+    args = parser.parse_args()
+
+    journal_path = resolve_journal_path(args.journal)
+    # 没有任何筛选条件时只列摘要，避免把整个 journal 渲染到终端
+    list_only = args.list or (args.record is None and args.rel_path is None and args.idx is None)
+
+    found = False
+    for no, record in select_records(journal_path, args.record, args.rel_path, args.idx, args.type):
+        found = True
+        if list_only:
+            print(record_summary(no, record))
+        else:
+            print(f"# --- record {no}: {record['type']} {record['rel_path']}#{record['idx']} ---")
+            print(record_to_yaml(record))
+
+    if not found:
+        print("No matching records.", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,12 +4,18 @@ import yaml
 import re
 import sys
 import hashlib
+import importlib.util
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
 from datetime import datetime, timedelta
+from itertools import islice
 from pathlib import Path
 
 # Add the workflows/01_ingest directory to sys.path to import SCRIPT_util
 sys.path.append(str(Path(__file__).parent.parent / "01_ingest"))
-from SCRIPT_util import RegexPatterns
+from SCRIPT_util import KnowledgeBasePaths, RegexPatterns, TimelineIndex
 
 # --- YAML Multi-line Support ---
 class LiteralStr(str):
@@ -26,12 +32,27 @@ yaml.add_representer(LiteralStr, literal_presenter)
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Analyze data gaps with refined 'sandwich' context logic.")
-    parser.add_argument("--spec-file", required=True, help="Path to project spec YAML")
+    parser.add_argument("--spec-file", help="Path to project spec YAML")
+    parser.add_argument("--all-specs", action="store_true",
+                        help="Check every project spec in --spec-dir in one pass (each chat is scanned once), one report per spec")
+    parser.add_argument("--spec-dir", default="kb/02-project-specs", help="Directory of project specs for --all-specs")
+    parser.add_argument("--jobs", type=int, default=0, help="Processes scanning chats in parallel for --all-specs (0: all CPU cores)")
     parser.add_argument("--data-dir", default="kb/01-chats-input-organized", help="Root of organized data")
     parser.add_argument("--output-dir", default="kb/03-missing-periods", help="Where to save gap reports")
     parser.add_argument("--high-threshold", default="12h", help="Threshold for high sensitivity")
     parser.add_argument("--low-threshold", default="2d", help="Threshold for low sensitivity")
-    return parser.parse_args()
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Do not read or update the timeline cache in OUTPUT_DIR/.cache")
+    parser.add_argument("--backend", choices=["auto", "python", "numpy"], default="auto",
+                        help="Gap detection backend (auto: numpy when installed, otherwise python)")
+    args = parser.parse_args()
+    if bool(args.spec_file) == args.all_specs:
+        parser.error("exactly one of --spec-file or --all-specs is required")
+    if args.jobs < 0:
+        parser.error("--jobs must not be negative")
+    if args.jobs == 0:
+        args.jobs = os.cpu_count() or 1
+    return args
 
 def parse_duration(duration_str):
     match = re.match(r"(\d+)([hd])", duration_str.lower())
@@ -57,77 +78,210 @@ def is_functional_line(line: str) -> bool:
     if line.startswith('last_updated:'): return True
     return False
 
-def get_pure_message_context(lines, start_idx, direction='backward', count=3):
+# Same line breaks as reading in text mode (universal newlines)
+NEWLINE = re.compile(rb"\r\n|\r|\n")
+CONTEXT_WINDOW = 4096
+
+def iter_file_lines(path, offset, direction='forward'):
+    """
+    Decoded lines (without line breaks) around byte 'offset', which must be the start of a line.
+    'forward' yields the line at offset and the lines after it; 'backward' yields the lines before it, nearest first.
+    Only a window around offset is read; the window doubles until the caller stops or the file boundary is reached.
+    """
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        window, emitted = CONTEXT_WINDOW, 0
+        while True:
+            if direction == 'backward':
+                start = max(0, offset - window)
+                f.seek(start)
+                pieces = NEWLINE.split(f.read(offset - start))
+                # The window ends on a line break; its first piece is cut unless it starts at the top of the file
+                pieces = pieces[(1 if start > 0 else 0):-1]
+                pieces.reverse()
+                at_boundary = start == 0
+            else:
+                f.seek(offset)
+                data = f.read(window)
+                at_boundary = offset + len(data) >= file_size
+                pieces = NEWLINE.split(data)
+                # The last piece is cut by the window, or empty after the final line break
+                if not at_boundary or not pieces[-1]:
+                    pieces.pop()
+            for piece in pieces[emitted:]:
+                yield piece.decode('utf-8', errors='replace')
+            emitted = len(pieces)
+            if at_boundary:
+                return
+            window *= 2
+
+def get_pure_message_context(path, offset, direction='backward', count=3):
     """
     IMPLEMENTATION LOGIC:
     This function extracts searchable 'Connection Points' for human collectors.
     
-    For a gap detected at 'time_tag_B' (the return point):
+    For a gap detected at 'time_tag_B' (the return point, a line starting at byte 'offset' of 'path'):
     - 'after': Move UP from 'time_tag_B' to find what messages we already have right before the gap in the FILE.
     - 'before': Move DOWN from 'time_tag_B' to find what messages start our next available data segment.
+    Lines are read by seeking around 'offset' (see iter_file_lines), never the whole file.
     """
     result = []
-    curr = start_idx - 1 if direction == 'backward' else start_idx + 1
-    
-    while len(result) < count:
-        if curr < 0 or curr >= len(lines):
-            break
-        
-        line = lines[curr].strip()
-        if not is_functional_line(line):
-            result.append(line)
-            
-        if direction == 'backward':
-            curr -= 1
-        else:
-            curr += 1
-            
+    with closing(iter_file_lines(path, offset, direction)) as lines:
+        if direction == 'forward':
+            next(lines, None)  # the time tag line itself
+        for line in lines:
+            if len(result) >= count:
+                break
+            line = line.strip()
+            if not is_functional_line(line):
+                result.append(line)
+
     if direction == 'backward':
         result.reverse()
         
     return LiteralStr("\n".join(result)) if result else "N/A"
 
-def extract_time_tags_from_source(source_dir, start_dt, end_dt):
-    time_tags = []
+def tag_line(tag):
+    """The stripped time tag line of a tag, e.g. '-- 2024-01-02 03:04'."""
+    with closing(iter_file_lines(tag['path'], tag['offset'])) as lines:
+        return next(lines, "").strip()
+
+def load_timeline(source_path, start_dt, end_dt, cache_dir=None):
+    """
+    The chat's timeline index pruned to [start_dt, end_dt] (see TimelineIndex.load).
+    Files whose segment in the chat's _timeline.idx is stale (edited outside ingest, or archived before the index
+    existed) are rescanned. With cache_dir, those rescanned segments are kept in cache_dir/{chat}.idx, keyed by
+    file name, size and mtime, so later runs reuse them until the file changes again. Segments that
+    _timeline.idx already has up to date are dropped from the cache.
+    """
+    chat_dir = str(source_path)
+    index = TimelineIndex.read(KnowledgeBasePaths.get_org_timeline_index_path(chat_dir)) or TimelineIndex()
+    if cache_dir is None:
+        index.sync(chat_dir, start_dt, end_dt)
+        return index
+
+    cache_path = Path(cache_dir) / f"{source_path.name}.idx"
+    cache = TimelineIndex.read(str(cache_path)) or TimelineIndex()
+    stored = dict(index.segments)
+    if index.sync(chat_dir, start_dt, end_dt, fallback=cache):
+        for name, segment in index.segments.items():
+            if stored.get(name, (None, None))[:2] == segment[:2]:
+                cache.segments.pop(name, None)
+            else:
+                cache.segments[name] = segment
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        cache.write(str(cache_path))
+    return index
+
+class ChatTimeline:
+    """
+    Time tags of a chat, sorted by (dt, file, idx) and stored as columns (see TimelineIndex.columns):
+    an int64 'minutes' array plus file / line / byte offset columns, with no per-tag objects.
+    Gap detection and day counting work on the minutes column; tag(i) builds the dict of a single tag
+    ('dt', 'minutes', 'file', 'path', 'idx', 'offset'), which is only needed for tags that border a gap.
+    """
+    def __init__(self, source_path, names=(), file_ids=None, minutes=None, line_nos=None, offsets=None):
+        self.source_path = Path(source_path)
+        self.names = list(names)
+        self.file_ids = file_ids if file_ids is not None else array('I')
+        self.minutes = minutes if minutes is not None else array('q')
+        self.line_nos = line_nos if line_nos is not None else array('I')
+        self.offsets = offsets if offsets is not None else array('Q')
+
+    def __len__(self):
+        return len(self.minutes)
+
+    def tag(self, i):
+        """The dict of tag i (negative i counts from the end)."""
+        if i < 0: i += len(self)
+        file_name = self.names[self.file_ids[i]]
+        return {
+            "dt": TimelineIndex.to_datetime(self.minutes[i]),
+            "minutes": self.minutes[i],
+            "file": file_name,
+            "path": str(self.source_path / file_name),
+            "idx": self.line_nos[i],
+            "offset": self.offsets[i]
+        }
+
+    def minutes_array(self):
+        """The minutes column as an int64 numpy array (a view of the same buffer, no copy)."""
+        return _numpy().frombuffer(self.minutes, dtype='int64')
+
+    def slice(self, start_dt, end_dt):
+        """Tags within [start_dt, end_dt] (same result as scanning this range)."""
+        lo = bisect_left(self.minutes, TimelineIndex.to_minutes(start_dt))
+        hi = bisect_right(self.minutes, TimelineIndex.to_minutes(end_dt))
+        return ChatTimeline(self.source_path, self.names, self.file_ids[lo:hi], self.minutes[lo:hi],
+                            self.line_nos[lo:hi], self.offsets[lo:hi])
+
+def extract_time_tags_from_source(source_dir, start_dt, end_dt, cache_dir=None):
+    """
+    Time tags of a chat within [start_dt, end_dt] as a ChatTimeline.
+    Tags come from the chat's timeline index (TimelineIndex, maintained by ingest); shard files outside the range
+    are pruned by name, and files that changed since the index was written are rescanned (see load_timeline).
+    Each tag only records its byte 'offset': context lines are read by seeking, and only for tags that border a gap.
+    """
     source_path = Path(source_dir)
-    if not source_path.exists(): return time_tags
+    if not source_path.exists(): return ChatTimeline(source_path)
+    return ChatTimeline(source_path, *load_timeline(source_path, start_dt, end_dt, cache_dir).columns(start_dt, end_dt))
 
-    p_std = re.compile(r'^--\s*(\d{4}-\d{2}-\d{2})\s+(\d{2}:\d{2})')
+def _numpy():
+    """Import numpy on demand; it is only needed by the numpy backend."""
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("The numpy gap backend requires numpy: pip install numpy, or use --backend python")
+    return numpy
 
-    for md_file in sorted(source_path.glob("*.md")):
-        try:
-            with open(md_file, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for idx, line in enumerate(lines):
-                    line_content = line.strip()
-                    m = p_std.match(line_content)
-                    if m:
-                        dt_str = f"{m.group(1)} {m.group(2)}"
-                        try:
-                            dt = datetime.strptime(dt_str, "%Y-%m-%d %H:%M")
-                            if start_dt <= dt <= end_dt:
-                                time_tags.append({
-                                    "dt": dt,
-                                    "file": md_file.name,
-                                    "idx": idx,
-                                    "raw": line_content,
-                                    "all_lines": lines
-                                })
-                        except ValueError: pass
-        except Exception as e:
-            print(f"Error reading {md_file}: {e}", file=sys.stderr)
-
-    time_tags.sort(key=lambda x: (x['dt'], x['file'], x['idx']))
-    return time_tags
-
-def find_gaps_with_sandwich_context(time_tags, start_dt, end_dt, threshold_td):
+def resolve_backend(backend):
+    """'auto' picks numpy when it is installed, otherwise python; explicit choices are checked."""
+    if backend == "auto":
+        return "numpy" if importlib.util.find_spec("numpy") else "python"
+    if backend == "numpy":
+        _numpy()
+    return backend
+
+def find_gap_positions(timeline, start_dt, end_dt, threshold_td):
+    """
+    Locate gaps longer than threshold_td in a ChatTimeline.
+    Returns (start_gap, internal, end_gap): internal lists every i where tag i -> tag i+1 is a gap.
+    Tags are whole minutes, so comparing minute differences against the threshold rounded down to whole
+    minutes gives the same result as comparing timedeltas.
+    """
+    minutes = timeline.minutes
+    threshold = threshold_td // timedelta(minutes=1)
+    start_gap = minutes[0] - TimelineIndex.to_minutes(start_dt) > threshold
+    internal = [i for i, (curr, nxt) in enumerate(zip(minutes, islice(minutes, 1, None))) if nxt - curr > threshold]
+    end_gap = TimelineIndex.to_minutes(end_dt) - minutes[-1] > threshold
+    return start_gap, internal, end_gap
+
+def find_gap_positions_numpy(timeline, start_dt, end_dt, threshold_td):
+    """Same as find_gap_positions, with one vectorized diff over the int64 minutes column."""
+    np = _numpy()
+    minutes = timeline.minutes_array()
+    threshold = threshold_td // timedelta(minutes=1)
+    start_gap = bool(minutes[0] - TimelineIndex.to_minutes(start_dt) > threshold)
+    internal = np.flatnonzero(np.diff(minutes) > threshold).tolist()
+    end_gap = bool(TimelineIndex.to_minutes(end_dt) - minutes[-1] > threshold)
+    return start_gap, internal, end_gap
+
+def count_unique_days(timeline, backend="python"):
+    """Number of distinct calendar days that have at least one time tag (minutes are counted from 1970-01-01 00:00)."""
+    if backend == "numpy" and len(timeline):
+        np = _numpy()
+        return int(np.unique(timeline.minutes_array() // (24 * 60)).size)
+    return len(set(m // (24 * 60) for m in timeline.minutes))
+
+def find_gaps_with_sandwich_context(timeline, start_dt, end_dt, threshold_td, backend="python"):
     """
     LOGIC: 'after' and 'before' contexts are centered around the 'resume point' (nxt tag).
     This creates a clear boundary for where the data is missing in the IM history.
+    Gap positions come from find_gap_positions, or find_gap_positions_numpy when backend is "numpy".
     """
     gaps = []
 
-    if not time_tags:
+    if not len(timeline):
         gaps.append({
             "after": "START OF PROJECT RANGE",
             "after_time": "N/A",
@@ -137,59 +291,63 @@ def find_gaps_with_sandwich_context(time_tags, start_dt, end_dt, threshold_td):
         })
         return gaps
 
+    locate = find_gap_positions_numpy if backend == "numpy" else find_gap_positions
+    start_gap, internal, end_gap = locate(timeline, start_dt, end_dt, threshold_td)
+
     # 1. Start boundary gap
-    if (time_tags[0]['dt'] - start_dt) > threshold_td:
+    if start_gap:
+        first = timeline.tag(0)
         gaps.append({
             "after": "START OF PROJECT RANGE",
             "after_time": f"Expect: {start_dt.strftime('%Y-%m-%d %H:%M')}",
-            "missing": [start_dt.strftime("%Y-%m-%d %H:%M"), (time_tags[0]['dt'] - timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M")],
-            "before_time": time_tags[0]['raw'],
-            "before": get_pure_message_context(time_tags[0]['all_lines'], time_tags[0]['idx'], 'forward', 3)
+            "missing": [start_dt.strftime("%Y-%m-%d %H:%M"), (first['dt'] - timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M")],
+            "before_time": tag_line(first),
+            "before": get_pure_message_context(first['path'], first['offset'], 'forward', 3)
         })
 
     # 2. Internal gaps
-    for i in range(len(time_tags) - 1):
-        curr = time_tags[i]
-        nxt = time_tags[i+1]
-        
-        if (nxt['dt'] - curr['dt']) > threshold_td:
-            # Pivot Point is nxt (where we find data again)
-            gaps.append({
-                "after": get_pure_message_context(nxt['all_lines'], nxt['idx'], 'backward', 3),
-                "after_time": curr['raw'],
-                "missing": [(curr['dt'] + timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M"), (nxt['dt'] - timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M")],
-                "before_time": nxt['raw'],
-                "before": get_pure_message_context(nxt['all_lines'], nxt['idx'], 'forward', 3)
-            })
+    for i in internal:
+        curr = timeline.tag(i)
+        nxt = timeline.tag(i + 1)
+
+        # Pivot Point is nxt (where we find data again)
+        gaps.append({
+            "after": get_pure_message_context(nxt['path'], nxt['offset'], 'backward', 3),
+            "after_time": tag_line(curr),
+            "missing": [(curr['dt'] + timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M"), (nxt['dt'] - timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M")],
+            "before_time": tag_line(nxt),
+            "before": get_pure_message_context(nxt['path'], nxt['offset'], 'forward', 3)
+        })
 
     # 3. End boundary gap
-    if (end_dt - time_tags[-1]['dt']) > threshold_td:
+    if end_gap:
+        last = timeline.tag(-1)
         gaps.append({
-            "after": get_pure_message_context(time_tags[-1]['all_lines'], time_tags[-1]['idx'], 'backward', 3),
-            "after_time": time_tags[-1]['raw'],
-            "missing": [(time_tags[-1]['dt'] + timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M"), end_dt.strftime("%Y-%m-%d %H:%M")],
+            "after": get_pure_message_context(last['path'], last['offset'], 'backward', 3),
+            "after_time": tag_line(last),
+            "missing": [(last['dt'] + timedelta(minutes=1)).strftime("%Y-%m-%d %H:%M"), end_dt.strftime("%Y-%m-%d %H:%M")],
             "before_time": f"Expect: {end_dt.strftime('%Y-%m-%d %H:%M')}",
             "before": "END OF PROJECT RANGE"
         })
 
     return gaps
 
-def main():
-    args = parse_args()
-    high_td = parse_duration(args.high_threshold)
-    low_td = parse_duration(args.low_threshold)
-
-    try:
-        spec = load_yaml(args.spec_file)
-    except Exception as e:
-        print(f"Error loading spec: {e}"); sys.exit(1)
-
-    project_id = spec['meta']['id']
+def spec_time_range(spec):
+    """[start_dt, end_dt] of a project spec; a missing end means today."""
     time_range = spec['scope']['time_range']
     start_dt = datetime.strptime(time_range['start'], "%Y-%m-%d")
     end_dt = datetime.strptime(time_range.get('end', datetime.now().strftime("%Y-%m-%d")), "%Y-%m-%d").replace(hour=23, minute=59)
+    return start_dt, end_dt
 
-    report = {
+def source_settings(src, high_td, low_td):
+    """(name, sensitivity, threshold) of a spec source, given as a plain name or a dict."""
+    src_name = src['name'] if isinstance(src, dict) else src
+    sensitivity = src.get('time_sensitivity', 'low') if isinstance(src, dict) else 'low'
+    threshold_td = high_td if sensitivity == 'high' else low_td
+    return src_name, sensitivity, threshold_td
+
+def new_report(args):
+    return {
         "meta": {
             "name": "check gap",
             "description": "检查 chat 的 gap，输出每个 chat 的 gap 情况。",
@@ -206,48 +364,160 @@ def main():
         "results": []
     }
 
-    for src in spec['scope']['sources']:
-        src_name = src['name'] if isinstance(src, dict) else src
-        sensitivity = src.get('time_sensitivity', 'low') if isinstance(src, dict) else 'low'
-        threshold_td = high_td if sensitivity == 'high' else low_td
+def analyze_source(src_name, sensitivity, threshold_td, source_path, timeline, start_dt, end_dt, backend):
+    """The report entry of one source, from its ChatTimeline within [start_dt, end_dt]."""
+    days_found = count_unique_days(timeline, backend)
+    total_days_expected = (end_dt.date() - start_dt.date()).days + 1
+    coverage_pct = (days_found / total_days_expected) * 100 if total_days_expected > 0 else 0
 
-        print(f"Scanning source: {src_name} (Sensitivity: {sensitivity})...")
-        sanitized_name = RegexPatterns.chat_name_sanitize(src_name)
-        source_path = Path(args.data_dir) / sanitized_name
+    gaps = find_gaps_with_sandwich_context(timeline, start_dt, end_dt, threshold_td, backend)
+    status = "正常"
+    if not source_path.exists() or not len(timeline): status = "缺失"
+    elif gaps: status = "部分缺失"
 
-        time_tags = extract_time_tags_from_source(source_path, start_dt, end_dt)
-        unique_days = set(t['dt'].date() for t in time_tags)
-        total_days_expected = (end_dt.date() - start_dt.date()).days + 1
-        coverage_pct = (len(unique_days) / total_days_expected) * 100 if total_days_expected > 0 else 0
-
-        gaps = find_gaps_with_sandwich_context(time_tags, start_dt, end_dt, threshold_td)
-        status = "正常"
-        if not source_path.exists() or not time_tags: status = "缺失"
-        elif gaps: status = "部分缺失"
-
-        report["results"].append({
-            "chat": src_name,
-            "exists": source_path.exists(),
-            "time_sensitivity": sensitivity,
-            "status": status,
-            "data_status": [
-                {
-                    "days_found": len(unique_days),
-                    "days_expected": total_days_expected,
-                    "days_coverage": f"{coverage_pct:.2f}%",
-                    "missing": gaps
-                }
-            ]
-        })
+    return {
+        "chat": src_name,
+        "exists": source_path.exists(),
+        "time_sensitivity": sensitivity,
+        "status": status,
+        "data_status": [
+            {
+                "days_found": days_found,
+                "days_expected": total_days_expected,
+                "days_coverage": f"{coverage_pct:.2f}%",
+                "missing": gaps
+            }
+        ]
+    }
 
-    out_dir = Path(args.output_dir)
+def write_report(report, output_dir, project_id, timestamp):
+    out_dir = Path(output_dir)
     if not out_dir.exists(): out_dir.mkdir(parents=True, exist_ok=True)
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M")
     out_file = out_dir / f"missing_{project_id}_{timestamp}.yaml"
 
     with open(out_file, 'w', encoding='utf-8') as f:
         yaml.dump(report, f, allow_unicode=True, sort_keys=False)
     print(f"Detailed sandwich-context gap report saved to {out_file}")
 
+# Keys every project spec must have; YAML files without them (e.g. notes.yaml) are not project specs
+REQUIRED_SPEC_KEYS = (("meta", "id"), ("scope", "sources"), ("scope", "time_range", "start"))
+
+def check_spec_keys(spec):
+    """Raise KeyError naming the first required key (e.g. 'scope.time_range.start') that spec lacks."""
+    for keys in REQUIRED_SPEC_KEYS:
+        node = spec
+        for depth, key in enumerate(keys):
+            if not isinstance(node, dict) or key not in node:
+                raise KeyError(".".join(keys[:depth + 1]))
+            node = node[key]
+
+def load_all_specs(spec_dir):
+    """
+    (specs, errors): (path, spec) of every project spec in spec_dir sorted by file name, and the number of
+    files that could not be read or parsed (reported to stderr).
+    YAML files that are not project specs (e.g. notes.yaml) are skipped and reported.
+    """
+    specs, errors = [], 0
+    for path in sorted(Path(spec_dir).glob("*.yaml")):
+        try:
+            spec = load_yaml(path)
+        except (OSError, yaml.YAMLError) as e:
+            print(f"Error loading spec {path.name}: {e}", file=sys.stderr)
+            errors += 1
+            continue
+        try:
+            check_spec_keys(spec)
+        except KeyError as e:
+            print(f"Skipping {path.name}: not a project spec (missing {e.args[0]})")
+            continue
+        specs.append((path, spec))
+    return specs, errors
+
+def scan_chats(chat_ranges, jobs, cache_dir=None):
+    """
+    Scan each chat once over the union of the ranges that reference it.
+    chat_ranges: {source_path: (start_dt, end_dt)}. Returns {source_path: ChatTimeline}.
+    With jobs > 1 the chats are scanned by a process pool; results are identical to scanning serially.
+    """
+    paths = list(chat_ranges)
+    if jobs <= 1 or len(paths) <= 1:
+        return {path: extract_time_tags_from_source(path, *chat_ranges[path], cache_dir) for path in paths}
+    with ProcessPoolExecutor(max_workers=min(jobs, len(paths))) as executor:
+        results = executor.map(extract_time_tags_from_source, paths,
+                               [chat_ranges[path][0] for path in paths], [chat_ranges[path][1] for path in paths],
+                               [cache_dir] * len(paths))
+        return dict(zip(paths, results))
+
+def timeline_cache_dir(args):
+    return None if args.no_cache else Path(args.output_dir) / ".cache"
+
+def run_all_specs(args, high_td, low_td, backend):
+    """
+    --all-specs: one report per spec in args.spec_dir. Chats shared by several specs are scanned only once,
+    over the union of their time ranges; each spec's gaps and coverage come from its slice of the shared timeline.
+    """
+    specs, errors = load_all_specs(args.spec_dir)
+    if not specs:
+        print(f"Error: no project specs found in {args.spec_dir}"); sys.exit(1)
+
+    chat_ranges = {}
+    for _, spec in specs:
+        start_dt, end_dt = spec_time_range(spec)
+        for src in spec['scope']['sources']:
+            src_name = source_settings(src, high_td, low_td)[0]
+            source_path = Path(args.data_dir) / RegexPatterns.chat_name_sanitize(src_name)
+            lo, hi = chat_ranges.get(source_path, (start_dt, end_dt))
+            chat_ranges[source_path] = (min(lo, start_dt), max(hi, end_dt))
+
+    print(f"Scanning {len(chat_ranges)} chat(s) for {len(specs)} spec(s) with {min(args.jobs, len(chat_ranges))} process(es)...")
+    timelines = scan_chats(chat_ranges, args.jobs, timeline_cache_dir(args))
+
+    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M")
+    for path, spec in specs:
+        project_id = spec['meta']['id']
+        start_dt, end_dt = spec_time_range(spec)
+        print(f"Checking spec: {path.name} ({project_id})")
+        report = new_report(args)
+        for src in spec['scope']['sources']:
+            src_name, sensitivity, threshold_td = source_settings(src, high_td, low_td)
+            source_path = Path(args.data_dir) / RegexPatterns.chat_name_sanitize(src_name)
+            timeline = timelines[source_path].slice(start_dt, end_dt)
+            report["results"].append(analyze_source(src_name, sensitivity, threshold_td, source_path, timeline, start_dt, end_dt, backend))
+        write_report(report, args.output_dir, project_id, timestamp)
+    if errors:
+        print(f"Error: {errors} spec file(s) in {args.spec_dir} could not be loaded"); sys.exit(1)
+
+def main():
+    args = parse_args()
+    high_td = parse_duration(args.high_threshold)
+    low_td = parse_duration(args.low_threshold)
+    backend = resolve_backend(args.backend)
+    print(f"Gap detection backend: {backend}")
+
+    if args.all_specs:
+        run_all_specs(args, high_td, low_td, backend)
+        return
+
+    try:
+        spec = load_yaml(args.spec_file)
+    except Exception as e:
+        print(f"Error loading spec: {e}"); sys.exit(1)
+
+    project_id = spec['meta']['id']
+    start_dt, end_dt = spec_time_range(spec)
+    report = new_report(args)
+
+    for src in spec['scope']['sources']:
+        src_name, sensitivity, threshold_td = source_settings(src, high_td, low_td)
+
+        print(f"Scanning source: {src_name} (Sensitivity: {sensitivity})...")
+        sanitized_name = RegexPatterns.chat_name_sanitize(src_name)
+        source_path = Path(args.data_dir) / sanitized_name
+
+        timeline = extract_time_tags_from_source(source_path, start_dt, end_dt, timeline_cache_dir(args))
+        report["results"].append(analyze_source(src_name, sensitivity, threshold_td, source_path, timeline, start_dt, end_dt, backend))
+
+    write_report(report, args.output_dir, project_id, datetime.now().strftime("%Y-%m-%d_%H-%M"))
+
 if __name__ == "__main__":
     main()
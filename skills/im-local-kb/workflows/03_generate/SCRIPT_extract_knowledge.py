@@ -3,13 +3,20 @@ import argparse
 import yaml
 import re
 import sys
+import json
+import codecs
 import difflib
 from datetime import datetime
 from pathlib import Path
 
 # Add the workflows/01_ingest directory to sys.path to import SCRIPT_util
 sys.path.append(str(Path(__file__).parent.parent / "01_ingest"))
-from SCRIPT_util import RegexPatterns, KnowledgeBasePaths
+from SCRIPT_util import RegexPatterns, KnowledgeBasePaths, ShardLayout, ChatOrgFile, ChatBlock, LineBuffer, BlockDigestScanner
+
+# 每次运行的 Block 清单：contexts.md 中每个 Block 的 (群聊, 文件, 时间标签, 内容摘要)，供下一次增量运行计算新增内容
+BLOCK_MANIFEST_NAME = "contexts.blocks.jsonl"
+# contexts.md 的行偏移索引每隔多少行记录一次，与子代理按 500 行分块一致
+LINE_INDEX_STEP = 500
 
 def parse_args():
     parser = argparse.ArgumentParser(description="[知识生成] 组装上下文与提示词，输出到 stdout 供 LLM Agent 读取。")
@@ -26,43 +33,264 @@ def load_yaml(path):
 
 def get_chat_logs(source_dir, start_date, end_date):
     """
-    获取指定日期范围内的聊天记录。
-    返回: [(filename, content), ...]
+    获取指定日期范围内的聊天记录文件。
+    按群聊目录的分片清单 (_shard.yaml，缺省为 YYYY-MM.md 月度文件) 选出与时间范围相交的分片，按时间顺序排列。
+    文件名不是分片名称的文件默认包含。
+    返回: [Path, ...]（只返回路径，内容由调用方按需流式读取）
     """
-    logs = []
     source_path = Path(source_dir)
     if not source_path.exists():
-        return logs
+        return []
+
+    layout = ShardLayout.load(str(source_path))
+    return [Path(file_path) for file_path in layout.shard_files(str(source_path), start_date, end_date)]
 
-    # 简单策略：文件名通常是 YYYY-MM.md
-    for md_file in source_path.glob("*.md"):
+def iter_context_files(data_dir, sources, start_date, end_date):
+    """
+    按 spec 中 sources 的顺序产出 (群聊目录名, 文件路径)，即 contexts.md 中各段的来源。
+    """
+    for src in sources:
+        src_name = src['name'] if isinstance(src, dict) else src
+        src_name = RegexPatterns.chat_name_sanitize(src_name)
+        for md_file in get_chat_logs(Path(data_dir) / src_name, start_date, end_date):
+            yield src_name, md_file
+
+class ContextWriter:
+    r"""
+    流式写出上下文文件：标题直接写入，聊天记录文件按固定大小的块复制，不整体读入内存。
+    同一遍中统计行数，并每隔 step 行记录一次行首的字节偏移（offsets[k] 为第 k * step + 1 行的偏移），
+    子代理按 500 行分块时可以直接定位到分块的起点。
+    复制时按文本模式读取的规则统一换行（\r\n、\r -> \n），结果与读入字符串再写出相同。
+    复制的同时按 UTF-8 校验，与按文本读取时一样遇到无效字节抛出 UnicodeDecodeError；
+    调用方可以用 checkpoint / rollback 撤销这个文件已写出的部分。
+    （行统计与校验需要经过用户态，因此没有使用 os.sendfile。）
+
+    >>> import io
+    >>> writer = ContextWriter(io.BytesIO(), step=2)
+    >>> writer.write(b"title\n")
+    >>> writer.copy_file(io.BytesIO(b"a\r\nb\rc\nd"), buffer_size=2)
+    >>> writer.f.getvalue(), writer.line_count, writer.line_offsets()
+    (b'title\na\nb\nc\nd', 5, [0, 8, 12])
+    >>> state = writer.checkpoint()
+    >>> writer.copy_file(io.BytesIO(b"\ne\xff"), buffer_size=2)
+    Traceback (most recent call last):
+    ...
+    UnicodeDecodeError: 'utf-8' codec can't decode byte 0xff in position 0: invalid start byte
+    >>> writer.rollback(state)
+    >>> writer.f.getvalue(), writer.line_count, writer.line_offsets()
+    (b'title\na\nb\nc\nd', 5, [0, 8, 12])
+    """
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, f, step: int = LINE_INDEX_STEP):
+        self.f = f
+        self.step = step
+        self.bytes_written = 0
+        self.newlines = 0
+        self.offsets = [0]
+        self._last_byte = b""
+
+    def write(self, data: bytes):
+        # 第 i 行 (从 0 计) 从第 i 个换行符之后开始：本块内跨过 step 的整数倍时记录对应行首的偏移
+        count = data.count(b"\n")
+        pos, seen = -1, 0
+        while self.newlines + count >= len(self.offsets) * self.step:
+            target = len(self.offsets) * self.step - self.newlines
+            while seen < target:
+                pos = data.index(b"\n", pos + 1)
+                seen += 1
+            self.offsets.append(self.bytes_written + pos + 1)
+        if data:
+            self.f.write(data)
+            self.bytes_written += len(data)
+            self.newlines += count
+            self._last_byte = data[-1:]
+
+    def copy_file(self, src, buffer_size: int = BUFFER_SIZE, scanner=None):
+        r"""
+        把二进制文件对象 src 的内容按块复制到输出，统一换行。块末尾的 \r 留到下一块，避免把 \r\n 拆成两个换行。
+        给出 scanner (BlockDigestScanner) 时把写出的每一块同时交给它，在同一遍中计算 Block 摘要。
+        """
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        pending = b""
+        while True:
+            chunk = src.read(buffer_size)
+            if not chunk:
+                break
+            decoder.decode(chunk)
+            data = pending + chunk if pending else chunk
+            pending = b""
+            if b"\r" in data:
+                if data.endswith(b"\r"):
+                    data, pending = data[:-1], b"\r"
+                data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+            self.write(data)
+            if scanner is not None:
+                scanner.feed(data)
+        decoder.decode(b"", final=True)
+        if pending:
+            self.write(b"\n")
+            if scanner is not None:
+                scanner.feed(b"\n")
+
+    def checkpoint(self):
+        """
+        当前的写出位置与统计，供 rollback 使用。
+        """
+        return self.f.tell(), self.bytes_written, self.newlines, len(self.offsets), self._last_byte
+
+    def rollback(self, state):
+        """
+        截断输出并恢复统计，回到 checkpoint 时的状态。
+        """
+        pos, self.bytes_written, self.newlines, offset_count, self._last_byte = state
+        del self.offsets[offset_count:]
+        self.f.seek(pos)
+        self.f.truncate()
+
+    @property
+    def line_count(self) -> int:
+        return self.newlines + (1 if self._last_byte not in (b"", b"\n") else 0)
+
+    def line_offsets(self) -> list:
+        # 最后一个换行符之后没有内容时，它之后的"行首"不是一行
+        return [offset for k, offset in enumerate(self.offsets) if k * self.step < self.line_count]
+
+    def write_index(self, context_file):
+        """
+        写出行偏移索引 {context_file}.lines.json，返回其路径。
+        """
+        index_file = Path(f"{context_file}.lines.json")
+        with open(index_file, 'w', encoding='utf-8') as f:
+            json.dump({"lines": self.line_count, "bytes": self.bytes_written, "step": self.step,
+                       "offsets": self.line_offsets()}, f)
+        return index_file
+
+class BlockManifest:
+    r"""
+    本次运行的 Block 清单 (JSON Lines，每行 chat / file / time_tag / digest，顺序与 contexts.md 相同)。
+    摘要由 write_combined_context 复制文件时一并算出 (BlockDigestScanner)，不需要再次读取语料。
+    内容摘要与 ingest 清单相同 (block_digest)，与 Block 所在的文件无关，重新分片不会产生新增。
+    不是有效整理后文件的文件 (例如含有第二个聊天名称标题) 整个作为一条记录 (time_tag 为 null，摘要为文件内容的 SHA-256)，
+    文件有任何变化时整个文件都算作新增。
+    给出 known_digests (上一次运行的摘要集合) 时，new_blocks 收集摘要不在其中的记录：
+    [(群聊目录名, 文件名, 时间标签或 None, contexts.md 中的起点, 终点), ...]。
+
+    >>> import io, tempfile, contextlib
+    >>> tmp = Path(tempfile.mkdtemp())
+    >>> (tmp / "群").mkdir()
+    >>> _ = (tmp / "群" / "2024-01.md").write_bytes("## -- 群\n-- 2024-01-02 03:04\n甲\n".encode('utf-8'))
+    >>> _ = (tmp / "群" / "2024-02.md").write_bytes("## -- 群\n-- 2024-02-02 03:04\n".encode('utf-8') + b"\xff\n")
+    >>> _ = (tmp / "群" / "2024-03.md").write_bytes("## -- 群\n-- 2024-03-02 03:04\n乙\n## -- 另群\n-- 2024-03-03 03:04\n丁\n".encode('utf-8'))
+    >>> def run(known=None):
+    ...     manifest = BlockManifest(io.StringIO(), known)
+    ...     with contextlib.redirect_stderr(sys.stdout):
+    ...         write_combined_context(tmp / "contexts.md", tmp, ["群"], datetime(2024, 1, 1), datetime(2024, 4, 1), manifest)
+    ...     return manifest
+    >>> manifest = run()  # doctest: +ELLIPSIS
+    Error reading ...2024-02.md: 'utf-8' codec can't decode byte 0xff in position 30: invalid start byte
+    Warning: ...2024-03.md is not a valid organized file (整理后的文件应该只包含一个 chat，但找到多个不同的 chat), recorded as a whole-file block
+    >>> [(record["file"], record["time_tag"]) for record in map(json.loads, manifest.f.getvalue().splitlines())]
+    [('2024-01.md', '2024-01-02 03:04'), ('2024-03.md', None)]
+    >>> known = {json.loads(line)["digest"] for line in manifest.f.getvalue().splitlines()}
+    >>> with open(tmp / "群" / "2024-03.md", 'ab') as f:
+    ...     _ = f.write("-- 2024-01-04 05:06\n丙 NEW\n".encode('utf-8'))
+    >>> manifest = run(known)  # doctest: +ELLIPSIS
+    Error reading ...
+    Warning: ...
+    >>> print("".join(render_added_blocks(tmp / "contexts.md", manifest.new_blocks)))
+    <BLANKLINE>
+    <BLANKLINE>
+    # 数据来源: 群/2024-03.md
+    ## -- 群
+    -- 2024-03-02 03:04
+    乙
+    ## -- 另群
+    -- 2024-03-03 03:04
+    丁
+    -- 2024-01-04 05:06
+    丙 NEW
+    <BLANKLINE>
+    """
+
+    def __init__(self, f, known_digests=None):
+        self.f = f
+        self.known_digests = known_digests
+        self.new_blocks = []
+
+    def add_file(self, src_name, md_file, scanner, end):
+        """
+        记录一个已完整写入 contexts.md 的文件：scanner 是复制该文件时使用的 BlockDigestScanner，end 是文件内容在 contexts.md 中的终点。
+        """
         try:
-            file_name = md_file.stem # "2023-10"
-            # 尝试解析文件名中的日期
+            records = [(block.time_tag, digest, start, stop) for block, digest, start, stop in scanner.finish()]
+        except ValueError as e:
+            print(f"Warning: {md_file} is not a valid organized file ({e}), recorded as a whole-file block", file=sys.stderr)
+            records = [(None, scanner.file_digest(), scanner.start, end)]
+        for time_tag, digest, start, stop in records:
+            record = {"chat": src_name, "file": md_file.name, "time_tag": time_tag, "digest": digest}
+            self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            if self.known_digests is not None and digest not in self.known_digests:
+                self.new_blocks.append((src_name, md_file.name, time_tag, start, stop))
+
+def write_combined_context(context_file, data_dir, sources, start_date, end_date, manifest=None):
+    """
+    按 spec 中 sources 的顺序把各群聊在时间范围内的聊天记录流式写入 context_file (即 contexts.md)，每个文件前加数据来源标题。
+    内存占用与语料大小无关。给出 manifest (BlockManifest) 时同一遍中写出 Block 清单。返回 ContextWriter (行数、行偏移索引)。
+    无法读取或含有无效 UTF-8 的文件跳过，并在 stderr 中提示。
+    """
+    with open(context_file, 'wb') as f:
+        writer = ContextWriter(f)
+        for src_name, md_file in iter_context_files(data_dir, sources, start_date, end_date):
             try:
-                file_date = datetime.strptime(file_name, "%Y-%m")
-                # 月份粒度的简单筛选
-                file_month_start = file_date
-                if file_date.month == 12:
-                    file_month_end = file_date.replace(year=file_date.year+1, month=1)
-                else:
-                    file_month_end = file_date.replace(month=file_date.month+1)
-
-                # 检查时间是否有重叠
-                if file_month_end < start_date or file_month_start > end_date:
+                src = open(md_file, 'rb')
+            except OSError as e:
+                print(f"Error reading {md_file}: {e}", file=sys.stderr)
+                continue
+            with src:
+                state = writer.checkpoint()
+                try:
+                    writer.write(f"\n\n# 数据来源: {src_name}/{md_file.name}\n".encode('utf-8'))
+                    scanner = BlockDigestScanner(str(md_file), base=writer.bytes_written) if manifest is not None else None
+                    writer.copy_file(src, scanner=scanner)
+                except UnicodeDecodeError as e:
+                    # 撤销该文件已写出的标题与部分内容，它也不进入 Block 清单
+                    print(f"Error reading {md_file}: {e}", file=sys.stderr)
+                    writer.rollback(state)
                     continue
-            except ValueError:
-                # 如果文件名不是日期格式，暂时默认包含
-                pass
+            if manifest is not None:
+                manifest.add_file(src_name, md_file, scanner, writer.bytes_written)
+    return writer
 
-            with open(md_file, 'r', encoding='utf-8') as f:
-                logs.append((md_file.name, f.read()))
-
-        except Exception as e:
-            # 忽略读取错误，避免中断
-            continue
+def load_block_digests(run_dir):
+    """
+    读取某次运行的 Block 清单，返回摘要集合；没有清单 (清单出现之前的运行) 时返回 None。
+    """
+    manifest_path = Path(run_dir) / BLOCK_MANIFEST_NAME
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return {json.loads(line)["digest"] for line in f if line.strip()}
 
-    return logs
+def render_added_blocks(context_file, new_blocks):
+    """
+    新增 Block 的上下文行：与 contexts.md 相同，每个文件的 Block 之前加数据来源标题。
+    Block 内容按 BlockManifest 记录的偏移从 contexts.md 中读回；整个文件的记录原样输出该文件的全部行。
+    """
+    lines = []
+    current = None
+    with open(context_file, 'rb') as f:
+        for src_name, fname, time_tag, start, end in new_blocks:
+            if (src_name, fname) != current:
+                current = (src_name, fname)
+                lines.extend(["\n", "\n", f"# 数据来源: {src_name}/{fname}\n"])
+            f.seek(start)
+            content = LineBuffer(f.read(end - start))
+            if time_tag is None:
+                lines.extend(line.rstrip("\r\n") + "\n" for line in content)
+            else:
+                lines.extend(ChatOrgFile.block_to_md_lines(ChatBlock(src_name, time_tag, content, fname)))
+    return lines
 
 def main():
     args = parse_args()
@@ -86,22 +314,7 @@ def main():
         # 如果未定义结束日期，则默认为当前时间
         end_date = datetime.now()
 
-    # 2. 收集上下文并写入 contexts.md
-    all_context = []
-    for src in spec['scope']['sources']:
-        src_name = src['name'] if isinstance(src, dict) else src
-        src_name = RegexPatterns.chat_name_sanitize(src_name)
-        source_path = Path(data_dir) / src_name
-
-        logs = get_chat_logs(source_path, start_date, end_date)
-        for fname, content in logs:
-            header = f"\n\n# 数据来源: {src_name}/{fname}\n"
-            all_context.append(header)
-            all_context.append(content)
-
-    combined_context = "".join(all_context)
-
-    # 3. 准备输出目录
+    # 2. 准备输出目录
     timestamp = datetime.now().strftime("%Y-%m-%d_%H%M")
     run_parent_dir = Path(output_base_dir) / project_id
     run_dir = run_parent_dir / f"run_{timestamp}"
@@ -114,31 +327,44 @@ def main():
         if runs:
             previous_run_dir = runs[0]
 
+    # 3. 收集上下文并流式写入 contexts.md，同时写出行偏移索引
+    # 同一遍中写出 Block 清单；增量模式下与上一次运行的清单做集合差，得到新增的 Block
     context_file = run_dir / "contexts.md"
-    with open(context_file, 'w', encoding='utf-8') as f:
-        f.write(combined_context)
+    incremental = strategy == 'incremental' and not args.force_full
+    prev_digests = load_block_digests(previous_run_dir) if (incremental and previous_run_dir) else None
+    with open(run_dir / BLOCK_MANIFEST_NAME, 'w', encoding='utf-8') as f:
+        manifest = BlockManifest(f, prev_digests)
+        context_writer = write_combined_context(context_file, data_dir, spec['scope']['sources'], start_date, end_date, manifest)
+    context_index_file = context_writer.write_index(context_file)
 
     # 生成 added-contexts.md (增量上下文)
     added_context_file = None
-    if strategy == 'incremental' and not args.force_full:
+    if incremental:
         if not previous_run_dir:
             print(f"STATUS: FIRST_INCREMENTAL_RUN")
             print(f"REASON: 未发现项目 {project_id} 的历史运行记录。也许需要先用 force-full 参数执行一次全量提取以建立基线。")
             sys.exit(0)
 
-        prev_context_file = previous_run_dir / "contexts.md"
-        if not prev_context_file.exists():
-            print(f"STATUS: FIRST_INCREMENTAL_RUN")
-            print(f"REASON: 历史目录 {previous_run_dir} 中缺失 contexts.md。")
-            sys.exit(0)
-
-        with open(prev_context_file, 'r', encoding='utf-8') as f:
-            prev_lines = f.readlines()
-        curr_lines = combined_context.splitlines(keepends=True)
-
-        # 使用 difflib 计算新增部分 (仅保留以 '+' 开头的行)
-        diff = list(difflib.unified_diff(prev_lines, curr_lines, n=0))
-        added_lines = [line[1:] for line in diff if line.startswith('+') and not line.startswith('+++')]
+        if prev_digests is not None:
+            # 新增内容 = 本次的 Block 中摘要不在上一次清单里的 Block
+            added_lines = render_added_blocks(context_file, manifest.new_blocks)
+        else:
+            # 上一次运行没有 Block 清单 (清单出现之前的运行)，回退为与其 contexts.md 做 diff
+            prev_context_file = previous_run_dir / "contexts.md"
+            if not prev_context_file.exists():
+                print(f"STATUS: FIRST_INCREMENTAL_RUN")
+                print(f"REASON: 历史目录 {previous_run_dir} 中缺失 {BLOCK_MANIFEST_NAME} 与 contexts.md。")
+                sys.exit(0)
+
+            # 本次的 contexts.md 在写出时已校验；历史运行的文件不一定，无法解码的字节按替换字符比较
+            with open(prev_context_file, 'r', encoding='utf-8', errors='replace') as f:
+                prev_lines = f.readlines()
+            with open(context_file, 'r', encoding='utf-8') as f:
+                curr_lines = f.readlines()
+
+            # 使用 difflib 计算新增部分 (仅保留以 '+' 开头的行)
+            diff = list(difflib.unified_diff(prev_lines, curr_lines, n=0))
+            added_lines = [line[1:] for line in diff if line.startswith('+') and not line.startswith('+++')]
 
         if not added_lines:
             print(f"STATUS: 增量模式终止。当前语料库与上次运行 ({previous_run_dir.name}) 相比无任何新增内容。")
@@ -148,8 +374,11 @@ def main():
             sys.exit(0)
 
         added_context_file = run_dir / "added-contexts.md"
-        with open(added_context_file, 'w', encoding='utf-8') as f:
-            f.writelines(added_lines)
+        with open(added_context_file, 'wb') as f:
+            added_writer = ContextWriter(f)
+            for line in added_lines:
+                added_writer.write(line.encode('utf-8'))
+        added_index_file = added_writer.write_index(added_context_file)
         print(f"INFO: 增量提取模式已激活。发现 {len(added_lines)} 行新内容。")
 
     # 如果强制全量，即使 strategy 定义为 incremental 也会走 full 流程
@@ -158,7 +387,10 @@ def main():
         print("INFO: 强制执行全量提取模式。")
 
     # 决定本次提取使用的上下文路径
-    active_context_file = added_context_file if (strategy == 'incremental' and not args.force_full) else context_file
+    if strategy == 'incremental' and not args.force_full:
+        active_context_file, active_index_file, active_lines = added_context_file, added_index_file, added_writer.line_count
+    else:
+        active_context_file, active_index_file, active_lines = context_file, context_index_file, context_writer.line_count
 
     # 4. 为每个目标生成分阶段 Prompt 文件与状态文件
     goals = spec.get('extraction_goals', [])
@@ -184,7 +416,7 @@ def main():
         # 构建包含指令的 YAML 状态文件
         state_content = f"""# [SUB-AGENT INSTRUCTION]
 # 你正在执行任务：{goal_title}。
-# 1. 初始化: 若 total_chunks 为 -1，请先使用 read_file 获取 context_path 的总行数，按每 500 行一个 chunk 分割，并初始化下面的 chunk_list。
+# 1. 初始化: 若 total_chunks 为 -1，请按 context_lines (context_path 的总行数，脚本已统计) 每 500 行一个 chunk 分割，并初始化下面的 chunk_list。
 # 2. 隔离提取: 遍历 chunk_list，处理 status 为 pending 的块，将产出保存为独立文件：output-{idx:02d}-chunk-{{{{chunk_no}}}}.md。
 # 3. 状态同步: 每处理并成功写入一个分块文件，请务必更新对应 chunk 的 status 为 done 并同步此文件。
 # 4. 严禁合并: 此阶段严禁尝试将分块合并为单个文件。
@@ -197,11 +429,13 @@ meta:
 
 files:
   context_path: "{active_context_file}"
+  line_index_path: "{active_index_file}" # 每 {LINE_INDEX_STEP} 行一个行首字节偏移
   prompt_path: "{prompt_path}"
   run_dir: "{run_dir}" # 分块结果存放地
   dependency_path: "{dep_path if dep_path else ''}"
 
 progress:
+  context_lines: {active_lines}
   total_chunks: -1
   chunk_list: [] # 格式: - chunk_no: 1, file: contexts.md, lines: 1-500, status: pending
   status: "PENDING"
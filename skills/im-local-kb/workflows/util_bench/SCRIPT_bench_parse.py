@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+# Add the workflows/01_ingest directory to sys.path to import SCRIPT_util
+sys.path.append(str(Path(__file__).parent.parent / "01_ingest"))
+from SCRIPT_util import RegexPatterns, FileParser
+
+"""
+SCRIPT_bench_parse.py
+描述: 对比 FileParser.parse_raw_file（单趟 LineClassifier）与逐行调用
+RegexPatterns.extract_chat_name + extract_time_tag 的旧解析路径，校验两者产出相同的 ChatBlock，并输出耗时。
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="[基准] 原始聊天记录解析耗时对比")
+    parser.add_argument("--input", help="用于测试的原始聊天记录文件 (缺省时生成合成数据)")
+    parser.add_argument("--lines", type=int, default=200000, help="合成数据的行数")
+    parser.add_argument("--fallback_year", type=int, default=2024, help="缺少年份时的兜底年份")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最快一次")
+    return parser.parse_args()
+
+def write_synthetic_raw(path: str, total_lines: int, seed: int = 0):
+    """
+    生成 `## -- 群名` / `-- MM-DD HH:MM` 格式的合成原始记录，每 20 行左右插入一个时间标签。
+    """
+    rnd = random.Random(seed)
+    words = "今天 我们 讨论 一下 模型 发布 计划 测试 数据 需要 确认 上线 时间 问题".split()
+    written = 0
+    day = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("---\ntitle: bench\n---\n")
+        while written < total_lines:
+            f.write(f"## -- 群聊{day % 7}\n")
+            for hour in range(9, 21, 3):
+                month, dom = 1 + (day // 28) % 12, 1 + day % 28
+                f.write(f"-- {month:02d}-{dom:02d} {hour:02d}:{rnd.randint(0, 59):02d}\n")
+                for _ in range(rnd.randint(10, 30)):
+                    f.write(f"用户{rnd.randint(1, 50)}: {''.join(rnd.choices(words, k=6))}\n")
+                    written += 1
+                f.write(f"-- {hour + 1:02d}:00\n")
+            day += 1
+
+def legacy_parse_blocks(file_path: str, fallback_year):
+    """
+    旧的逐行解析路径，仅用于对照。
+    """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    start_idx = 0
+    if lines and RegexPatterns.is_frontmatter(lines[0]):
+        start_idx = 1
+        while start_idx < len(lines) and not RegexPatterns.is_frontmatter(lines[start_idx]):
+            start_idx += 1
+        start_idx += 1
+
+    blocks = []
+    last_chat_name, last_time_tag, current_content = None, None, []
+    for line in lines[start_idx:]:
+        is_chat, chat_name = RegexPatterns.extract_chat_name(line)
+        if is_chat:
+            if last_chat_name is not None and last_time_tag is not None:
+                blocks.append((last_chat_name, last_time_tag, current_content))
+            last_chat_name, last_time_tag, current_content = RegexPatterns.chat_name_sanitize(chat_name), None, []
+            continue
+        is_time, time_tag = RegexPatterns.extract_time_tag(line, last_time_tag, fallback_year=fallback_year)
+        if is_time:
+            if last_chat_name is not None and last_time_tag is not None:
+                blocks.append((last_chat_name, last_time_tag, current_content))
+            last_time_tag, current_content = time_tag, []
+        else:
+            current_content.append(line)
+    if last_chat_name is not None and last_time_tag is not None:
+        blocks.append((last_chat_name, last_time_tag, current_content))
+    return blocks
+
+def best_of(repeat: int, fn):
+    best, result = None, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def main():
+    args = parse_args()
+    tmp_dir = None
+    input_path = args.input
+    if not input_path:
+        tmp_dir = tempfile.TemporaryDirectory()
+        input_path = os.path.join(tmp_dir.name, "bench_raw.md")
+        write_synthetic_raw(input_path, args.lines)
+
+    legacy_s, legacy_blocks = best_of(args.repeat, lambda: legacy_parse_blocks(input_path, args.fallback_year))
+    current_s, raw_file = best_of(args.repeat, lambda: FileParser.parse_raw_file(input_path, fallback_year=args.fallback_year))
+
+    current_blocks = [(b.chat_name, b.time_tag, list(b.content)) for b in raw_file.chat_blocks]
+    if current_blocks != legacy_blocks:
+        print("[ERROR] parse_raw_file 与旧解析路径的结果不一致")
+        sys.exit(1)
+
+    print(f"input: {input_path} ({os.path.getsize(input_path) / 1024 / 1024:.1f} MB, {len(current_blocks)} blocks)")
+    print(f"legacy per-line RegexPatterns: {legacy_s:.3f}s")
+    print(f"FileParser.parse_raw_file:     {current_s:.3f}s")
+    print(f"speedup: {legacy_s / current_s:.2f}x")
+
+    if tmp_dir:
+        tmp_dir.cleanup()
+
+if __name__ == "__main__":
+    main()
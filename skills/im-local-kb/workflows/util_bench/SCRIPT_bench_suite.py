@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, List, Optional
+
+# Add the workflows/01_ingest, 02_gap_check and 03_generate directories to sys.path
+sys.path.append(str(Path(__file__).parent.parent / "01_ingest"))
+sys.path.append(str(Path(__file__).parent.parent / "02_gap_check"))
+sys.path.append(str(Path(__file__).parent.parent / "03_generate"))
+from SCRIPT_util import ChatBlock, ChatOrgFile, FileParser
+from SCRIPT_normalize_merge import MergeTarget, magic_merge
+from SCRIPT_analyze_gaps import extract_time_tags_from_source
+from SCRIPT_extract_knowledge import write_combined_context
+from SCRIPT_gen_corpus import SyntheticTimeline, generate_raw_corpus, generate_org_corpus
+
+"""
+SCRIPT_bench_suite.py
+描述: im-local-kb 脚本的基准测试集。用 SCRIPT_gen_corpus.py 生成确定性的合成数据，按规模（行数）度量：
+- parse: FileParser.parse_raw_file
+- merge: magic_merge 的每种合并策略 (already_exists / both_match / begin_match / end_match / no_match)
+- gap: 02_gap_check 的 extract_time_tags_from_source
+- context: 03_generate 的上下文组装 (write_combined_context，流式写出 contexts.md)
+结果保存为 JSON，可用 --compare 与之前的结果对比。
+"""
+
+BENCHES = ["parse", "merge", "gap", "context"]
+MERGE_CASES = ["already_exists", "both_match", "begin_match", "end_match", "no_match"]
+
+
+def parse_size(text: str) -> int:
+    """
+    解析规模参数，支持 k / m 后缀，例如 10k -> 10000, 1M -> 1000000。
+    """
+    text = text.strip().lower()
+    multiplier = {"k": 1000, "m": 1000000}.get(text[-1:], 1)
+    return int(float(text[:-1] if multiplier > 1 else text) * multiplier)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="[基准] im-local-kb 基准测试集")
+    parser.add_argument("--sizes", default="10k,100k,1M", help="逗号分隔的规模 (行数)，支持 k/M 后缀，例如 10k,100k,1M,10M")
+    parser.add_argument("--bench", default=",".join(BENCHES), help=f"逗号分隔的测试项 (可选: {','.join(BENCHES)})")
+    parser.add_argument("--repeat", type=int, default=3, help="重复次数，取最快一次")
+    parser.add_argument("--seed", type=int, default=0, help="合成数据的随机种子")
+    parser.add_argument("--work_dir", help="合成数据目录 (缺省时使用临时目录，结束后删除)")
+    parser.add_argument("--output", help="结果 JSON 路径 (默认: bench_{timestamp}.json)")
+    parser.add_argument("--compare", help="与之前保存的结果 JSON 对比")
+    args = parser.parse_args()
+    args.sizes = [parse_size(size) for size in args.sizes.split(",") if size.strip()]
+    args.bench = [bench.strip() for bench in args.bench.split(",") if bench.strip()]
+    unknown = set(args.bench) - set(BENCHES)
+    if unknown:
+        parser.error(f"未知的测试项: {', '.join(sorted(unknown))}")
+    return args
+
+
+def measure(repeat: int, fn: Callable[[], object], setup: Optional[Callable[[], None]] = None) -> dict:
+    """
+    执行 fn repeat 次（每次之前执行 setup，不计时），返回最快一次与平均耗时，以及最后一次的返回值。
+    """
+    timings = []
+    result = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - t0)
+    return {"seconds": min(timings), "mean_seconds": sum(timings) / len(timings), "result": result}
+
+
+def record(results: List[dict], bench: str, case: str, lines: int, timing: dict, **extra):
+    entry = {"bench": bench, "case": case, "lines": lines, "seconds": round(timing["seconds"], 6),
+             "mean_seconds": round(timing["mean_seconds"], 6),
+             "lines_per_second": round(lines / timing["seconds"]) if timing["seconds"] else None}
+    entry.update(extra)
+    results.append(entry)
+    print(f"  {bench:<8} {case:<17} {lines:>10} lines  {timing['seconds']:>9.4f}s  ({entry['lines_per_second']} lines/s)")
+
+
+def bench_parse(size_dir: str, size: int, seed: int, repeat: int, results: List[dict]):
+    """
+    单个约 size 行的原始导出文件的解析耗时。
+    """
+    path = os.path.join(size_dir, "raw", "raw_0.md")
+    if not os.path.exists(path):
+        generate_raw_corpus(os.path.dirname(path), size, files=1, chats=3, overlap=0, seed=seed)
+    timing = measure(repeat, lambda: FileParser.parse_raw_file(path))
+    record(results, "parse", "parse_raw_file", size, timing, blocks=len(timing["result"].chat_blocks),
+           bytes=os.path.getsize(path))
+
+
+def fresh_lines(prefix: str, count: int) -> List[str]:
+    return [f"用户99: 新的消息内容用于基准测试 {prefix} #{no}\n" for no in range(count)]
+
+
+def bench_merge(size_dir: str, size: int, seed: int, repeat: int, results: List[dict]):
+    """
+    约 size 行的月度文件上，每种合并策略单个块的 magic_merge 耗时（包含加锁、加载、合并与写回）。
+    目标文件中间放置一个 30 行的会话，各策略的块由它构造；每次测量前恢复目标文件与 hash 缓存。
+    """
+    merge_dir = os.path.join(size_dir, "merge")
+    os.makedirs(merge_dir, exist_ok=True)
+    target_path = os.path.join(merge_dir, "2024-01.md")
+    pristine_path = os.path.join(merge_dir, "pristine.md")
+    pristine_index_path = os.path.join(merge_dir, "pristine.md.hashidx")
+    timeline = SyntheticTimeline(seed, "基准测试群")
+    sessions = max(3, round(size / 23.5))
+    middle = sessions // 2
+    anchor_lines = [f"用户{no % 7}: 这是中间会话里足够长的一条消息 #{no}\n" for no in range(30)]
+
+    if not os.path.exists(pristine_index_path):
+        with open(pristine_path, 'w', encoding='utf-8') as f:
+            f.write(f"## -- {timeline.chat_name}\n")
+            for i in range(sessions):
+                block = ChatBlock(timeline.chat_name, timeline.session_tag(i), anchor_lines if i == middle else timeline.session_lines(i), "")
+                f.writelines(ChatOrgFile.block_to_md_lines(block))
+        # 预先建立 hash 缓存，测量的是缓存命中时的合并
+        shutil.copyfile(pristine_path, target_path)
+        MergeTarget.load(target_path)
+        shutil.copyfile(os.path.join(merge_dir, ".2024-01.md.hashidx"), pristine_index_path)
+
+    middle_tag = timeline.session_tag(middle)
+    blocks = {
+        "already_exists": ChatBlock(timeline.chat_name, middle_tag, anchor_lines[5:25], ""),
+        "both_match": ChatBlock(timeline.chat_name, middle_tag, anchor_lines[:8] + fresh_lines("both", 5) + anchor_lines[-8:], ""),
+        "begin_match": ChatBlock(timeline.chat_name, middle_tag, anchor_lines[-10:] + fresh_lines("begin", 10), ""),
+        "end_match": ChatBlock(timeline.chat_name, middle_tag, fresh_lines("end", 10) + anchor_lines[:10], ""),
+        "no_match": ChatBlock(timeline.chat_name, timeline.session_tag(sessions), fresh_lines("none", 20), ""),
+    }
+
+    def restore():
+        shutil.copyfile(pristine_path, target_path)
+        shutil.copyfile(pristine_index_path, os.path.join(merge_dir, ".2024-01.md.hashidx"))
+
+    for case in MERGE_CASES:
+        timing = measure(repeat, lambda: magic_merge(blocks[case], target_path), setup=restore)
+        strategy = timing["result"].action_taken["strategy"]
+        if strategy != case:
+            print(f"[ERROR] magic_merge 的策略为 {strategy}，预期 {case}")
+            sys.exit(1)
+        record(results, "merge", case, size, timing)
+
+
+def bench_gap(size_dir: str, size: int, seed: int, repeat: int, results: List[dict]):
+    """
+    单个群聊约 size 行的月度文件上，extract_time_tags_from_source 扫描全部时间标签的耗时。
+    合成数据没有时间线索引：extract_time_tags 每次扫描全部文件；extract_cached 使用预热过的 03 缓存（重复运行缺口检查的情形）。
+    """
+    kb_dir = os.path.join(size_dir, "kb")
+    chat_dirs = ensure_org_corpus(kb_dir, size, seed)
+    start_dt, end_dt = datetime(2000, 1, 1), datetime(2200, 1, 1)
+    timing = measure(repeat, lambda: extract_time_tags_from_source(chat_dirs[0], start_dt, end_dt))
+    record(results, "gap", "extract_time_tags", size, timing, time_tags=len(timing["result"]))
+
+    cache_dir = os.path.join(size_dir, "gap_cache")
+    extract_time_tags_from_source(chat_dirs[0], start_dt, end_dt, cache_dir)
+    timing = measure(repeat, lambda: extract_time_tags_from_source(chat_dirs[0], start_dt, end_dt, cache_dir))
+    record(results, "gap", "extract_cached", size, timing, time_tags=len(timing["result"]))
+
+
+def bench_context(size_dir: str, size: int, seed: int, repeat: int, results: List[dict]):
+    """
+    单个群聊约 size 行的月度文件上，写出 contexts.md（含行数统计与行偏移索引）的耗时。
+    """
+    kb_dir = os.path.join(size_dir, "kb")
+    chat_dirs = ensure_org_corpus(kb_dir, size, seed)
+    data_dir = os.path.dirname(chat_dirs[0])
+    sources = [os.path.basename(chat_dir) for chat_dir in chat_dirs]
+    context_file = os.path.join(size_dir, "contexts.md")
+    timing = measure(repeat, lambda: write_combined_context(context_file, data_dir, sources, datetime(2000, 1, 1), datetime(2200, 1, 1)))
+    record(results, "context", "write_context", size, timing, bytes=timing["result"].bytes_written,
+           context_lines=timing["result"].line_count)
+
+
+def ensure_org_corpus(kb_dir: str, size: int, seed: int) -> List[str]:
+    """
+    gap 与 context 共用同一份整理后的数据，只生成一次。返回各群聊目录。
+    """
+    org_dir = os.path.join(kb_dir, "01-chats-input-organized")
+    if not os.path.isdir(org_dir):
+        generate_org_corpus(kb_dir, size, chats=1, seed=seed)
+    return sorted(os.path.join(org_dir, name) for name in os.listdir(org_dir))
+
+
+def compare_results(previous_path: str, results: List[dict]):
+    """
+    按 (bench, case, lines) 与之前的结果对比，ratio > 1 表示本次更慢。
+    """
+    with open(previous_path, 'r', encoding='utf-8') as f:
+        previous = {(r["bench"], r["case"], r["lines"]): r for r in json.load(f)["results"]}
+    print(f"\nCompared with {previous_path} (ratio = current / previous):")
+    for r in results:
+        old = previous.get((r["bench"], r["case"], r["lines"]))
+        if old and old["seconds"]:
+            print(f"  {r['bench']:<8} {r['case']:<15} {r['lines']:>10}  {old['seconds']:>9.4f}s -> {r['seconds']:>9.4f}s  x{r['seconds'] / old['seconds']:.2f}")
+
+
+def main():
+    args = parse_args()
+    tmp_dir = None
+    work_dir = args.work_dir
+    if not work_dir:
+        tmp_dir = tempfile.TemporaryDirectory()
+        work_dir = tmp_dir.name
+
+    bench_fns = {"parse": bench_parse, "merge": bench_merge, "gap": bench_gap, "context": bench_context}
+    results: List[dict] = []
+    try:
+        for size in args.sizes:
+            print(f"size: {size} lines")
+            # 每个规模、每个 seed 一个数据目录；指定 --work_dir 时可复用已生成的数据
+            size_dir = os.path.join(work_dir, f"size_{size}_seed_{args.seed}")
+            for bench in args.bench:
+                bench_fns[bench](size_dir, size, args.seed, args.repeat, results)
+    finally:
+        if tmp_dir:
+            tmp_dir.cleanup()
+
+    output_path = args.output or f"bench_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.json"
+    report = {
+        "meta": {
+            "created": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "repeat": args.repeat,
+            "sizes": args.sizes,
+        },
+        "results": results
+    }
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results saved to {output_path}")
+
+    if args.compare:
+        compare_results(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
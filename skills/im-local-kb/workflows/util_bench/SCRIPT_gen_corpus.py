@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import random
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Add the workflows/01_ingest directory to sys.path to import SCRIPT_util
+sys.path.append(str(Path(__file__).parent.parent / "01_ingest"))
+from SCRIPT_util import ChatBlock, ChatOrgFile, KnowledgeBasePaths, RegexPatterns
+
+"""
+SCRIPT_gen_corpus.py
+描述: 确定性的合成聊天记录生成器，供基准测试使用。相同的参数与 seed 总是生成逐字节相同的文件。
+- 原始导出 (00): frontmatter、`## -- 群名`、`-- YYYY-MM-DD HH:MM` / `-- MM-DD HH:MM` / `-- HH:MM` 时间标签，
+  相邻文件按 overlap 比例覆盖同一段会话，重叠边界上的会话被截头/截尾，少量会话缺失中间的消息（模拟不同设备、不同日期的导出）。
+- 整理后 (01): 按 {chat}/{YYYY-MM}.md 组织的规范月度文件，与 ingest 的输出格式相同。
+"""
+
+WORDS = "今天 我们 讨论 一下 模型 发布 计划 测试 数据 需要 确认 上线 时间 问题 修复 完成 进度 同步 会议 文档".split()
+CHAT_NAMES = ["项目讨论群", "摸鱼群", "张三", "产品/需求 评审", "[运维] 值班群", "李四", "架构组", "客户支持"]
+NOISE_LINES = ["[图片]\n", "[表情]\n", "\n"]
+# 原始导出每个会话平均的行数（时间标签 1 行 + 平均 22.5 行消息），用于按目标行数估算会话数
+AVERAGE_SESSION_LINES = 23.5
+
+
+def chat_name_for(c: int) -> str:
+    """
+    第 c 个群聊的名称（包含需要转义的字符，与真实导出一致），超出预置名称时追加序号。
+    """
+    return CHAT_NAMES[c % len(CHAT_NAMES)] + (str(c // len(CHAT_NAMES)) if c >= len(CHAT_NAMES) else "")
+
+
+class SyntheticTimeline:
+    """
+    单个群聊的确定性时间线：第 i 个会话的时间与消息只由 (seed, chat_name, i) 决定。
+    不需要在内存中保存整条时间线，任意导出文件都可以重新生成同一段会话，以构造重叠的导出。
+    """
+
+    def __init__(self, seed: int, chat_name: str, start: datetime = datetime(2024, 1, 1), sessions_per_day: int = 4):
+        self.seed = seed
+        self.chat_name = chat_name
+        self.start = start
+        self.sessions_per_day = sessions_per_day
+
+    def session_time(self, i: int) -> datetime:
+        rnd = random.Random(f"{self.seed}:{self.chat_name}:time:{i}")
+        day, slot = divmod(i, self.sessions_per_day)
+        # 会话落在一天中均匀分布的时段内，分钟随机，保证同一天内时间严格递增
+        slot_minutes = (14 * 60) // self.sessions_per_day
+        minute = 8 * 60 + slot * slot_minutes + rnd.randrange(slot_minutes)
+        return self.start + timedelta(days=day, minutes=minute)
+
+    def session_tag(self, i: int) -> str:
+        return self.session_time(i).strftime("%Y-%m-%d %H:%M")
+
+    def session_lines(self, i: int) -> List[str]:
+        """
+        会话的消息行（均以换行结尾）：大部分是带唯一编号的消息，夹杂少量图片/表情/空行等噪音行。
+        """
+        rnd = random.Random(f"{self.seed}:{self.chat_name}:lines:{i}")
+        lines = []
+        for no in range(rnd.randint(5, 40)):
+            if rnd.random() < 0.08:
+                lines.append(rnd.choice(NOISE_LINES))
+            else:
+                text = "".join(rnd.choices(WORDS, k=rnd.randint(3, 9)))
+                lines.append(f"用户{rnd.randint(1, 30)}: {text} #{i}-{no}\n")
+        return lines
+
+    def block(self, i: int) -> ChatBlock:
+        return ChatBlock(self.chat_name, self.session_tag(i), self.session_lines(i), "")
+
+
+def format_raw_time_tag(dt: datetime, prev: Optional[datetime], rnd: random.Random) -> str:
+    """
+    原始导出中的时间标签写法：每段的第一个标签、跨年时写完整日期；跨天时写 MM-DD HH:MM；同一天内写 HH:MM。
+    偶尔在不必要时也写完整日期，覆盖解析器的各个分支。
+    2 月 29 日总是写完整日期：MM-DD 写法按 1900 年校验日期，无法解析 02-29。
+    """
+    if prev is None or prev.year != dt.year or (dt.month, dt.day) == (2, 29) or rnd.random() < 0.1:
+        return dt.strftime("-- %Y-%m-%d %H:%M\n")
+    if prev.date() != dt.date():
+        return dt.strftime("-- %m-%d %H:%M\n")
+    return dt.strftime("-- %H:%M\n")
+
+
+def generate_raw_corpus(output_dir: str, total_lines: int, files: int = 4, chats: int = 3, overlap: float = 0.3, seed: int = 0) -> List[str]:
+    """
+    生成约 total_lines 行的原始导出文件 raw_{k}.md（k = 0..files-1），返回文件路径列表。
+    每个文件包含 chats 个群聊，每个群聊覆盖连续的一段会话；相邻文件覆盖的会话有 overlap 比例的重叠。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    timelines = [SyntheticTimeline(seed, chat_name_for(c)) for c in range(chats)]
+    window = max(1, round(total_lines / (files * chats * AVERAGE_SESSION_LINES)))
+    step = max(1, round(window * (1 - overlap)))
+
+    paths = []
+    for k in range(files):
+        rnd = random.Random(f"{seed}:file:{k}")
+        first, last = k * step, k * step + window
+        path = os.path.join(output_dir, f"raw_{k}.md")
+        with open(path, 'w', encoding='utf-8') as f:
+            if k % 2 == 0:
+                f.write(f"---\ntitle: synthetic export {k}\nseed: {seed}\n---\n\n")
+            for timeline in timelines:
+                f.write(f"## -- {timeline.chat_name}\n\n")
+                prev = None
+                for i in range(first, last):
+                    lines = timeline.session_lines(i)
+                    if len(lines) > 8:
+                        # 导出边界上的会话不完整：开头的会话截掉前几行，结尾的会话截掉后几行
+                        if i == first and k > 0:
+                            lines = lines[rnd.randint(1, 3):]
+                        if i == last - 1 and k < files - 1:
+                            lines = lines[:-rnd.randint(1, 3)]
+                        # 与上一个文件重叠的会话，偶尔缺失中间的一两条消息
+                        if k > 0 and i < (k - 1) * step + window and rnd.random() < 0.05:
+                            cut = rnd.randint(3, len(lines) - 4)
+                            lines = lines[:cut] + lines[cut + rnd.randint(1, 2):]
+                    dt = timeline.session_time(i)
+                    f.write(format_raw_time_tag(dt, prev, rnd))
+                    f.writelines(lines)
+                    prev = dt
+                f.write("\n")
+        paths.append(path)
+    return paths
+
+
+def generate_org_corpus(knowledge_base_dir: str, total_lines: int, chats: int = 1, seed: int = 0) -> Dict[str, List[str]]:
+    """
+    在 knowledge_base_dir/01-chats-input-organized 下生成约 total_lines 行的规范月度文件，
+    返回 {chat_name: [月度文件路径, ...]}（按时间顺序）。
+    """
+    result = {}
+    sessions = max(1, round(total_lines / (chats * AVERAGE_SESSION_LINES)))
+    for c in range(chats):
+        # 整理后文件中的群聊名称是转义后的名称（与 ingest 的输出一致）
+        timeline = SyntheticTimeline(seed, RegexPatterns.chat_name_sanitize(chat_name_for(c)))
+        paths = []
+        month_path, month_file = None, None
+        for i in range(sessions):
+            block = timeline.block(i)
+            path = KnowledgeBasePaths.get_org_file_path(knowledge_base_dir, chat_name=block.chat_name, dt=block.time_tag)
+            if path != month_path:
+                # 会话按时间递增，换月时关闭上一个月度文件
+                if month_file:
+                    month_file.close()
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                month_path, month_file = path, open(path, 'w', encoding='utf-8')
+                month_file.write(f"## -- {block.chat_name}\n")
+                paths.append(path)
+            month_file.writelines(ChatOrgFile.block_to_md_lines(block))
+        if month_file:
+            month_file.close()
+        result[timeline.chat_name] = paths
+    return result
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="[基准] 生成确定性的合成聊天记录")
+    parser.add_argument("--output_dir", required=True, help="输出目录 (原始导出) 或知识库目录 (--organized)")
+    parser.add_argument("--lines", type=int, default=100000, help="大约生成的总行数")
+    parser.add_argument("--files", type=int, default=4, help="原始导出文件数")
+    parser.add_argument("--chats", type=int, default=3, help="群聊数")
+    parser.add_argument("--overlap", type=float, default=0.3, help="相邻导出文件的会话重叠比例 (0 ~ 1)")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子")
+    parser.add_argument("--organized", action="store_true", help="生成整理后的月度文件 (01-chats-input-organized)，而不是原始导出")
+    args = parser.parse_args()
+    if not 0 <= args.overlap < 1:
+        parser.error("--overlap 必须在 [0, 1) 范围内")
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.organized:
+        result = generate_org_corpus(args.output_dir, args.lines, chats=args.chats, seed=args.seed)
+        paths = [path for chat_paths in result.values() for path in chat_paths]
+    else:
+        paths = generate_raw_corpus(args.output_dir, args.lines, files=args.files, chats=args.chats, overlap=args.overlap, seed=args.seed)
+    total_lines = 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            total_lines += sum(1 for _ in f)
+    print(json.dumps({"files": len(paths), "lines": total_lines, "seed": args.seed}, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
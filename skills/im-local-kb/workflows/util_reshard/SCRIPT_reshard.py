@@ -0,0 +1,152 @@
+import os
+import sys
+import argparse
+from collections import Counter
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Dict, List
+
+# Add the workflows/01_ingest directory to sys.path to import SCRIPT_util
+sys.path.append(str(Path(__file__).parent.parent / "01_ingest"))
+from SCRIPT_util import ChatBlock, ChatOrgFile, FileParser, KnowledgeBasePaths, ShardLayout, atomic_write_bytes, block_digest
+from SCRIPT_normalize_merge import rebuild_timeline_index, target_lock
+
+"""
+SCRIPT_reshard.py
+描述: 调整整理后 (01) 群聊的分片粒度 (month / week / day)，并更新群聊目录的分片清单 _shard.yaml。
+步骤（每个群聊）：
+1. 加锁读取当前粒度的全部分片，按新粒度重新分组、排序、渲染，原子写出新分片；
+2. 重新解析新分片，校验块的内容摘要与旧分片完全一致（不一致时删除新分片并报错，旧数据不受影响）；
+3. 写入新的 _shard.yaml，此后读取方只看到新分片；
+4. 删除旧分片及其 hash 缓存，重建群聊的时间线索引。
+任何一步中断，清单仍指向旧粒度（或已经指向完整的新分片），重新运行即可清理残留的文件。
+运行期间不要同时执行 ingest。
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="[重新分片] 调整整理后群聊的分片粒度")
+    parser.add_argument("--knowledge_base_dir", required=True, type=str, help="知识库目录")
+    parser.add_argument("--granularity", required=True, choices=ShardLayout.GRANULARITIES, help="新的分片粒度")
+    parser.add_argument("--chat", action="append", help="群聊名称，可重复指定 (默认: 全部群聊)")
+    parser.add_argument("--dry-run", action="store_true", help="只输出计划，不修改文件")
+    return parser.parse_args()
+
+
+def remove_shard(file_path: str):
+    """
+    删除分片文件及其 hash 缓存。锁文件在释放锁之后另行删除（见 target_lock）。
+    """
+    for path in (file_path, KnowledgeBasePaths.get_org_hash_index_path(file_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def foreign_shards(chat_dir: str, layout: ShardLayout) -> List[str]:
+    """
+    群聊目录中不属于 layout 粒度的分片文件（重新分片中断后残留的文件）。
+    """
+    paths = []
+    for file_name in sorted(os.listdir(chat_dir)):
+        stem, ext = os.path.splitext(file_name)
+        shard = ShardLayout.parse_shard_name(stem) if ext == ".md" and not file_name.startswith(".") else None
+        if shard and shard[0] != layout.granularity:
+            paths.append(os.path.join(chat_dir, file_name))
+    return paths
+
+
+def reshard_chat(chat_dir: str, target: ShardLayout, dry_run: bool = False) -> dict:
+    """
+    把一个群聊目录重新分片为 target 粒度，返回统计信息。
+    """
+    current = ShardLayout.load(chat_dir)
+    chat_name = os.path.basename(chat_dir)
+    old_files = [path for path in current.shard_files(chat_dir) if ShardLayout.parse_shard_name(Path(path).stem)]
+    stats = {"chat": chat_name, "from": current.granularity, "to": target.granularity,
+             "old_files": len(old_files), "new_files": 0, "blocks": 0, "removed_leftovers": 0}
+
+    if current.granularity == target.granularity:
+        leftovers = foreign_shards(chat_dir, current)
+        stats["new_files"] = len(old_files)
+        stats["removed_leftovers"] = len(leftovers)
+        if not dry_run:
+            for path in leftovers:
+                remove_shard(path)
+        return stats
+
+    with ExitStack() as stack:
+        for path in old_files:
+            stack.enter_context(target_lock(path))
+
+        groups: Dict[str, List[ChatBlock]] = {}
+        old_digests = Counter()
+        for path in old_files:
+            for block in FileParser.parse_org_file(path).chat_blocks:
+                groups.setdefault(target.shard_file_path(chat_dir, block.time_tag), []).append(block)
+                old_digests[block_digest(block)] += 1
+        stats["new_files"] = len(groups)
+        stats["blocks"] = sum(old_digests.values())
+        if dry_run:
+            return stats
+
+        # 之前中断的运行可能留下了新粒度的文件：不在本次分组中的直接删除，其余由原子写入覆盖
+        new_files = sorted(groups)
+        for path in foreign_shards(chat_dir, current):
+            if path not in groups:
+                remove_shard(path)
+                stats["removed_leftovers"] += 1
+        new_digests = Counter()
+        for path in new_files:
+            stack.enter_context(target_lock(path))
+            org_file = ChatOrgFile(path)
+            org_file.chat_blocks = groups[path]
+            atomic_write_bytes(path, "".join(org_file.convert_to_md_lines()).encode('utf-8'))
+            # 旧的 hash 缓存以内容摘要为键，本来就会失效，这里直接删除
+            index_path = KnowledgeBasePaths.get_org_hash_index_path(path)
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            for block in FileParser.parse_org_file(path).chat_blocks:
+                new_digests[block_digest(block)] += 1
+
+        if new_digests != old_digests:
+            for path in new_files:
+                remove_shard(path)
+            raise ValueError(f"重新分片后 {chat_name} 的内容与原分片不一致，已撤销新分片，原数据未修改")
+
+        target.save(chat_dir)
+        for path in old_files:
+            remove_shard(path)
+        rebuild_timeline_index(chat_dir)
+    # 旧分片已经不存在，释放锁之后再删除它们的锁文件
+    for path in old_files:
+        lock_path = KnowledgeBasePaths.get_org_lock_path(path)
+        if os.path.exists(lock_path):
+            os.remove(lock_path)
+    return stats
+
+
+def main():
+    args = parse_args()
+    org_dir = os.path.join(args.knowledge_base_dir, "01-chats-input-organized")
+    if not os.path.isdir(org_dir):
+        print(f"Error: Organized directory '{org_dir}' does not exist.")
+        sys.exit(1)
+
+    if args.chat:
+        chat_dirs = [KnowledgeBasePaths.get_org_chat_dir(args.knowledge_base_dir, chat) for chat in args.chat]
+    else:
+        chat_dirs = sorted(os.path.join(org_dir, name) for name in os.listdir(org_dir))
+    target = ShardLayout(args.granularity)
+
+    for chat_dir in chat_dirs:
+        if not os.path.isdir(chat_dir):
+            print(f"[WARNING] Chat directory not found: {chat_dir}")
+            continue
+        stats = reshard_chat(chat_dir, target, dry_run=args.dry_run)
+        prefix = "[DRY-RUN] " if args.dry_run else ""
+        print(f"{prefix}{stats['chat']}: {stats['old_files']} {stats['from']} file(s) -> {stats['new_files']} {stats['to']} file(s), "
+              f"{stats['blocks']} block(s), {stats['removed_leftovers']} leftover file(s) removed")
+
+
+if __name__ == "__main__":
+    main()